@@ -1,5 +1,6 @@
 import parlay
 from parlay.server.broker import Broker, run_in_thread
+from parlay.server.envelope import encode_message
 from twisted.web.client import Agent, readBody
 from twisted.web.http_headers import Headers
 import base64
@@ -235,7 +236,7 @@ class CloudLinkWebsocketClient(WebSocketClientProtocol):
         :param msg:
         :return:
         """
-        self.sendMessage(json.dumps(msg))
+        self.sendMessage(encode_message(msg))
 
     def onConnect(self, response):
         print "Connected to cloud"
@@ -2,6 +2,7 @@ from base import BaseItem
 from parlay.protocols.utils import message_id_generator
 from twisted.internet import defer
 from parlay.server.broker import run_in_broker, run_in_thread
+from parlay.server.envelope import ParlayMessage
 from parlay.items.threaded_item import ThreadedItem
 from parlay.items.base import INPUT_TYPES, MSG_STATUS, MSG_TYPES, TX_TYPES, INPUT_TYPE_DISCOVERY_LOOKUP, \
     INPUT_TYPE_CONVERTER_LOOKUP
@@ -66,7 +67,8 @@ class ParlayStandardItem(ThreadedItem):
         else:
             self._content_fields.append(discovery)
 
-    def add_property(self, id, attr_name=None, input=INPUT_TYPES.STRING, read_only=False, write_only=False, name=None):
+    def add_property(self, id, attr_name=None, input=INPUT_TYPES.STRING, read_only=False, write_only=False, name=None,
+                     cache_ttl=None):
         """
         Add a property to this Item.
         :param id : the id of the name
@@ -74,12 +76,16 @@ class ParlayStandardItem(ThreadedItem):
         :param attr_name = the name of the attr to set in 'self' when setting and getting (None if same as name)
         :param read_only = Read only
         :param write_only = write_only
+        :param cache_ttl = seconds the broker may answer GETs with the last value before asking us again (None to
+        always ask us)
         """
         name = name if name is not None else id
         attr_name = attr_name if attr_name is not None else name  # default
                                                 # attr_name isn't needed for discovery, but for lookup
         self._properties[id] = {"PROPERTY": id, "PROPERTY_NAME": name, "ATTR_NAME": attr_name, "INPUT": input,
                                   "READ_ONLY": read_only, "WRITE_ONLY": write_only}  # add to internal list
+        if cache_ttl is not None:
+            self._adapter.set_property_cache_ttl(self.item_id, id, cache_ttl)
 
     def add_datastream(self, id, attr_name=None, units="", name=None):
         """
@@ -181,9 +187,9 @@ class ParlayStandardItem(ThreadedItem):
         if from_ is None:
             from_ = self.item_id
 
-        msg = {"TOPICS": {"FROM": from_, "TX_TYPE": tx_type, "MSG_TYPE": msg_type, "MSG_ID": msg_id,
-                          "MSG_STATUS": msg_status, "RESPONSE_REQ": response_req},
-               "CONTENTS": contents}
+        msg = ParlayMessage({"FROM": from_, "TX_TYPE": tx_type, "MSG_TYPE": msg_type, "MSG_ID": msg_id,
+                             "MSG_STATUS": msg_status, "RESPONSE_REQ": response_req},
+                            contents)
 
         if to is not None:
             msg["TOPICS"]["TO"] = to
@@ -225,8 +231,10 @@ class ParlayStandardItem(ThreadedItem):
         """
         msg = self.make_msg(to, command, msg_type=MSG_TYPES.COMMAND,
                             direct=True, response_req=True, COMMAND=command, **kwargs)
+        # make the handle first so it's waiting before any response can come back
+        handle = CommandHandle(msg, self)
         self.send_parlay_message(msg, wait=False)
-        return CommandHandle(msg, self)
+        return handle
 
     def encode_binary_data(self, mime_type, content):
         """
@@ -303,7 +311,7 @@ class ParlayProperty(object):
     """
 
     def __init__(self, default=None, val_type=str, read_only=False, write_only=False,
-                 custom_read=None, custom_write=None, callback=lambda _, __: __):
+                 custom_read=None, custom_write=None, callback=lambda _, __: __, cache_ttl=None):
         """
         Init method for the ParlayProperty class
 
@@ -314,6 +322,8 @@ class ParlayProperty(object):
         :param write_only : Set to true to make write only
         :param custom_write : Custom write function to call when writing
         :param custom_read : Custom read function to get the value
+        :param cache_ttl : seconds the broker may answer GETs with the last value before asking the item again
+        (None to always ask the item)
         :return: none
         """
         self._val_lookup = {}  # lookup based on instance
@@ -324,6 +334,7 @@ class ParlayProperty(object):
         self._custom_read = custom_read
         self._custom_write = custom_write
         self._callback = callback
+        self._cache_ttl = cache_ttl
         self.listeners = {}  # dict: item instance -> { dict: requester_id -> listener}
         # can't be both read and write only
         assert(not(self._read_only and write_only))
@@ -524,7 +535,8 @@ class ParlayCommandItem(ParlayStandardItem):
             if isinstance(member, ParlayProperty):
                 self.add_property(member_name, member_name,  # lookup type name based on type func (e.g. int())
                                   INPUT_TYPE_DISCOVERY_LOOKUP.get(member._val_type.__name__, "STRING"),
-                                  read_only=member._read_only, write_only=member._write_only)
+                                  read_only=member._read_only, write_only=member._write_only,
+                                  cache_ttl=member._cache_ttl)
 
     def _add_datastreams_to_discovery(self):
         """
@@ -306,32 +306,31 @@ class CommandHandle(object):
         self._done = False  # True when we're done listening (So we can clean up)
         self._queue = Queue.Queue()
 
-        # add our listener
-        self._script.add_listener(self._generic_on_message)
+        # have the adapter route every response to our message straight to us. The response table belongs to the
+        # reactor thread
+        self._pending = self._script._reactor.maybeblockingCallFromThread(
+            self._script._adapter.expect_response, topics['FROM'], topics['TO'], topics['MSG_ID'],
+            self._generic_on_message)
 
     def _generic_on_message(self, msg):
         """
         Listener function that powers the handle.
-        This should only be called by a script in the reactor thread in its listener loop
+        The adapter calls this in the reactor thread with each message that has our message id but swapped TO and
+        FROM, until the final response
         """
 
         topics, contents = msg["TOPICS"], msg["CONTENTS"]
-        if topics.get("MSG_ID", None) == self._msg_topics["MSG_ID"] \
-                and topics.get("TO", None) == self._msg_topics["FROM"] \
-                and topics.get("FROM", None) == self._msg_topics['TO']:
-
-            # add it to the list if the msg ids match but to and from are swapped (this is for inspection later)
-            self.msg_list.append(msg)
-            # add it to the message queue for messages that we have not looked at yet
-            self._queue.put_nowait(msg)
-
-            status = topics.get("MSG_STATUS", None)
-            msg_type = topics.get("MSG_TYPE", None)
-            if msg_type == MSG_TYPES.RESPONSE and status != MSG_STATUS.PROGRESS:
-                #  if it's a response but not an ack, then we're done
-                self._done = True
-
-        # remove this function from the listeners list
+        # add it to the list (this is for inspection later)
+        self.msg_list.append(msg)
+        # add it to the message queue for messages that we have not looked at yet
+        self._queue.put_nowait(msg)
+
+        status = topics.get("MSG_STATUS", None)
+        msg_type = topics.get("MSG_TYPE", None)
+        if msg_type == MSG_TYPES.RESPONSE and status != MSG_STATUS.PROGRESS:
+            #  if it's a response but not an ack, then we're done
+            self._done = True
+
         return self._done
 
     @run_in_thread
@@ -4,6 +4,8 @@ from parlay.protocols.utils import message_id_generator
 from twisted.python.failure import Failure
 from base import BaseItem
 from parlay.server.broker import Broker, run_in_broker
+from parlay.server.discovery_cache import apply_patch
+from parlay.server.envelope import ParlayMessage
 from parlay.constants import DEFAULT_TIMEOUT
 import sys
 import json
@@ -47,16 +49,20 @@ class ThreadedItem(BaseItem):
         self._msg_listeners = []
         self._system_errors = []
         self._system_events = []
+        self._response_waiters = []  # functions to call with a system error, for requests waiting on a response
         self._timer = None
 
         self._auto_update_discovery = True  #: If True auto update discovery with broadcast discovery messages
         self.discovery = {}  #: The current discovery information to pull from
+        self.discovery_version = None  #: The broker's version of self.discovery, None if we don't know it
 
         self._message_id_generator = message_id_generator(65535, 100)
+        self._find_id_generator = message_id_generator(65535)
 
         # Add this listener so it will be first in the list to pickup errors, warnings and events.
         self.add_listener(self._system_listener)
         self.add_listener(self._discovery_request_listener)
+        self.add_listener(self._discovery_changes_listener)
 
         self._adapter.subscribe(self._discovery_broadcast_listener, type='DISCOVERY_BROADCAST')
 
@@ -70,10 +76,37 @@ class ThreadedItem(BaseItem):
         Listen for discovery broadcast listeners and update our discovery accordingly
         """
         if self._auto_update_discovery and msg['CONTENTS'].get("status", "") == "ok":
-            self.discovery = msg['CONTENTS'].get('discovery', self.discovery)
+            contents = msg['CONTENTS']
+            if 'patch' not in contents:
+                # a whole discovery
+                self.discovery = contents.get('discovery', self.discovery)
+                self.discovery_version = contents.get('version', None)
+            elif self.discovery_version is not None:
+                if contents.get('base_version', None) == self.discovery_version:
+                    self.discovery = apply_patch(self.discovery, contents['patch'])
+                    self.discovery_version = contents['version']
+                elif contents['version'] > self.discovery_version:
+                    # we missed a change. Catch up
+                    self.publish({'TOPICS': {'type': 'broker', 'request': 'get_discovery_changes'},
+                                  'CONTENTS': {'version': self.discovery_version}})
 
         return ListenerStatus.KEEP_LISTENER
 
+    def _discovery_changes_listener(self, msg):
+        """
+        Catch up on the discovery changes we missed
+        """
+        if msg['TOPICS'].get('response', "") == 'get_discovery_changes_response' and \
+                msg['CONTENTS'].get('status', "") == 'ok':
+            contents = msg['CONTENTS']
+            if 'patch' not in contents:
+                self.discovery = contents.get('discovery', self.discovery)
+                self.discovery_version = contents['version']
+            elif contents.get('base_version', None) == self.discovery_version:
+                self.discovery = apply_patch(self.discovery, contents['patch'])
+                self.discovery_version = contents['version']
+        return ListenerStatus.KEEP_LISTENER
+
     def _system_listener(self, msg):
         """
         This should be the first listener in the list. It will store any non-response errors and events
@@ -86,6 +119,9 @@ class ThreadedItem(BaseItem):
             status = msg['TOPICS'].get('MSG_STATUS', "")
             if status == 'ERROR':
                 self._system_errors.append(msg)
+                # the oldest request waiting on a response gets the error
+                if len(self._response_waiters) > 0:
+                    self._response_waiters.pop(0)(self._system_errors.pop(0))
             elif status == 'WARNING' or status == 'INFO':
                 self._system_events.append(msg)
         return ListenerStatus.KEEP_LISTENER
@@ -169,7 +205,7 @@ class ThreadedItem(BaseItem):
         """
         Prepare a message for the broker to disperse
         """
-        msg = {'TOPICS': {}, 'CONTENTS': kwargs}
+        msg = ParlayMessage({}, kwargs)
         if _extra_topics is not None:
             msg["TOPICS"] = _extra_topics
 
@@ -218,6 +254,18 @@ class ThreadedItem(BaseItem):
         # block the thread until we get a discovery or error
         return self._reactor.maybeblockingCallFromThread(self._in_reactor_discover, force)
 
+    def find_items(self, **query):
+        """
+        Ask the broker for the discovery of just the items that match a query, instead of the whole discovery.
+
+        :param query: any of ID, NAME, TYPE (a prefix of the item's type), INTERFACE and limit
+        :return: list of item discovery objects (with their children)
+        """
+        if not self._reactor.running:
+            raise Exception("You must call parlay.utils.setup() at the beginning of a script!")
+
+        return self._reactor.maybeblockingCallFromThread(self._in_reactor_find_items, **query)
+
     def save_discovery(self, path):
         """
         Save the current discovery information to a file so it can be loaded later
@@ -258,12 +306,11 @@ class ThreadedItem(BaseItem):
         try:
             defer.returnValue(find())
         except StopIteration:
-            # discover and try again
-            try:
-                yield self.discover(force=False)
-                defer.returnValue(find())
-            except StopIteration:
+            # ask the broker for just that item
+            items = yield self._in_reactor_find_items(ID=item_id)
+            if len(items) == 0:
                 raise KeyError("Couldn't find item with id " + str(item_id))
+            defer.returnValue(self._proxy_item(items[0]))
 
     @run_in_broker
     @defer.inlineCallbacks
@@ -286,12 +333,11 @@ class ThreadedItem(BaseItem):
         try:
             defer.returnValue(find())
         except StopIteration:
-            # discover and try again
-            try:
-                yield self.discover(force=False)
-                defer.returnValue(find())
-            except StopIteration:
+            # ask the broker for just that item
+            items = yield self._in_reactor_find_items(NAME=item_name)
+            if len(items) == 0:
                 raise KeyError("Couldn't find item with name " + str(item_name))
+            defer.returnValue(self._proxy_item(items[0]))
 
     @run_in_broker
     @defer.inlineCallbacks
@@ -307,9 +353,9 @@ class ThreadedItem(BaseItem):
             raise Exception("You must call parlay.utils.setup() at the beginning of a script!")
 
         result = [self._proxy_item(x) for x in self._find_item_info(self.discovery, item_name, "NAME")]
-        if len(result) == 0:  # retry after discover if it fails
-            yield self.discover(force=False)
-            result = [self._proxy_item(x) for x in self._find_item_info(self.discovery, item_name, "NAME")]
+        if len(result) == 0:  # ask the broker if we don't know about any
+            items = yield self._in_reactor_find_items(NAME=item_name)
+            result = [self._proxy_item(x) for x in items]
 
         defer.returnValue(result)
 
@@ -383,43 +429,41 @@ class ThreadedItem(BaseItem):
         """
         response = defer.Deferred()
         timer = None
+        pending = None
         timeout_msg = {'TOPICS': {'MSG_TYPE': 'TIMEOUT'}}
 
-        def listener(received_msg):
-            # See if this is the response we are waiting for
-            if received_msg['TOPICS'].get('MSG_TYPE', "") == MSG_TYPES.RESPONSE:
-                if received_msg['TOPICS']['TO'] == self.item_id and \
-                        received_msg['TOPICS'].get('MSG_ID', None) == msg['TOPICS']['MSG_ID']:
-
-                    if received_msg['TOPICS'].get('MSG_STATUS', "") == MSG_STATUS.PROGRESS:
-                        return False  # keep waiting, an ACK means its not finished yet, it just got our msg
-                    if timer is not None:
-                        # Clear the timer
-                        timer.cancel()
-                    if received_msg['TOPICS'].get('MSG_STATUS', "") == MSG_STATUS.ERROR:
-                        # return error to waiting thread
-                        response.errback(Failure(ErrorResponse(received_msg)))
-                    else:
-                        # send the response back to the waiting thread
-                        response.callback(received_msg)
-                    return True  # remove this listener from the list
-
-            else:  # not our response.  Check for a system error.
-                if len(self._system_errors) > 0:
-                    if timer is not None:
-                        # clear out the timer
-                        timer.cancel()
-                    # report an error to the waiting thread
-                    response.errback(Failure(AsyncSystemError(self._system_errors.pop(0))))
-                    return True  # remove this listener
-
-            return False  # not for this listener - don't remove
+        def on_response(received_msg):
+            # the adapter only calls us with responses to msg
+            if received_msg['TOPICS'].get('MSG_STATUS', "") == MSG_STATUS.PROGRESS:
+                return  # keep waiting, an ACK means its not finished yet, it just got our msg
+            if timer is not None and timer.active():
+                # Clear the timer
+                timer.cancel()
+            if on_system_error in self._response_waiters:
+                self._response_waiters.remove(on_system_error)
+            if received_msg['TOPICS'].get('MSG_STATUS', "") == MSG_STATUS.ERROR:
+                # return error to waiting thread
+                response.errback(Failure(ErrorResponse(received_msg)))
+            else:
+                # send the response back to the waiting thread
+                response.callback(received_msg)
+
+        def on_system_error(error_msg):
+            # a system error came in while we were waiting
+            if timer is not None and timer.active():
+                # clear out the timer
+                timer.cancel()
+            self._adapter.cancel_response(pending)
+            # report an error to the waiting thread
+            response.errback(Failure(AsyncSystemError(error_msg)))
 
         def cb(_msg):
             # got a timeout or started with an error
-            # remove the listener
-            if listener in self._msg_listeners:
-                self._msg_listeners.remove(listener)
+            # stop waiting for the response
+            if pending is not None:
+                self._adapter.cancel_response(pending)
+            if on_system_error in self._response_waiters:
+                self._response_waiters.remove(on_system_error)
             # send failure to thread waiting.
             response.errback(Failure(AsyncSystemError(_msg)))
 
@@ -432,8 +476,10 @@ class ThreadedItem(BaseItem):
             if timeout > 0:
                 timer = self._reactor.callLater(timeout, cb, timeout_msg)
 
-            # add our listener to the listener ist
-            self.add_listener(listener)
+            # have the adapter route the response straight to us
+            topics = msg['TOPICS']
+            pending = self._adapter.expect_response(self.item_id, topics['TO'], topics['MSG_ID'], on_response)
+            self._response_waiters.append(on_system_error)
 
             # send the message
             self.publish(msg)
@@ -450,12 +496,13 @@ class ThreadedItem(BaseItem):
         result = defer.Deferred()
 
         def discovery_listener(msg):
-            if msg['TOPICS'].get("type", "") != 'broker' and \
+            if msg['TOPICS'].get("type", "") != 'broker' or \
                     msg['TOPICS'].get("response", "") != "get_discovery_response":
                 return False  # not the msg we're looking for
 
             if msg['CONTENTS'].get("status", "") == "ok":
                 self.discovery = msg['CONTENTS'].get('discovery', {})
+                self.discovery_version = msg['CONTENTS'].get('version', None)
                 result.callback(self.discovery)
             else:
                 result.errback(Failure(Exception(msg.get("status", "NO STATUS"))))
@@ -469,6 +516,30 @@ class ThreadedItem(BaseItem):
 
         return result
 
+    def _in_reactor_find_items(self, **query):
+        """
+        find_items called from within the reactor context
+        """
+        result = defer.Deferred()
+        request_id = next(self._find_id_generator)
+
+        def find_listener(msg):
+            if msg['TOPICS'].get("response", "") != "find_items_response" or \
+                    msg['CONTENTS'].get('id', None) != request_id:
+                return False  # not the msg we're looking for
+
+            if msg['CONTENTS'].get("status", "") == "ok":
+                result.callback(msg['CONTENTS'].get('items', []))
+            else:
+                result.errback(Failure(Exception(msg['CONTENTS'].get("status", "NO STATUS"))))
+            return True
+
+        self.add_listener(find_listener)
+        contents = dict(query)
+        contents['id'] = request_id
+        self.publish({"TOPICS": {'type': 'broker', 'request': 'find_items'}, "CONTENTS": contents})
+        return result
+
     def _sleep(self, timeout):
         """
         Support a script delay.  The delay will stop early with an error if there is a system error.
@@ -2,6 +2,7 @@ from meta_protocol import ProtocolMeta
 import inspect
 from twisted.internet import defer
 from parlay.server.broker import run_in_broker, run_in_thread
+from parlay.server.discovery_index import discovery_tree
 from parlay.protocols.utils import timeout,PrivateDeferred
 from collections import deque
 
@@ -90,6 +91,30 @@ class BaseProtocol(object):
                 'protocol_type': getattr(self, "_protocol_type_name", "UNKNOWN"),
                 'CHILDREN': [x.get_discovery() for x in self.items if not x.is_child()]}
 
+    def get_discovery_tree(self):
+        """
+        The first level of lazy discovery: just the IDs, names and types of the attached items.
+        Protocols where full discovery is expensive should override this (and get_item_discovery) so the tree is
+        cheap, the default strips down the full discovery
+        """
+        return defer.maybeDeferred(self.get_discovery).addCallback(discovery_tree)
+
+    def get_item_discovery(self, item_id):
+        """
+        The full discovery of one attached item (or a deferred), or None if it isn't one of ours
+        """
+        def find(items):
+            for item in items:
+                if getattr(item, 'item_id', None) == item_id:
+                    return item
+                found = find(getattr(item, 'children', []))
+                if found is not None:
+                    return found
+            return None
+
+        item = find(self.items)
+        return item.get_discovery() if item is not None else None
+
     def get_new_data_wait_handler(self):
         return WaitHandler(self._new_data)
 
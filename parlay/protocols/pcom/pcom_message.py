@@ -13,6 +13,7 @@ conversion to and from a JSON message.
 """
 
 from parlay.protocols.utils import message_id_generator
+from parlay.server.envelope import ParlayMessage
 
 import pcom_serial
 import logging
@@ -489,7 +490,7 @@ class PCOMMessage(object):
         """
 
         # Initialize our potential JSON message
-        msg = {'TOPICS': {}, 'CONTENTS': {}}
+        msg = ParlayMessage({}, {})
 
         msg['TOPICS']['TO'] = self._get_name_from_id(self.to)
         msg['TOPICS']['FROM'] = self._get_name_from_id(self.from_)
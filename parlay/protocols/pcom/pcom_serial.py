@@ -17,6 +17,8 @@ from twisted.internet.protocol import connectionDone
 from parlay.items.parlay_standard import ParlayStandardItem, INPUT_TYPES
 from parlay.protocols.base_protocol import BaseProtocol
 from parlay.protocols.utils import message_id_generator, MessageQueue
+from parlay.server.discovery_cache import SingleFlight
+from parlay.server.discovery_index import discovery_tree
 
 from serial.tools import list_ports
 
@@ -330,6 +332,11 @@ class PCOMSerial(BaseProtocol, LineReceiver):
         self._discovery_in_progress = False
         self._discovery_deferred = defer.Deferred()
 
+        # items found by a tree discovery whose commands and properties haven't been fetched yet
+        # dict: K->V = item ID -> ParlayStandardItem
+        self._undetailed_items = {}
+        self._details_fetches = SingleFlight()  # items whose commands and properties are being fetched
+
         self._ack_table = {seq_num: defer.Deferred() for seq_num in xrange(2**self.SEQ_BITS)}
 
         self._ack_window = SlidingACKWindow(self.WINDOW_SIZE, self.NUM_RETRIES, self)
@@ -994,7 +1001,6 @@ class PCOMSerial(BaseProtocol, LineReceiver):
             # Add child to our dictionary in the correct spot
             self.items[item_id].add_child(self.items[child_id])
 
-    @defer.inlineCallbacks
     def get_discovery(self):
         """
         Hitting the "discovery" button on the UI triggers this generator.
@@ -1002,6 +1008,41 @@ class PCOMSerial(BaseProtocol, LineReceiver):
         Run a discovery for everything connected to this protocol and return a list of of all connected:
         items, messages, and endpoint types
         """
+        return self._run_discovery(details=True)
+
+    def get_discovery_tree(self):
+        """
+        Discover the items connected to this protocol, but only their names, types and children. Each item's
+        commands and properties (dozens of round trips per item) are fetched by get_item_discovery() on demand
+        """
+        return self._run_discovery(details=False).addCallback(discovery_tree)
+
+    def get_item_discovery(self, item_id):
+        """
+        The full discovery of one item, fetching its commands and properties if a tree discovery skipped them.
+        Requests that come in while they're being fetched wait for them, instead of getting the item without them
+        """
+        if item_id in self._undetailed_items or self._details_fetches.running(item_id):
+            return self._details_fetches.call(item_id, self._fetch_item_discovery, item_id)
+        return defer.succeed(BaseProtocol.get_item_discovery(self, item_id))
+
+    @defer.inlineCallbacks
+    def _fetch_item_discovery(self, item_id):
+        parlay_item = self._undetailed_items.pop(item_id, None)
+        if parlay_item is not None:
+            try:
+                yield self._get_item_details(item_id, parlay_item)
+            except Exception:
+                self._undetailed_items[item_id] = parlay_item  # try again next time
+                raise
+        defer.returnValue(BaseProtocol.get_item_discovery(self, item_id))
+
+    @defer.inlineCallbacks
+    def _run_discovery(self, details):
+        """
+        Discovery for get_discovery() and get_discovery_tree()
+        :param details: If False, skip each item's commands and properties
+        """
 
         if not self.is_port_attached:
             if not self._port:
@@ -1040,10 +1081,11 @@ class PCOMSerial(BaseProtocol, LineReceiver):
             yield self._attached_item_d
 
         self.items = {}
+        self._undetailed_items = {}
         for subsystem_id in self._subsystem_ids:
             if subsystem_id != self.INVALID_SUBSYSTEM_ID and type(subsystem_id) is int:
                 try:
-                    yield self._get_item_discovery_info(subsystem_id)
+                    yield self._get_item_discovery_info(subsystem_id, details=details)
                 except Exception as e:
                     logger.error("Exception while discovering! Skipping subsystem: {0}\n     {1}".format(subsystem_id, e))
         yield self._create_item_hierarchy()
@@ -1058,7 +1100,7 @@ class PCOMSerial(BaseProtocol, LineReceiver):
         # to the adapter and furthermore to the broker.
         discovery_msg = BaseProtocol.get_discovery(self)
 
-        if self.discovery_file is not None and self._loaded_from_file is False:
+        if self.discovery_file is not None and self._loaded_from_file is False and details:
             self.write_discovery_info_to_file(self.discovery_file, discovery_msg)
 
         if self._discovery_deferred:
@@ -1242,7 +1284,7 @@ class PCOMSerial(BaseProtocol, LineReceiver):
         PCOM_COMMAND_MAP[reactor][GET_SUBSYSTEM_NAME] = PCOMSerial.build_command_info("", [], ["subsystem_name"])
 
     @defer.inlineCallbacks
-    def _get_item_discovery_info(self, subsystem):
+    def _get_item_discovery_info(self, subsystem, details=True):
         """
         The discovery protocol for the embedded core:
 
@@ -1268,6 +1310,8 @@ class PCOMSerial(BaseProtocol, LineReceiver):
                 GET PROPERTY TYPE
 
         :param subsystem: The subsystem we will be getting the item IDs from
+        :param details: If False, only get each item's name and type. Its commands and properties are left for
+        get_item_discovery()
         :return:
         """
 
@@ -1333,79 +1377,92 @@ class PCOMSerial(BaseProtocol, LineReceiver):
                 response = yield self.send_command(item_id, command_id=GET_ITEM_TYPE, tx_type="DIRECT")
                 item_type = int(response.data[0])
 
-                response = yield self.send_command(item_id, command_id=GET_COMMAND_IDS, tx_type="DIRECT")
-                command_ids = response.data
+                if details:
+                    yield self._get_item_details(item_id, parlay_item)
+                elif item_type != ITEM_TYPE_HIDDEN:
+                    # fetched by get_item_discovery() when someone asks for them
+                    self._undetailed_items[item_id] = parlay_item
 
-                command_dropdowns = []
-                command_subfields = []
+                if item_type != ITEM_TYPE_HIDDEN:
+                    self.items[item_id] = parlay_item
 
-                parlay_item.add_field('COMMAND', INPUT_TYPES.DROPDOWN,
-                                      dropdown_options=command_dropdowns,
-                                      dropdown_sub_fields=command_subfields)
+                logger.info("[PCOM] Finished ITEM: {0}".format(item_name))
 
-                def placeholder(failure):
-                    return failure
+        except Exception as e:
+            logger.error("[PCOM]: Could not fetch discovery info due to exception: {0}".format(e))
+            raise e
 
-                discovered_command = defer.DeferredList([])
-                discovered_command.addErrback(placeholder)
+        logger.info("[PCOM] Finished subsystem: {0}".format(subsystem))
+        defer.returnValue(discovery)
 
-                for command_id in command_ids:
-                    # Loop through the command IDs and build the Parlay Item object
-                    # for each one
+    @defer.inlineCallbacks
+    def _get_item_details(self, item_id, parlay_item):
+        """
+        The expensive part of an item's discovery: its commands and properties
+        :param item_id: the item to query
+        :param parlay_item: the ParlayStandardItem to fill in
+        """
+        response = yield self.send_command(item_id, command_id=GET_COMMAND_IDS, tx_type="DIRECT")
+        command_ids = response.data
 
-                    command_name = self.get_command_name(item_id, command_id)
-                    command_input_format = self.get_command_input_param_format(item_id, command_id)
-                    command_input_param_names = self.get_command_input_param_names(item_id, command_id)
-                    command_output_desc = self.get_command_output_parameter_desc(item_id, command_id)
+        command_dropdowns = []
+        command_subfields = []
 
-                    if not command_name or not command_input_format or not command_input_param_names or \
-                            not command_output_desc:
+        parlay_item.add_field('COMMAND', INPUT_TYPES.DROPDOWN,
+                              dropdown_options=command_dropdowns,
+                              dropdown_sub_fields=command_subfields)
 
-                        discovered_command.errback(defer.failure.Failure(Exception("")))
-                        raise Exception("[PCOM] Unable to fetch command info for item:", item_id)
+        def placeholder(failure):
+            return failure
 
-                    discovered_command = defer.gatherResults([command_name, command_input_format,
-                                                              command_input_param_names, command_output_desc])
-                    discovered_command.addCallback(PCOMSerial.command_cb, item_id=item_id, command_id=command_id,
-                                                   command_subfields=command_subfields,
-                                                   command_dropdowns=command_dropdowns,
-                                                   parlay_item=parlay_item, hidden=(command_id in DISCOVERY_MESSAGES))
+        discovered_command = defer.DeferredList([])
+        discovered_command.addErrback(placeholder)
 
-                yield discovered_command
+        for command_id in command_ids:
+            # Loop through the command IDs and build the Parlay Item object
+            # for each one
 
-                response = yield self.send_command(item_id, command_id=GET_PROPERTY_IDS, tx_type="DIRECT")
-                property_ids = response.data
+            command_name = self.get_command_name(item_id, command_id)
+            command_input_format = self.get_command_input_param_format(item_id, command_id)
+            command_input_param_names = self.get_command_input_param_names(item_id, command_id)
+            command_output_desc = self.get_command_output_parameter_desc(item_id, command_id)
 
-                discovered_property = defer.DeferredList([])
-                discovered_property.addErrback(placeholder)
+            if not command_name or not command_input_format or not command_input_param_names or \
+                    not command_output_desc:
 
-                for property_id in property_ids:
+                discovered_command.errback(defer.failure.Failure(Exception("")))
+                raise Exception("[PCOM] Unable to fetch command info for item:", item_id)
 
-                    property_name = self.get_property_name(item_id, property_id)
-                    property_type = self.get_property_type(item_id, property_id)
-                    property_desc = self.get_property_desc(item_id, property_id)
+            discovered_command = defer.gatherResults([command_name, command_input_format,
+                                                      command_input_param_names, command_output_desc])
+            discovered_command.addCallback(PCOMSerial.command_cb, item_id=item_id, command_id=command_id,
+                                           command_subfields=command_subfields,
+                                           command_dropdowns=command_dropdowns,
+                                           parlay_item=parlay_item, hidden=(command_id in DISCOVERY_MESSAGES))
 
-                    if not property_name or not property_type or not property_desc:
-                        discovered_property.errback(defer.failure.Failure(Exception("")))
-                        raise Exception("[PCOM] Unable to fetch property info for item:", item_id)
+        yield discovered_command
 
-                    discovered_property = defer.gatherResults([property_name, property_type, property_desc])
-                    discovered_property.addCallback(PCOMSerial.property_cb, item_id=item_id, property_id=property_id,
-                                                    parlay_item=parlay_item)
+        response = yield self.send_command(item_id, command_id=GET_PROPERTY_IDS, tx_type="DIRECT")
+        property_ids = response.data
 
-                yield discovered_property
+        discovered_property = defer.DeferredList([])
+        discovered_property.addErrback(placeholder)
 
-                if item_type != ITEM_TYPE_HIDDEN:
-                    self.items[item_id] = parlay_item
+        for property_id in property_ids:
 
-                logger.info("[PCOM] Finished ITEM: {0}".format(item_name))
+            property_name = self.get_property_name(item_id, property_id)
+            property_type = self.get_property_type(item_id, property_id)
+            property_desc = self.get_property_desc(item_id, property_id)
 
-        except Exception as e:
-            logger.error("[PCOM]: Could not fetch discovery info due to exception: {0}".format(e))
-            raise e
+            if not property_name or not property_type or not property_desc:
+                discovered_property.errback(defer.failure.Failure(Exception("")))
+                raise Exception("[PCOM] Unable to fetch property info for item:", item_id)
 
-        logger.info("[PCOM] Finished subsystem: {0}".format(subsystem))
-        defer.returnValue(discovery)
+            discovered_property = defer.gatherResults([property_name, property_type, property_desc])
+            discovered_property.addCallback(PCOMSerial.property_cb, item_id=item_id, property_id=property_id,
+                                            parlay_item=parlay_item)
+
+        yield discovered_property
 
     def _send_broadcast_message(self):
         """
@@ -2,15 +2,19 @@ from parlay.protocols.base_protocol import BaseProtocol
 from parlay.server.adapter import Adapter
 from autobahn.twisted.websocket import WebSocketClientFactory, WebSocketServerProtocol, WebSocketClientProtocol
 from parlay.server.broker import Broker
-import json
+from parlay.server.envelope import encode_message
+from parlay.server import message_codecs
+from parlay.server.outbound_queue import QueuedWebSocketMixin
+from parlay.server.correlation import ResponseTable
 from twisted.internet import defer
 from twisted.internet.protocol import Factory
 
 
-class WebSocketServerAdapter(WebSocketServerProtocol, Adapter):
+class WebSocketServerAdapter(QueuedWebSocketMixin, WebSocketServerProtocol, Adapter):
     """
     When a client connects over a websocket, this is the protocol that will handle the communication.
-    The messages are encoded as a JSON string
+    The messages are encoded as a JSON string, unless the client negotiated a binary codec (see
+    parlay.server.message_codecs) with the websocket subprotocol header
     """
 
     broker = Broker.get_instance()
@@ -20,50 +24,66 @@ class WebSocketServerAdapter(WebSocketServerProtocol, Adapter):
         self._discovery_response_defer = None
         self._protocol_response_defer = None
         self._open_protocol_response_defer = None
+        self._codec = message_codecs.DEFAULT_CODEC
+        self.outbound_queue = None
+        self.publish_limiter = None
 
+    def onOpen(self):
+        # hold messages in a bounded queue instead of letting autobahn buffer without limit when the client stalls
+        self.open_outbound_queue(self.broker)
+        # and keep a runaway client from publishing faster than the broker's limits
+        self.publish_limiter = self.broker.publish_limiter(str(self))
 
     def onClose(self, wasClean, code, reason):
         print "Closing:" + str(self)
         # clean up after ourselves
-        self.broker.adapters.remove(self)
+        if self in self.broker.adapters:
+            self.broker.adapters.remove(self)
+        self.broker.unsubscribe_all(self)
+        self.broker.remove_federation_peer(self)
+        if self.publish_limiter is not None:
+            self.publish_limiter.close()
 
     def send_message_as_JSON(self, msg):
-        """
-        Send a message dictionary as JSON
-        """
-        self.sendMessage(json.dumps(msg))
+        # kept for backwards compatibility. Messages are only JSON if that's the negotiated codec
+        self.send_message(msg)
 
     def onMessage(self, payload, isBinary):
-        if not isBinary:
-            msg = json.loads(payload)
-
-            # if we're waiting for discovery and its a discovery response
-            if self._discovery_response_defer is not None and \
-                    msg['TOPICS'].get('type', None) == 'get_protocol_discovery_response':
-                # discovery!
-                # get skeleton
-                discovery = msg['CONTENTS'].get('discovery', [])
-                self._discovery_response_defer.callback(discovery)
-                self._discovery_response_defer = None
-            # if we're waiting for a protocol list and its a protocol response
-            elif self._protocol_response_defer is not None and \
-                    msg['TOPICS'].get('type', None) == 'get_protocol_list_response':
-
-                protocol_list = msg['CONTENTS'].get('protocol_list', [])
-                self._protocol_response_defer.callback(protocol_list)
-                self._protocol_response_defer = None
-
-
-            # else its just a regular message, publish it.
-            else:
-                self.broker.publish(msg, self.send_message_as_JSON)
+        try:
+            msg = self._codec.decode(payload)
+        except Exception as e:
+            print "Could not decode " + self._codec.name + " message from " + str(self) + ": " + str(e)
+            return
 
+        # if we're waiting for discovery and its a discovery response
+        if self._discovery_response_defer is not None and \
+                msg['TOPICS'].get('type', None) == 'get_protocol_discovery_response':
+            # discovery!
+            # get skeleton
+            discovery = msg['CONTENTS'].get('discovery', [])
+            self._discovery_response_defer.callback(discovery)
+            self._discovery_response_defer = None
+        # if we're waiting for a protocol list and its a protocol response
+        elif self._protocol_response_defer is not None and \
+                msg['TOPICS'].get('type', None) == 'get_protocol_list_response':
+
+            protocol_list = msg['CONTENTS'].get('protocol_list', [])
+            self._protocol_response_defer.callback(protocol_list)
+            self._protocol_response_defer = None
+
+
+        # else its just a regular message, publish it (within the rate limits)
+        elif self.publish_limiter is not None:
+            self.publish_limiter.publish(msg, self.send_message)
         else:
-            print "Binary messages not supported"
+            self.broker.publish(msg, self.send_message)
 
     def onConnect(self, request):
         # let the broker know we exist!
         self.broker.adapters.append(self)
+        # pick the codec from the subprotocols the client offered. Accepting None means plain JSON
+        self._codec, subprotocol = message_codecs.negotiate(request.protocols)
+        return subprotocol
 
     def discover(self, force):
         # already in the middle of discovery
@@ -71,7 +91,7 @@ class WebSocketServerAdapter(WebSocketServerProtocol, Adapter):
             return self._discovery_response_defer
 
         self._discovery_response_defer = defer.Deferred()
-        self.send_message_as_JSON({'TOPICS': {'type': 'get_protocol_discovery'}, 'CONTENTS': {}})
+        self.send_message({'TOPICS': {'type': 'get_protocol_discovery'}, 'CONTENTS': {}})
 
         def timeout():
             if self._discovery_response_defer is not None:
@@ -79,7 +99,8 @@ class WebSocketServerAdapter(WebSocketServerProtocol, Adapter):
                 self._discovery_response_defer.callback({})
                 self._discovery_response_defer = None
 
-        self.broker.reactor.callLater(10, timeout)
+        # the broker reports us stale after this long anyway
+        self.broker.reactor.callLater(self.broker.discovery_deadline, timeout)
 
         return self._discovery_response_defer
 
@@ -93,7 +114,7 @@ class WebSocketServerAdapter(WebSocketServerProtocol, Adapter):
             return self._protocol_response_defer
 
         self._protocol_response_defer = defer.Deferred()
-        self.send_message_as_JSON({'TOPICS': {'type': 'get_protocol_list'}, 'CONTENTS': {}})
+        self.send_message({'TOPICS': {'type': 'get_protocol_list'}, 'CONTENTS': {}})
 
         def timeout():
             if self._protocol_response_defer is not None:
@@ -121,15 +142,23 @@ class WebsocketClientAdapter(Adapter, WebSocketClientProtocol):
         WebSocketClientProtocol.__init__(self)
         Adapter.__init__(self)
         self._subscribe_q = []
+        self._request_q = []  # broker requests made before we were connected
         self._listener_list = []  # no way to unsubscribe. Subscriptions last
+        self._codec = message_codecs.DEFAULT_CODEC
+        self._responses = ResponseTable(self)  # the broker is remote, so keep our own outstanding requests
 
     def onConnect(self, request):
         WebSocketClientProtocol.onConnect(self, request)
+        # the broker tells us which of our offered codecs it picked. No subprotocol means plain JSON
+        self._codec, _ = message_codecs.negotiate([request.protocol])
         self._connected.callback(True)
         # flush our subscription requests
         for _fn, topics in self._subscribe_q:
             self.subscribe(_fn, **topics)
         self._subscribe_q = []  # empty the list
+        for msg in self._request_q:
+            self.publish(msg)
+        self._request_q = []
 
     def call_on_every_message(self, listener):
         self._listener_list.append(listener)
@@ -138,11 +167,17 @@ class WebsocketClientAdapter(Adapter, WebSocketClientProtocol):
         """
         We got a message.  See who wants to process it.
         """
-        if isBinary:
-            print "WebsocketBrokerProtocol doesn't understand binary messages"
+        try:
+            msg = self._codec.decode(packet)
+        except Exception as e:
+            print "WebsocketBrokerProtocol could not decode " + self._codec.name + " message: " + str(e)
             return
 
-        msg = json.loads(packet)
+        # hand responses straight to whoever is waiting on them
+        if msg['TOPICS'].get('MSG_TYPE', None) == 'RESPONSE':
+            for fn in self._responses.match(msg):
+                fn(msg)
+
         # run it through the listeners for processing
         for fn in self._listener_list:
             fn(msg)
@@ -165,17 +200,48 @@ class WebsocketClientAdapter(Adapter, WebSocketClientProtocol):
 
             self._listener_list.append(listener)
 
+    def expect_response(self, requester, responder, msg_id, callback, timeout=0, on_timeout=None):
+        return self._responses.expect(requester, responder, msg_id, callback, timeout, on_timeout)
+
+    def cancel_response(self, pending):
+        self._responses.cancel(pending)
+
+    def set_property_cache_ttl(self, item_id, property_id, ttl):
+        # items add their properties when they're made, which can be before we've connected
+        if not self.connected:
+            self._request_q.append({"TOPICS": {"type": "broker", "request": "get_property_coalescing"},
+                                    "CONTENTS": {"ID": item_id, "PROPERTY": property_id, "ttl": ttl}})
+            return
+        Adapter.set_property_cache_ttl(self, item_id, property_id, ttl)
+
     def publish(self, msg, callback=None):
         if not self.connected:
             raise RuntimeError("Not Connected to Broker yet")
-        self.sendMessage(json.dumps(msg))
+        self.sendMessage(encode_message(msg, self._codec.name), isBinary=self._codec.is_binary)
 
 
 class WebsocketClientAdapterFactory(WebSocketClientFactory):
     def __init__(self, *args, **kwargs):
+        """
+        Takes the same arguments as WebSocketClientFactory, plus:
+        :param codecs: names of the codecs to offer the broker, most preferred first (default: JSON only)
+        :type codecs: list
+        :param compression: If True, offer permessage-deflate compression
+        :type compression: bool
+        """
+        codecs = kwargs.pop('codecs', None)
+        compression = kwargs.pop('compression', False)
+        if codecs is not None and 'protocols' not in kwargs:
+            kwargs['protocols'] = message_codecs.subprotocols_for(codecs)
+
         self.adapter = WebsocketClientAdapter()  # this is the adapter singleton
         WebSocketClientFactory.__init__(self, *args, **kwargs)
 
+        if compression:
+            from autobahn.websocket.compress import PerMessageDeflateOffer
+            self.setProtocolOptions(perMessageCompressionOffers=[PerMessageDeflateOffer()],
+                                    perMessageCompressionAccept=message_codecs.accept_permessage_deflate_response)
+
     def buildProtocol(self, addr):
         adapter = self.adapter
         adapter.factory = self
@@ -1,5 +1,8 @@
 from twisted.internet import reactor, defer
 from parlay.protocols.meta_protocol import ProtocolMeta
+from parlay.server.correlation import ResponseTable
+from parlay.server.discovery_index import discovery_tree
+from parlay.server.discovery_cache import SingleFlight, first_item_discovery, with_deadline
 import sys
 
 
@@ -19,6 +22,10 @@ class Adapter(object):
 
         self.open_protocols = []  # list of protocols that *ARE* open
 
+        # outstanding requests, for adapters that don't route responses themselves (see expect_response)
+        self._fallback_responses = ResponseTable(self)
+        self._response_subscriptions = set()  # requesters we've subscribed to the responses of
+
     def publish(self, msg, callback=None):
         """
         :param msg: Parlay message to publish
@@ -29,6 +36,19 @@ class Adapter(object):
         """
         raise NotImplementedError()
 
+    def publish_many(self, msgs, callback=None):
+        """
+        Publish a batch of messages, in order. Adapters that can hand the whole batch to the broker at once should
+        override this, the default publishes them one at a time
+        :param msgs: Parlay messages to publish
+        :type msgs: list
+        :param callback: Optional the callback function to call if the broker responds directly
+        :type callback: function
+        :return: None
+        """
+        for msg in msgs:
+            self.publish(msg, callback)
+
     def subscribe(self, fn, **kwargs):
         """
         Subscribe to messages matching the provided topic keyword/value pairs
@@ -40,6 +60,58 @@ class Adapter(object):
         """
         raise NotImplementedError()
 
+    def subscribe_batch(self, fn, **kwargs):
+        """
+        Subscribe to messages matching the provided topic keyword/value pairs, receiving them as lists
+        :param fn: the listener function to call with a list of messages meeting the criteria
+        :type fn: function
+        :param kwargs: The topics and their values to subscribe to
+        :type kwargs: dict
+        :return: None
+        """
+        raise NotImplementedError()
+
+    def expect_response(self, requester, responder, msg_id, callback, timeout=0, on_timeout=None):
+        """
+        Call callback with the responses to a request, until the final (not PROGRESS) one
+        :param requester: the ID of the item that sent the request (its FROM)
+        :param responder: the ID of the item the request was sent to (its TO)
+        :param msg_id: the request's MSG_ID
+        :param callback: function(msg) to call with each response
+        :param timeout: seconds to wait before giving up on the response (0 for the default eviction time)
+        :param on_timeout: optional function() to call if the timeout expires first
+        :return: a handle to pass to cancel_response()
+
+        Adapters that can route responses more directly should override this and cancel_response(). The default
+        subscribes once to each requester's RESPONSEs and matches them to the outstanding requests itself
+        """
+        if requester not in self._response_subscriptions:
+            self._response_subscriptions.add(requester)
+            self.subscribe(self._route_response, TO=requester, MSG_TYPE='RESPONSE')
+        return self._fallback_responses.expect(requester, responder, msg_id, callback, timeout, on_timeout)
+
+    def cancel_response(self, pending):
+        """
+        Stop waiting for the responses registered with expect_response()
+        """
+        self._fallback_responses.cancel(pending)
+
+    def _route_response(self, msg):
+        for callback in self._fallback_responses.match(msg):
+            callback(msg)
+
+    def set_property_cache_ttl(self, item_id, property_id, ttl):
+        """
+        Let the broker answer GETs of an item's property with the last value it saw, for up to ttl seconds. The
+        default asks the broker with a 'get_property_coalescing' request, for adapters whose broker is remote
+        :param item_id: the ID of the item the property belongs to
+        :param property_id: the property's ID
+        :param ttl: seconds a value may be reused for. 0 turns caching off
+        :return: None
+        """
+        self.publish({"TOPICS": {"type": "broker", "request": "get_property_coalescing"},
+                      "CONTENTS": {"ID": item_id, "PROPERTY": property_id, "ttl": ttl}})
+
     def register_item(self, item):
         """
         Register an item with the adapter
@@ -97,17 +169,58 @@ class Adapter(object):
         """
         raise NotImplementedError()
 
+    def discover_progressive(self, force, progress):
+        """
+        Like discover(), but call progress(entries) with each part of the discovery list as it arrives, e.g. once
+        per protocol. Adapters that can report parts should override this, the default reports the whole
+        discovery at once when discover() finishes
+        :type force bool
+        :rtype defer.Deferred
+        """
+        def report(discovery):
+            if isinstance(discovery, list) and len(discovery) > 0:
+                progress(discovery)
+            return discovery
+
+        return defer.maybeDeferred(self.discover, force).addCallback(report)
+
+    def discover_tree(self, force):
+        """
+        Return the first level of lazy discovery (or a deferred): the discovery list stripped down to the IDs,
+        names and types of the items. Adapters that can get that more cheaply than a full discovery should override
+        this, the default strips down discover()
+        :type force bool
+        :rtype defer.Deferred
+        """
+        def strip(discovery):
+            return discovery_tree(discovery) if isinstance(discovery, list) else []
+
+        return defer.maybeDeferred(self.discover, force).addCallback(strip)
+
+    def get_item_discovery(self, item_id):
+        """
+        Return the full discovery of one item (or a deferred), or None if the item isn't attached to this adapter
+        """
+        return None
+
 
 class PyAdapter(Adapter):
     """
     Adapter for the Python Broker and Python environment
     """
 
+    # the part of the broker's discovery_deadline a protocol has to answer discovery before we report it stale.
+    # Less than all of it, so the broker hears about it from us before it gives up on this whole adapter
+    PROTOCOL_DEADLINE_FRACTION = 0.8
+
     def __init__(self, broker):
         self._broker = broker
         self.reactor = broker.reactor
         self.open_protocols = []  # list of protocols that are currently open
         self._discovery_cache = {}  # dict: K->V = Protocol -> discovery
+        self._item_discovery_cache = {}  # dict: K->V = item ID -> discovery, for lazy discovery
+        self._item_discovery_fetches = SingleFlight()  # item discoveries being fetched from the protocols
+        self._last_discovery = {}  # dict: K->V = Protocol -> last discovery it gave, even after a forced discover
 
         super(PyAdapter, self).__init__()
 
@@ -115,9 +228,24 @@ class PyAdapter(Adapter):
         # publish the message, and if the broker needs to respond he can publish it himself
         self._broker.publish(msg, callback)
 
+    def publish_many(self, msgs, callback=None):
+        self._broker.publish_many(msgs, callback)
+
     def subscribe(self, fn, **kwargs):
         self._broker.subscribe(fn, **kwargs)
 
+    def subscribe_batch(self, fn, **kwargs):
+        self._broker.subscribe_batch(fn, **kwargs)
+
+    def expect_response(self, requester, responder, msg_id, callback, timeout=0, on_timeout=None):
+        return self._broker.expect_response(requester, responder, msg_id, callback, timeout, on_timeout)
+
+    def cancel_response(self, pending):
+        self._broker.cancel_response(pending)
+
+    def set_property_cache_ttl(self, item_id, property_id, ttl):
+        self._broker.set_property_cache_ttl(item_id, property_id, ttl)
+
     def deregister_item(self, item):
         """
         Register an item with the adapter
@@ -204,9 +332,26 @@ class PyAdapter(Adapter):
         :type force bool
         :param force True if this requested discover action wants to clear any caches and do a fresh discover.
         """
+        return self.discover_progressive(force, None)
+
+    def discover_progressive(self, force, progress):
+        """
+        Discover every open protocol, reporting each one's discovery as it arrives. A protocol that misses its
+        deadline (PROTOCOL_DEADLINE_FRACTION of the broker's discovery_deadline) is reported with its last discovery
+        (or just its name) marked STALE, so it doesn't hold up the rest. Its discovery is still cached when it does
+        arrive, for the next discover
+        """
         # clear the cache if we're told to force
         if force:
             self._discovery_cache = {}
+            self._item_discovery_cache = {}
+        # forget the protocols that have closed
+        self._last_discovery = dict((p, self._last_discovery[p]) for p in self.open_protocols
+                                    if p in self._last_discovery)
+
+        deadline = self._broker.discovery_deadline
+        if deadline is not None:
+            deadline *= self.PROTOCOL_DEADLINE_FRACTION
 
         d_list = []
         for p in self.open_protocols:
@@ -227,6 +372,7 @@ class PyAdapter(Adapter):
                 if type(disc) is dict:
                     # add it to the cache
                     self._discovery_cache[protocol] = protocol_discovery
+                    self._last_discovery[protocol] = protocol_discovery
                     return protocol_discovery
                 else:
                     sys.stderr.write("ERROR: Discovery must return a dict, instead got: " + str(disc) +
@@ -235,8 +381,60 @@ class PyAdapter(Adapter):
             d.addCallback(callback)
             d.addErrback(lambda err: callback({}, error=err))
 
+            def stale(protocol=p):
+                print "Discovery of " + str(protocol) + " missed its deadline. Marking it stale"
+                last = self._last_discovery.get(protocol, {'NAME': str(protocol), 'CHILDREN': []})
+                return dict(last, STALE=True)
+
+            d = with_deadline(d, deadline, self.reactor, stale)
+            if progress is not None:
+                def report(protocol_discovery):
+                    if protocol_discovery is not None:
+                        progress([protocol_discovery])
+                    return protocol_discovery
+                d.addCallback(report)
+
             d_list.append(d)
 
         # wait for all to be finished
         all_d = defer.gatherResults(d_list, consumeErrors=False)
         return all_d
+
+    def discover_tree(self, force):
+        """
+        Return the IDs, names and types of every item attached to this adapter (or a deferred), without the
+        details a full discovery would fetch. Uses the full discovery if we already have it
+        :type force bool
+        """
+        if force:
+            self._discovery_cache = {}
+            self._item_discovery_cache = {}
+
+        d_list = []
+        for p in self.open_protocols:
+            if p in self._discovery_cache:
+                d = defer.succeed(discovery_tree(self._discovery_cache[p]))
+            else:
+                d = defer.maybeDeferred(p.get_discovery_tree)
+            d.addErrback(lambda err: {'error': str(err)})
+            d_list.append(d)
+
+        return defer.gatherResults(d_list, consumeErrors=False)
+
+    def get_item_discovery(self, item_id):
+        """
+        Return the full discovery of one item (or a deferred), fetching it from its protocol only the first time.
+        None if no open protocol has the item
+        """
+        if item_id in self._item_discovery_cache:
+            return self._item_discovery_cache[item_id]
+        # requests that come in while it's being fetched wait for that fetch, rather than asking the protocols again
+        return self._item_discovery_fetches.call(item_id, self._fetch_item_discovery, item_id)
+
+    def _fetch_item_discovery(self, item_id):
+        def cache(discovery):
+            if discovery is not None:
+                self._item_discovery_cache[item_id] = discovery
+            return discovery
+
+        return first_item_discovery(self.open_protocols, item_id).addCallback(cache)
@@ -5,16 +5,36 @@ from twisted.internet import defer
 from parlay.server.adapter import PyAdapter
 from parlay.server.reactor import reactor
 from parlay.server.http_server import CacheControlledSite
+from parlay.server.subscriptions import Subscription, SubscriptionIndex, BatchListener, compile_topics
+from parlay.server.envelope import wrap_message
+from parlay.server import message_codecs
+from parlay.server.outbound_queue import OutboundQueue
+from parlay.server.dispatch import DispatchScheduler, message_priority
+from parlay.server.correlation import ResponseTable
+from parlay.server.flight_recorder import FlightRecorder
+from parlay.server.listener_profile import ListenerProfiler
+from parlay.server.circuit_breaker import ListenerCircuitBreaker
+from parlay.server.retained import RetainedValues
+from parlay.server.property_gets import PropertyGetCoalescer
+from parlay.server.throttle import RateThrottle, ThrottledListener
+from parlay.server.rate_limit import PublishLimits
+from parlay.server.traffic_log import TrafficRecorder
+from parlay.server.traffic_stats import TrafficStats
+from parlay.server.discovery_cache import DiscoveryCache, first_item_discovery, with_deadline
+from parlay.server.discovery_index import discovery_tree
+from parlay.server import cluster
+from parlay.server.federation import Federation, FederationClientFactory, FEDERATION_TYPE
 from parlay.protocols.meta_protocol import ProtocolMeta
 from adapter import Adapter
 from twisted.python.log import addObserver
 
-from autobahn.twisted.websocket import WebSocketServerFactory, listenWS
+from autobahn.twisted.websocket import WebSocketServerFactory, listenWS, connectWS
 from twisted.web import static
 import os
 import json
 import signal
 import functools
+import weakref
 import parlay
 import itertools
 import logging
@@ -36,6 +56,9 @@ class Broker(object):
     _started = defer.Deferred()
     _stopped = defer.Deferred()
 
+    # seconds between flight recorder dumps when errors are logged
+    ERROR_DUMP_INTERVAL = 60
+
     # discovery info for the broker
     _discovery = {'TEMPLATE': 'Broker', 'NAME': 'Broker', "ID": "__Broker__", "VERSION": BROKER_VERSION,
                   "interfaces": ['broker'],
@@ -69,8 +92,68 @@ class Broker(object):
         # the currently connected protocols
         self._protocols = []
 
+        # the ports start() listens on. The websocket port is also part of our default federation id
+        self.http_port = 8080
+        self.https_port = 8081
+        self.websocket_port = 8085
+        self.secure_websocket_port = 8086
+
+        # accept permessage-deflate on the websocket servers
+        self.websocket_compression = False
+
+        # size and slow consumer policy of each websocket and line adapter's outbound queue
+        self.outbound_queue_size = OutboundQueue.DEFAULT_MAX_SIZE
+        self.outbound_queue_policy = OutboundQueue.DEFAULT_POLICY
+
         # The listeners that will be called whenever a message is received
         self._listeners = {}  # See Listener lookup document for more info
+        # compiled index of every subscription in self._listeners that has listeners. This is what _publish uses
+        self._subscription_index = SubscriptionIndex()
+        # reverse index so an owner's subscriptions can be torn down without walking the whole trie
+        self._owner_subscriptions = {}  # dict: K->V = owner -> set of Subscriptions it has listeners on
+
+        # calls listeners in priority order, yielding to the reactor when a burst runs over its time budget
+        self._dispatcher = DispatchScheduler(self)
+        # outstanding requests, so their responses go straight to whoever is waiting on them
+        self._responses = ResponseTable(self)
+        # the last published messages, for debugging. Much cheaper than logging every message
+        self._flight_recorder = FlightRecorder()
+        # run() turns this on, so logged errors dump the flight recorder (see _error_logged)
+        self._dump_on_error = False
+        self._last_error_dump = None
+        # writes every published message to disk, if turned on with start_traffic_recorder()
+        self._traffic_recorder = None
+        # the last stream sample, property value and event of every item, for subscribers that want them replayed
+        self._retained = RetainedValues()
+        # identical PROPERTY GETs share one request to the item, and items can have property values cached
+        self._property_gets = PropertyGetCoalescer(self)
+        # delivers to subscribers with a maximum rate, one timer per rate
+        self._throttle = RateThrottle(self)
+        # message, byte and fan-out counters per publisher and destination, to find whoever is flooding the broker
+        self._traffic_stats = TrafficStats()
+        # times every listener call while profiling is turned on with profile_listeners()
+        self._listener_profiler = ListenerProfiler()
+        # token bucket limits on what each connection (and each FROM) may publish. Off until configured
+        self._publish_limits = PublishLimits(self)
+        # quarantines listeners that fail over and over, instead of calling them with every message
+        self._listener_breaker = ListenerCircuitBreaker(self)
+        self._dispatcher.breaker = self._listener_breaker
+
+        # number of processes to spread the broker across, and our link to the others (see parlay.server.cluster)
+        self.cluster_workers = 1
+        self._cluster = None
+
+        # concurrent get_discovery requests share one discovery, and changes are broadcast as patches
+        self._discovery_cache = DiscoveryCache(self._gather_discovery, on_change=self._broadcast_discovery_change)
+        # the same for the first level of lazy discovery, just the tree of item IDs, names and types
+        self._discovery_tree_cache = DiscoveryCache(self._gather_discovery_tree)
+        # seconds an adapter has to answer discovery before it's reported with its last discovery marked STALE
+        self.discovery_deadline = 10
+        self._adapter_discovery = weakref.WeakKeyDictionary()  # dict: K->V = adapter -> its last discovery
+
+        # links to brokers on other hosts (see parlay.server.federation). Created by get_federation()
+        self.federate_urls = []
+        self._federation = None
 
         # the broker is a singleton
         Broker.instance = self
@@ -90,10 +173,43 @@ class Broker(object):
 
     @staticmethod
     def start(mode=Modes.DEVELOPMENT, ssl_only=False, open_browser=True, http_port=8080, https_port=8081,
-              websocket_port=8085, secure_websocket_port=8086, ui_path=None, log_level=logging.DEBUG, ui_caching=False):
+              websocket_port=8085, secure_websocket_port=8086, ui_path=None, log_level=logging.DEBUG, ui_caching=False,
+              websocket_compression=False, outbound_queue_size=OutboundQueue.DEFAULT_MAX_SIZE,
+              outbound_queue_policy=OutboundQueue.DEFAULT_POLICY, dispatch_budget=DispatchScheduler.DEFAULT_BUDGET,
+              flight_recorder_size=FlightRecorder.DEFAULT_SIZE, flight_recorder_sample_every=1, traffic_log=None,
+              cluster_workers=1, federate=None, retained_size=RetainedValues.DEFAULT_MAX_SIZE,
+              retained_ttl=RetainedValues.DEFAULT_TTL, connection_rate_limit=None, connection_burst=None,
+              from_rate_limit=None, from_burst=None, rate_limit_policy=PublishLimits.DEFAULT_POLICY,
+              listener_max_failures=ListenerCircuitBreaker.DEFAULT_MAX_FAILURES):
         """
         Run the default Broker implementation.
         This call will not return.
+
+        :param websocket_compression: If True, accept permessage-deflate from websocket clients that offer it
+        :param outbound_queue_size: most messages to hold for a connection that can't keep up
+        :param outbound_queue_policy: what to do when a connection's queue is full. One of SlowConsumerPolicy
+        (drop_oldest, latest_value, disconnect)
+        :param dispatch_budget: most seconds to spend calling listeners before yielding back to the reactor
+        :param flight_recorder_size: how many of the last published messages to remember for debugging
+        :param flight_recorder_sample_every: only remember one of every N messages (0 turns the recorder off)
+        :param traffic_log: path of a traffic log to record every published message to, for replay later
+        (see parlay.server.replay)
+        :param cluster_workers: number of processes to spread websocket connections across (see
+        parlay.server.cluster). 1 runs everything in this process
+        :param federate: websocket urls of brokers on other hosts to federate with, e.g. ['ws://rack2:8085']
+        (see parlay.server.federation)
+        :param retained_size: most stream, property and event values to retain for replay to new subscribers (0
+        turns retaining off)
+        :param retained_ttl: seconds a retained value is good for
+        :param connection_rate_limit: most messages a second each websocket or serial connection may publish. None
+        for no limit (see parlay.server.rate_limit)
+        :param connection_burst: most messages a connection may publish at once. Defaults to a second's worth
+        :param from_rate_limit: most messages a second each FROM may publish, across every connection
+        :param from_burst: most messages a FROM may publish at once. Defaults to a second's worth
+        :param rate_limit_policy: what to do with messages over the limit. One of RateLimitPolicy (drop, delay,
+        reject)
+        :param listener_max_failures: consecutive failures before a listener is taken out of its subscriptions (see
+        parlay.server.circuit_breaker). 0 never takes them out
         """
         broker = Broker.get_instance()
         # do some construction stuff here
@@ -101,6 +217,17 @@ class Broker(object):
         broker.http_port = http_port
         broker.https_port = https_port
         broker.secure_websocket_port = secure_websocket_port
+        broker.configure(websocket_compression=websocket_compression, outbound_queue_size=outbound_queue_size,
+                         outbound_queue_policy=outbound_queue_policy, dispatch_budget=dispatch_budget,
+                         flight_recorder_size=flight_recorder_size,
+                         flight_recorder_sample_every=flight_recorder_sample_every, retained_size=retained_size,
+                         retained_ttl=retained_ttl, connection_rate_limit=connection_rate_limit,
+                         connection_burst=connection_burst, from_rate_limit=from_rate_limit, from_burst=from_burst,
+                         rate_limit_policy=rate_limit_policy, listener_max_failures=listener_max_failures)
+        if traffic_log is not None:
+            broker.start_traffic_recorder(traffic_log)
+        broker.cluster_workers = cluster_workers
+        broker.federate_urls = list(federate) if federate is not None else []
         broker._run_mode = Broker.Modes.PRODUCTION  # safest default
 
         if log_level is not None:
@@ -113,6 +240,48 @@ class Broker(object):
         return broker.run(mode=mode, ssl_only=ssl_only, open_browser=open_browser,
                           ui_path=ui_path, ui_caching=ui_caching)
 
+    def configure(self, websocket_compression=None, outbound_queue_size=None, outbound_queue_policy=None,
+                  dispatch_budget=None, flight_recorder_size=None, flight_recorder_sample_every=None,
+                  retained_size=None, retained_ttl=None, connection_rate_limit=None, connection_burst=None,
+                  from_rate_limit=None, from_burst=None, rate_limit_policy=None, listener_max_failures=None,
+                  discovery_deadline=None):
+        """
+        Change the broker's settings. The parameters are the same as start()'s, None leaves that setting as it is
+        :param discovery_deadline: seconds an adapter has to answer discovery before it's reported STALE
+        """
+        if websocket_compression is not None:
+            self.websocket_compression = websocket_compression
+        if outbound_queue_size is not None:
+            self.outbound_queue_size = outbound_queue_size
+        if outbound_queue_policy is not None:
+            self.outbound_queue_policy = outbound_queue_policy
+        if dispatch_budget is not None:
+            self._dispatcher.budget = dispatch_budget
+        self._flight_recorder.configure(size=flight_recorder_size, sample_every=flight_recorder_sample_every)
+        self._retained.configure(max_size=retained_size, ttl=retained_ttl)
+        self._publish_limits.configure(connection_rate=connection_rate_limit, connection_burst=connection_burst,
+                                       from_rate=from_rate_limit, from_burst=from_burst, policy=rate_limit_policy)
+        if listener_max_failures is not None:
+            self._listener_breaker.max_failures = listener_max_failures
+        if discovery_deadline is not None:
+            self.discovery_deadline = discovery_deadline
+
+    def get_config(self):
+        """
+        :return: dict of the broker's settings, the keyword arguments of configure(). Cluster workers are configured
+        with this so they behave like the primary
+        """
+        limits = self._publish_limits
+        return {'websocket_compression': self.websocket_compression, 'outbound_queue_size': self.outbound_queue_size,
+                'outbound_queue_policy': self.outbound_queue_policy, 'dispatch_budget': self._dispatcher.budget,
+                'flight_recorder_size': self._flight_recorder.size,
+                'flight_recorder_sample_every': self._flight_recorder.sample_every,
+                'retained_size': self._retained.max_size, 'retained_ttl': self._retained.ttl,
+                'connection_rate_limit': limits.connection_rate, 'connection_burst': limits.connection_burst,
+                'from_rate_limit': limits.from_rate, 'from_burst': limits.from_burst,
+                'rate_limit_policy': limits.policy, 'listener_max_failures': self._listener_breaker.max_failures,
+                'discovery_deadline': self.discovery_deadline}
+
     @staticmethod
     def start_for_test():
         broker = Broker.get_instance()
@@ -133,11 +302,19 @@ class Broker(object):
         :param write_method : the protocol's method to callback if the broker needs to send a response
         :type msg : dict
         """
-        self._logger.debug(msg)
+        self._flight_recorder.record(msg)
+        if self._traffic_recorder is not None:
+            self._traffic_recorder.record(msg)
 
         if write_method is None:
             write_method = lambda _: _
 
+        self._route(msg, write_method)
+
+    def _route(self, msg, write_method):
+        """
+        Route a message to the broker, (un)subscribe handlers or the listeners, depending on its type
+        """
         topic_type = msg['TOPICS'].get('type', None)
         # handle broker and subscribe messages special
         if topic_type == 'broker':
@@ -146,47 +323,155 @@ class Broker(object):
             self.handle_subscribe_message(msg, write_method)
         elif topic_type == 'unsubscribe':
             self.handle_unsubscribe_message(msg, write_method)
+        elif topic_type == FEDERATION_TYPE:
+            self.get_federation().handle_message(msg, write_method)
         # generic publish for all other messages
         else:
             self._publish(msg)
 
-    def _publish(self, msg, root_list=None):
+    def publish_many(self, msgs, write_method=None):
         """
-        Call all of the listeners that match msg
+        Publish a batch of messages to the Parlay system, in order.
+        Listeners subscribed with subscribe_batch() get all of the batch's messages they match in one call, so
+        adapters that receive bursts (a stream buffer being drained, a replayed log) only pay the per-call
+        overhead once per batch.
+        :param msgs : The messages to publish
+        :param write_method : the protocol's method to callback if the broker needs to send a response
+        :type msgs : list
+        """
+        if write_method is None:
+            write_method = lambda _: _
+
+        batch = []
+        traffic_recorder = self._traffic_recorder
+        for msg in msgs:
+            self._flight_recorder.record(msg)
+            if traffic_recorder is not None:
+                traffic_recorder.record(msg)
+            if msg['TOPICS'].get('type', None) in ('broker', 'subscribe', 'unsubscribe', FEDERATION_TYPE):
+                # deliver everything before it first so (un)subscribes take effect at the right point
+                self._publish_batch(batch)
+                batch = []
+                self._route(msg, write_method)
+            else:
+                batch.append(msg)
 
-        Time Complexity is O(2*n) * O(k)
-        where:  n = the number of levels of the listener list
-                k = the number of keys in the msg
+        self._publish_batch(batch)
+
+    def _publish_batch(self, msgs):
         """
-        if root_list is None:
-            root_list = self._listeners
+        Call all of the listeners that match each message in msgs. Plain listeners are called once per message,
+        batch listeners are called once after that with every message they matched, in order.
+        """
+        if len(msgs) == 0:
+            return
 
-        # call any functions in the None key
-        for func, owner in root_list.get(None, []):
-            try:
-                func(msg)
-            except Exception as e:
-                print "UNCAUGHT EXCEPTION IN PROTOCOL"
-                print e
-
-        TOPICS = msg['TOPICS']
-        # for each key in the listeners list
-        for k in TOPICS.keys():
-            # If the key exists and  values match, then call any functions or look further
-            #   root_list[k] is the value, which is a key to another dictionary
-            #   The None key in that dictionary will contain a list of funcs to call
-            #   Any other key will lead to yet another dictionary of keys and values
-            if k in root_list and TOPICS[k] in root_list[k]:
-                # recurse
-                self._publish(msg, root_list[k][TOPICS[k]])
-
-    def subscribe(self, func, _owner_=None, **kwargs):
+        batches = {}  # dict: K->V = batch listener -> list of messages
+        batch_order = []  # the order batch listeners first matched in, so delivery is deterministic
+        batch_priority = {}  # dict: K->V = batch listener -> most urgent dispatch lane of its messages
+        match = self._subscription_index.match
+        schedule = self._dispatcher.schedule
+        traffic_stats = self._traffic_stats
+        for msg in msgs:
+            msg = wrap_message(msg)
+            msg_type = msg['TOPICS'].get('MSG_TYPE', None)
+            if msg_type == 'PROPERTY' and not self._property_gets.admit(msg):
+                traffic_stats.record(msg, 0)
+                continue
+            self._retained.observe(msg)
+            priority = message_priority(msg)
+            funcs = []
+            batched = 0
+            if msg_type == 'RESPONSE':
+                funcs.extend(self._responses.match(msg))
+            for sub in match(msg['TOPICS']):
+                for func, owner in sub.listeners:
+                    if isinstance(func, BatchListener):
+                        batched += 1
+                        pending = batches.get(func, None)
+                        if pending is None:
+                            pending = batches[func] = []
+                            batch_order.append(func)
+                            batch_priority[func] = priority
+                        pending.append(msg)
+                        batch_priority[func] = min(priority, batch_priority[func])
+                    else:
+                        funcs.append(func)
+            traffic_stats.record(msg, len(funcs) + batched)
+            schedule(priority, msg, funcs)
+            if self._cluster is not None:
+                self._cluster.forward(msg)
+            if self._federation is not None:
+                self._federation.forward(msg)
+            if msg_type == 'RESPONSE':
+                self._property_gets.response_published(msg)
+
+        for func in batch_order:
+            schedule(batch_priority[func], batches[func], [func.func])
+
+    def _publish(self, msg, forward=True):
+        """
+        Call all of the listeners that match msg, and forward it to the other processes in the cluster that have
+        listeners for it (unless forward is False, because it came from one of them)
+
+        Time Complexity is O(k) + O(m)
+        where:  k = the number of keys in the msg
+                m = the number of candidate subscriptions filed under the msg's key/value pairs
+        """
+        # wrap it so every subscriber that sends it out shares one encoding
+        msg = wrap_message(msg)
+        msg_type = msg['TOPICS'].get('MSG_TYPE', None)
+        if msg_type == 'PROPERTY' and not self._property_gets.admit(msg):
+            self._traffic_stats.record(msg, 0)
+            return  # answered from the property cache, or waiting on an identical GET
+        self._retained.observe(msg)
+        funcs = [func for sub in self._subscription_index.match(msg['TOPICS']) for func, owner in sub.listeners]
+        if msg_type == 'RESPONSE':
+            # whoever is waiting on this response hears about it before the general subscribers
+            funcs[0:0] = self._responses.match(msg)
+        self._traffic_stats.record(msg, len(funcs))
+        # the dispatcher calls them now, unless it's over its time budget or already in the middle of calling
+        # listeners, in which case they're called in priority order as soon as it gets to them
+        self._dispatcher.schedule(message_priority(msg), msg, funcs)
+        if forward and self._cluster is not None:
+            self._cluster.forward(msg)
+        # and to the brokers on other hosts that have subscribers for it
+        if self._federation is not None:
+            self._federation.forward(msg)
+        if msg_type == 'RESPONSE':
+            # answer the PROPERTY GETs that were waiting on this one
+            self._property_gets.response_published(msg)
+
+    def start_traffic_recorder(self, path, codec='json'):
+        """
+        Start writing every published message to a traffic log. Writing happens on a background thread
+        :param path: the traffic log file. Appends if it already exists
+        :param codec: the codec to store messages with
+        """
+        self.stop_traffic_recorder()
+        self._traffic_recorder = TrafficRecorder(path, codec=codec)
+
+    def stop_traffic_recorder(self):
+        """
+        Stop recording traffic, after writing everything that has been recorded so far
+        """
+        if self._traffic_recorder is not None:
+            recorder, self._traffic_recorder = self._traffic_recorder, None
+            recorder.close()
+
+    def subscribe(self, func, _owner_=None, _retained_=False, _max_rate_hz_=None, _coalesce_='latest', **kwargs):
         """
         Register a listener. The kwargs is a dictionary of args that **all** must be true
         to call this listener. You may register the same function multiple times with different
         kwargs, and it may be called multiple times for each message.
         @param func: The function to run
-        @param kwargs: The key/value pairs to listen for
+        @param _retained_: True to call func right away with the retained stream, property and event values that
+        match (see parlay.server.retained)
+        @param _max_rate_hz_: most stream samples and property values per second to call func with, per stream or
+        property. None for all of them (see parlay.server.throttle)
+        @param _coalesce_: how to combine the values held back by _max_rate_hz_: 'latest', 'mean' or 'minmax'
+        @param kwargs: The key/value pairs to listen for. A value can also be a $prefix, $in or $range predicate
+        (see parlay.server.subscriptions)
         """
         # only bound methods (or explicit owners) are allowed to subscribe so they are easier to clean up later
         if _owner_ is None:
@@ -198,6 +483,19 @@ class Broker(object):
         else:
             owner = _owner_
 
+        kwargs = compile_topics(kwargs)
+        listener = func
+        if _max_rate_hz_ is not None:
+            listener = self._throttle.listener(func, _max_rate_hz_, _coalesce_)
+        self._add_listener(listener, owner, kwargs)
+        if _retained_:
+            self._retained.replay(kwargs, func)
+
+    def _add_listener(self, listener, owner, kwargs):
+        """
+        File a listener under the subscription for kwargs, making the subscription if it's new
+        :param kwargs: compiled topics (see compile_topics)
+        """
         # sort so we always get the same order
         keys = sorted(kwargs.keys())
         root_list = self._listeners
@@ -211,16 +509,96 @@ class Broker(object):
             # go down a level
             root_list = root_list[k][v]
 
-        # now that we're done, we have the leaf in root_list. Append it to the None list
-        listeners = root_list.get(None, set())
-        listeners.add((func, owner))
-        root_list[None] = listeners
+        # now that we're done, we have the leaf in root_list. Add the listener to the subscription in the None key
+        sub = root_list.get(None, None)
+        if sub is None:
+            sub = Subscription(dict(kwargs))
+            root_list[None] = sub
+
+        was_empty = len(sub) == 0
+        if sub.add(listener, owner) and was_empty:
+            self._subscription_index.add(sub)
+            if self._cluster is not None:
+                self._cluster.interest_added(sub.topics)
+            if self._federation is not None:
+                self._federation.interest_added(sub.topics)
+        self._owner_subscriptions.setdefault(owner, set()).add(sub)
+
+    def subscribe_batch(self, func, _owner_=None, _retained_=False, _max_rate_hz_=None, _coalesce_='latest',
+                        **kwargs):
+        """
+        Register a listener that takes a list of messages instead of a single message. It gets every message of a
+        publish_many() batch it matches in a single call, and a list of one for a plain publish()
+        @param func: The function to run. Called as func(msgs)
+        @param kwargs: The key/value pairs to listen for
+        """
+        if _owner_ is None:
+            if hasattr(func, 'im_self') and func.im_self is not None:
+                _owner_ = func.im_self
+            else:
+                raise ValueError("Function {} passed to subscribe_batch() ".format(func.__name__) +
+                                 "must be a bound method of an object")
+
+        self.subscribe(BatchListener(func), _owner_=_owner_, _retained_=_retained_, _max_rate_hz_=_max_rate_hz_,
+                       _coalesce_=_coalesce_, **kwargs)
+
+    def expect_response(self, requester, responder, msg_id, callback, timeout=0, on_timeout=None):
+        """
+        Route the responses to a COMMAND or PROPERTY request straight to callback, instead of making it look at
+        every message sent to the requester. The callback is called with each response until the final (not
+        PROGRESS) one.
+        :param requester: the ID of the item that sent the request (its FROM)
+        :param responder: the ID of the item the request was sent to (its TO)
+        :param msg_id: the request's MSG_ID
+        :param callback: function(msg) to call with each response
+        :param timeout: seconds to wait before giving up on the response (0 for the default eviction time)
+        :param on_timeout: optional function() to call if the timeout expires first
+        :return: a handle to pass to cancel_response()
+        """
+        return self._responses.expect(requester, responder, msg_id, callback, timeout, on_timeout)
+
+    def set_property_cache_ttl(self, item_id, property_id, ttl):
+        """
+        Have the broker answer GETs of an item's property from the last response, until it's ttl seconds old
+        :param ttl: seconds the property's value is good for. None or 0 to stop caching it
+        """
+        self._property_gets.set_cache_ttl(item_id, property_id, ttl)
+
+    def profile_listeners(self, enabled=True, budget=None):
+        """
+        Turn timing of every listener call on or off (see parlay.server.listener_profile). The times gathered so far
+        are kept until reset
+        :param enabled: True to time listener calls, False to stop
+        :param budget: seconds a listener call may take before it's flagged as slow. None to leave it as is
+        """
+        if budget is not None:
+            self._listener_profiler.budget = budget
+        self._dispatcher.profiler = self._listener_profiler if enabled else None
+
+    def publish_limiter(self, name):
+        """
+        Get a rate limiter for a new connection. Adapters that receive messages from outside the broker publish them
+        with its publish() instead of calling publish() directly
+        :param name: name of the connection, used when reporting
+        :rtype: parlay.server.rate_limit.ConnectionLimiter
+        """
+        return self._publish_limits.connection(name)
+
+    def cancel_response(self, pending):
+        """
+        Stop routing responses for a request registered with expect_response()
+        """
+        self._responses.cancel(pending)
 
     def unsubscribe(self, owner, TOPICS):
         """
         Unsubscribe owner from all subscriptions that match TOPICS. Only EXACT matches will be unsubscribed
         """
-        
+        try:
+            TOPICS = compile_topics(TOPICS)
+        except ValueError:
+            return  # not a subscription anyone could have made
+
         keys = sorted(TOPICS.keys())
         root_list = self._listeners
 
@@ -236,14 +614,106 @@ class Broker(object):
             root_list = root_list[k][v]
 
         # now that we're done, that means that we are subscribed and we have the leaf in root_list
-        listeners = root_list.get(None, set())
-        
+        sub = root_list.get(None, None)
+        if sub is None:
+            return  # not subscribed
+
         # filter out any subscriptions by 'owner'
-        root_list[None] = set([x for x in listeners if x[1] != owner])
+        owned = self._owner_subscriptions.get(owner, None)
+        if owned is not None:
+            owned.discard(sub)
+            if len(owned) == 0:
+                del self._owner_subscriptions[owner]
+        self._remove_owner_from_subscription(sub, owner)
+
+    def _remove_owner_from_subscription(self, sub, owner):
+        """
+        Remove owner's listeners from a subscription. If that empties it, take the subscription out of the index
+        and prune its branch of the trie
+        """
+        for func, o in sub.listeners:
+            if o == owner and isinstance(func, ThrottledListener):
+                func.cancel()  # don't deliver what it's holding
+        if sub.remove_owner(owner) and len(sub) == 0:
+            self._remove_subscription(sub)
+
+    def _remove_subscription(self, sub):
+        """
+        Take a subscription that has no listeners left out of the index and the trie
+        """
+        self._subscription_index.remove(sub)
+        self._prune_trie(sub)
+        if self._cluster is not None:
+            self._cluster.interest_removed(sub.topics)
+        if self._federation is not None:
+            self._federation.interest_removed(sub.topics)
+
+    def _quarantine_listener(self, func):
+        """
+        Take a listener out of every subscription it's on (see parlay.server.circuit_breaker)
+        :return: list of (topics, listener, owner) it was subscribed with, to put it back later. The listener is
+        what was subscribed, func or a BatchListener or ThrottledListener wrapping it
+        """
+        entries = []
+        for sub in list(self._subscription_index.subscriptions()):
+            removed = sub.remove_listener(func)
+            for listener, owner in removed:
+                entries.append((sub.topics, listener, owner))
+                if not any(o == owner for _, o in sub.listeners):
+                    owned = self._owner_subscriptions.get(owner, None)
+                    if owned is not None:
+                        owned.discard(sub)
+                        if len(owned) == 0:
+                            del self._owner_subscriptions[owner]
+            if len(removed) > 0 and len(sub) == 0:
+                self._remove_subscription(sub)
+        return entries
+
+    def release_quarantined_listeners(self, ids=None):
+        """
+        Put quarantined listeners back into the subscriptions they were taken out of
+        :param ids: ids of the quarantined listeners to put back (see get_quarantined_listeners), None for all
+        :return: the number of listeners put back
+        """
+        released = self._listener_breaker.release(ids)
+        for quarantined in released:
+            for topics, listener, owner in quarantined.entries:
+                self._add_listener(listener, owner, topics)
+        return len(released)
+
+    def _prune_trie(self, sub):
+        """
+        Remove an empty subscription's leaf from the trie, along with every node above it that no longer leads to
+        any subscriptions.
+
+        Time Complexity is O(n) where n = the number of keys in the subscription
+        """
+        # walk down to the leaf, remembering the path so we can walk back up
+        path = []
+        root_list = self._listeners
+        for k in sorted(sub.topics.keys()):
+            v = sub.topics[k]
+            if k not in root_list or v not in root_list[k]:
+                return  # already gone
+            path.append((root_list, k, v))
+            root_list = root_list[k][v]
+
+        if root_list.get(None, None) is not sub:
+            return  # the leaf was already replaced by a new subscription
+        del root_list[None]
+
+        # walk back up, deleting nodes until we find one that still leads somewhere
+        for parent, k, v in reversed(path):
+            if len(parent[k][v]) > 0:
+                break
+            del parent[k][v]
+            if len(parent[k]) == 0:
+                del parent[k]
 
     def _clean_trie(self, root_list=None):
         """
-        Internal method called to clean out the trie from subscription keys that no longer have any subscriptions
+        Internal method called to clean out the trie from subscription keys that no longer have any subscriptions.
+        Unsubscribing prunes the trie as it goes, so this is only needed as a full sweep.
         :param root_list : sub-trie to clean, or None for root of trie
         :result : number of subscriptions in the sub-trie
         """
@@ -269,25 +739,21 @@ class Broker(object):
                 del root_list[k]
 
         # add subscriptions ar our level
-        total_sub += len(root_list.get(None, set()))
+        total_sub += len(root_list.get(None, ()))
 
         return total_sub
 
-    def unsubscribe_all(self, owner, root_list=None):
+    def unsubscribe_all(self, owner):
         """
         Unsubscribe all function in our list that have a n owner that matches 'owner'
-        """
-        if root_list is None:
-            root_list = self._listeners
-
-        if None in root_list:   # don't bother checking if there's no listeners here
-            root_list[None] = set([x for x in root_list[None] if x[1] != owner])
 
-        for k in root_list:
-            if k is not None:  # special key for listener list
-                for v in root_list[k]:
-                    # call it again
-                    self.unsubscribe_all(owner, root_list[k][v])
+        Time Complexity is O(s * n)
+        where:  s = the number of subscriptions 'owner' has listeners on
+                n = the number of keys in each subscription
+        """
+        for sub in self._owner_subscriptions.pop(owner, ()):
+            self._remove_owner_from_subscription(sub, owner)
+        self._listener_breaker.forget_owner(owner)
 
     @classmethod
     def call_on_start(cls, func):
@@ -464,35 +930,213 @@ class Broker(object):
         elif request == "get_discovery":
             # if we're forcing a refresh, clear our whole cache
             force = msg['CONTENTS'].get('force', False)
-
-            all_d = defer.DeferredList([defer.maybeDeferred(x.discover, force=force) for x in self.adapters],
-                                       fireOnOneErrback=True, consumeErrors=False)
-
-            def discovery_done(adapters_discovery):
-                discovery = []
-                for x in adapters_discovery:
-                    if x[0] and len(x[1]) > 0: # sanity checks
-                        discovery.extend(x[1])
-
-                # append the discovery for the broker
-                discovery.append(Broker._discovery)
-
+            # 'tree' for just the item IDs, names and types. Details come from get_item_discovery
+            level = msg['CONTENTS'].get('level', 'full')
+            cache = self._discovery_tree_cache if level == 'tree' else self._discovery_cache
+            # 'progressive' to get a get_discovery_progress message with each adapter's (or protocol's) discovery
+            # as it arrives, before the whole discovery in the response
+            progress = None
+            if msg['CONTENTS'].get('progressive', False):
+                def progress(entries):
+                    message_callback({'TOPICS': dict(reply['TOPICS'], response='get_discovery_progress'),
+                                      'CONTENTS': {'status': 'ok', 'discovery': entries, 'level': level}})
+
+            def discovery_done(discovery):
                 reply['CONTENTS']['status'] = 'ok'
                 reply['CONTENTS']['discovery'] = discovery
+                reply['CONTENTS']['version'] = cache.version
+                reply['CONTENTS']['level'] = level
                 message_callback(reply)
 
-                # announce it to the world
-                reply['TOPICS']['type'] = 'DISCOVERY_BROADCAST'
-                self.publish(reply, lambda _: _)
-
             def discovery_error(*adapters_discovery):
                 #only show the error messages
                 reply['CONTENTS']['status'] = str(adapters_discovery)
                 reply['CONTENTS']['discovery'] = []
                 message_callback(reply)
 
-            all_d.addCallback(discovery_done)
-            all_d.addErrback(discovery_error)
+            cache.get(force, progress).addCallbacks(discovery_done, discovery_error)
+
+        elif request == "get_item_discovery":
+            # the full discovery of one item, for lazy discovery
+            item_id = msg['CONTENTS'].get('ID', None)
+            reply['CONTENTS']['ID'] = item_id
+
+            def item_done(item):
+                if item is None:
+                    reply['CONTENTS']['status'] = "No item with ID " + str(item_id)
+                else:
+                    reply['CONTENTS']['status'] = 'ok'
+                    reply['CONTENTS']['item'] = item
+                message_callback(reply)
+
+            def item_error(failure):
+                reply['CONTENTS']['status'] = str(failure.value)
+                message_callback(reply)
+
+            self.get_item_discovery(item_id).addCallbacks(item_done, item_error)
+
+        elif request == "get_discovery_changes":
+            # the patch from the client's version to ours, or the whole discovery if we don't go back that far
+            version = msg['CONTENTS'].get('version', 0)
+            patch = self._discovery_cache.changes_since(version)
+            reply['CONTENTS']['version'] = self._discovery_cache.version
+            if patch is None:
+                reply['CONTENTS']['discovery'] = self._discovery_cache.discovery
+            else:
+                reply['CONTENTS']['base_version'] = version
+                reply['CONTENTS']['patch'] = patch
+            reply['CONTENTS']['status'] = 'ok'
+            message_callback(reply)
+
+        elif request == "find_items":
+            # just the items that match, from the indexes over the latest discovery
+            contents = msg['CONTENTS']
+            if 'id' in contents:
+                reply['CONTENTS']['id'] = contents['id']  # so the requester can match up concurrent queries
+
+            def find(_=None):
+                reply['CONTENTS']['items'] = self._discovery_cache.index.find(
+                    item_id=contents.get('ID', None), name=contents.get('NAME', None),
+                    type_prefix=contents.get('TYPE', None), interface=contents.get('INTERFACE', None),
+                    limit=contents.get('limit', None))
+                reply['CONTENTS']['version'] = self._discovery_cache.version
+                reply['CONTENTS']['status'] = 'ok'
+                message_callback(reply)
+
+            def find_error(failure):
+                reply['CONTENTS']['status'] = str(failure.value)
+                reply['CONTENTS']['items'] = []
+                message_callback(reply)
+
+            if self._discovery_cache.version == 0 or contents.get('force', False):
+                # nothing discovered yet
+                self._discovery_cache.get(contents.get('force', False)).addCallbacks(find, find_error)
+            else:
+                find()
+
+        elif request == 'get_outbound_queues':
+            # depth and drop counters of every connection with an outbound queue
+            reply['CONTENTS']['queues'] = [x.outbound_queue.get_stats() for x in self.adapters
+                                           if getattr(x, 'outbound_queue', None) is not None]
+            reply['CONTENTS']['status'] = 'ok'
+            message_callback(reply)
+
+        elif request == 'get_flight_recorder':
+            # the last published messages, oldest first. 'size' and 'sample_every' reconfigure the recorder
+            contents = msg['CONTENTS']
+            self._flight_recorder.configure(size=contents.get('size', None),
+                                            sample_every=contents.get('sample_every', None))
+            reply['CONTENTS'] = self._flight_recorder.get_stats()
+            reply['CONTENTS']['messages'] = self._flight_recorder.dump(contents.get('count', None))
+            reply['CONTENTS']['status'] = 'ok'
+            message_callback(reply)
+
+        elif request == 'get_property_coalescing':
+            # PROPERTY GET coalescing and cache counters. ID, PROPERTY and 'ttl' turn caching of a property on (or off
+            # with a ttl of 0), for items that aren't in this process
+            contents = msg['CONTENTS']
+            if 'ID' in contents and 'PROPERTY' in contents and 'ttl' in contents:
+                self.set_property_cache_ttl(contents['ID'], contents['PROPERTY'], contents['ttl'])
+            reply['CONTENTS'] = self._property_gets.get_stats()
+            reply['CONTENTS']['status'] = 'ok'
+            message_callback(reply)
+
+        elif request == 'get_retained':
+            # the retained values whose TOPICS match CONTENTS 'TOPICS' (all of them if it's missing), without
+            # subscribing. 'max_size' and 'ttl' reconfigure the cache
+            contents = msg['CONTENTS']
+            self._retained.configure(max_size=contents.get('max_size', None), ttl=contents.get('ttl', None))
+            reply['CONTENTS'] = self._retained.get_stats()
+            try:
+                reply['CONTENTS']['messages'] = self._retained.match(contents.get('TOPICS', {}))
+                reply['CONTENTS']['status'] = 'ok'
+            except ValueError as e:
+                reply['CONTENTS']['status'] = str(e)
+            message_callback(reply)
+
+        elif request == 'get_traffic_stats':
+            # messages, bytes and 1 s/10 s/60 s rates per (FROM, MSG_TYPE), noisiest first, and fan-out per TO.
+            # 'top' limits how many publishers are reported, 'reset' starts the counters over after reporting
+            contents = msg['CONTENTS']
+            reply['CONTENTS'] = self._traffic_stats.get_stats(contents.get('top', None))
+            if contents.get('reset', False):
+                self._traffic_stats.reset()
+            reply['CONTENTS']['status'] = 'ok'
+            message_callback(reply)
+
+        elif request == 'get_dispatch_stats':
+            # the dispatch budget, the listener calls waiting in each priority lane, how often a burst ran over the
+            # budget and had to yield to the reactor, and the most calls ever waiting. 'budget' sets the budget,
+            # 'reset' starts the counters over after reporting
+            contents = msg['CONTENTS']
+            if contents.get('budget', None) is not None:
+                self._dispatcher.budget = contents['budget']
+            reply['CONTENTS'] = self._dispatcher.get_stats()
+            if contents.get('reset', False):
+                self._dispatcher.reset()
+            reply['CONTENTS']['status'] = 'ok'
+            message_callback(reply)
+
+        elif request == 'get_listener_profile':
+            # the slowest listeners and the recent calls over budget. 'enabled' turns profiling on or off, 'budget'
+            # sets the seconds a call may take, 'top' and 'sort' pick what's reported and 'reset' clears the times
+            contents = msg['CONTENTS']
+            if 'enabled' in contents or 'budget' in contents:
+                self.profile_listeners(contents.get('enabled', self._dispatcher.profiler is not None),
+                                       contents.get('budget', None))
+            try:
+                reply['CONTENTS'] = self._listener_profiler.get_stats(contents.get('top', 10),
+                                                                      contents.get('sort', 'total'))
+                reply['CONTENTS']['status'] = 'ok'
+            except ValueError as e:
+                reply['CONTENTS']['status'] = str(e)
+            reply['CONTENTS']['enabled'] = self._dispatcher.profiler is not None
+            if contents.get('reset', False):
+                self._listener_profiler.reset()
+            message_callback(reply)
+
+        elif request == 'get_publish_limits':
+            # the publish rate limits and how often they've been hit, noisiest FROMs first. 'connection_rate',
+            # 'connection_burst', 'from_rate', 'from_burst' and 'policy' change them (a rate of 0 turns it off)
+            contents = msg['CONTENTS']
+            status = 'ok'
+            if any(k in contents for k in ('connection_rate', 'connection_burst', 'from_rate', 'from_burst',
+                                           'policy')):
+                try:
+                    self._publish_limits.configure(connection_rate=contents.get('connection_rate', None),
+                                                   connection_burst=contents.get('connection_burst', None),
+                                                   from_rate=contents.get('from_rate', None),
+                                                   from_burst=contents.get('from_burst', None),
+                                                   policy=contents.get('policy', None))
+                except ValueError as e:
+                    status = str(e)
+            reply['CONTENTS'] = self._publish_limits.get_stats(contents.get('top', 10))
+            reply['CONTENTS']['status'] = status
+            message_callback(reply)
+
+        elif request == 'get_quarantined_listeners':
+            # listeners taken out of their subscriptions for failing too many times in a row. 'release' puts back
+            # the ones with those ids (or all of them, if it's true), 'max_failures' changes how many failures it takes
+            contents = msg['CONTENTS']
+            if 'max_failures' in contents:
+                self._listener_breaker.max_failures = contents['max_failures']
+            release = contents.get('release', None)
+            if release is True:
+                released = self.release_quarantined_listeners()
+            elif release:
+                released = self.release_quarantined_listeners(set(release))
+            else:
+                released = 0
+            reply['CONTENTS'] = self._listener_breaker.get_stats()
+            reply['CONTENTS']['released'] = released
+            reply['CONTENTS']['status'] = 'ok'
+            message_callback(reply)
+
+        elif request == 'get_federation':
+            # our federation id, and the brokers we're federated with
+            reply['CONTENTS'] = self.get_federation().get_stats()
+            reply['CONTENTS']['status'] = 'ok'
+            message_callback(reply)
 
         elif request == 'verify_broker_comms':
             reply["CONTENTS"]['status'] = "ok"
@@ -505,14 +1149,191 @@ class Broker(object):
             self.reactor.callLater(0.1, self.cleanup)
 
 
+    def get_local_discovery(self, force, progress=None):
+        """
+        Discover every adapter attached to this broker process. An adapter that misses discovery_deadline (or fails)
+        is reported with its last discovery marked STALE instead of holding up the others
+        :param force: True to clear the adapters' discovery caches
+        :param progress: function(entries) to call with each adapter's (or protocol's) discovery as it arrives
+        :return: Deferred that fires with the combined discovery list
+        """
+        ds = []
+        for adapter in self.adapters:
+            reporting = [True]  # an adapter that's been marked stale doesn't get to report any more
+            if progress is None:
+                d = defer.maybeDeferred(adapter.discover, force=force)
+            else:
+                report = functools.partial(self._report_adapter_progress, progress, reporting)
+                d = defer.maybeDeferred(adapter.discover_progressive, force, report)
+            d.addCallback(self._adapter_discovered, adapter)
+            d.addErrback(self._adapter_discovery_failed, adapter)
+
+            def missed_deadline(adapter=adapter, reporting=reporting):
+                print "Discovery of " + str(adapter) + " missed its deadline. Marking it stale"
+                reporting[0] = False
+                return self._stale_discovery(adapter)
+
+            ds.append(with_deadline(d, self.discovery_deadline, self.reactor, missed_deadline))
+
+        def combine(adapters_discovery):
+            discovery = []
+            for x in adapters_discovery:
+                if x[0] and isinstance(x[1], list):  # sanity checks
+                    discovery.extend(x[1])
+            return discovery
+
+        return defer.DeferredList(ds).addCallback(combine)
+
+    @staticmethod
+    def _report_adapter_progress(progress, reporting, entries):
+        if reporting[0]:
+            progress(entries)
+
+    def _adapter_discovered(self, discovery, adapter):
+        if isinstance(discovery, list):
+            self._adapter_discovery[adapter] = discovery
+        return discovery
+
+    def _adapter_discovery_failed(self, failure, adapter):
+        print "Error discovering " + str(adapter) + ": " + str(failure.value)
+        return self._stale_discovery(adapter)
+
+    def _stale_discovery(self, adapter):
+        """
+        The last discovery we got from an adapter, with every entry marked STALE
+        """
+        return [dict(entry, STALE=True) if isinstance(entry, dict) else entry
+                for entry in self._adapter_discovery.get(adapter, [])]
+
+    def _gather_discovery(self, force, progress=None):
+        """
+        Run a full discovery: this host, the brokers we're federated with, and the broker itself.
+        Use self._discovery_cache.get() instead, so concurrent requests share one
+        :param progress: function(entries) to call with each of our adapters' discovery as it arrives
+        """
+        d = self.get_host_discovery(force, progress)
+        if self._federation is not None:
+            # and every broker we're federated with, tagged with where it came from
+            d.addCallback(lambda local: self._federation.discover(force).addCallback(lambda rest: local + rest))
+
+        def add_broker(discovery):
+            discovery.append(Broker._discovery)
+            return discovery
+
+        return d.addCallback(add_broker)
+
+    def _gather_discovery_tree(self, force, progress=None):
+        """
+        Run the first level of lazy discovery over every adapter. The other processes in the cluster and the brokers
+        we're federated with only do full discovery, so their trees are stripped down from that.
+        Trees are cheap, so this doesn't report progress
+        """
+        d = defer.DeferredList([defer.maybeDeferred(x.discover_tree, force) for x in self.adapters],
+                               fireOnOneErrback=True, consumeErrors=False)
+
+        def combine(adapters_discovery):
+            discovery = []
+            for ok, adapter_discovery in adapters_discovery:
+                if ok and isinstance(adapter_discovery, list):
+                    discovery.extend(adapter_discovery)
+            return discovery
+
+        d.addCallback(combine)
+        if self._cluster is not None:
+            d.addCallback(lambda local: self._cluster.discover(force).addCallback(
+                lambda rest: local + discovery_tree(rest)))
+        if self._federation is not None:
+            d.addCallback(lambda local: self._federation.discover(force).addCallback(
+                lambda rest: local + discovery_tree(rest)))
+
+        def add_broker(discovery):
+            discovery.append(discovery_tree(Broker._discovery))
+            return discovery
+
+        return d.addCallback(add_broker)
+
+    def get_item_discovery(self, item_id):
+        """
+        Get the full discovery of one item, from the latest full discovery if we have one, otherwise from the adapter
+        it's attached to (which caches it until the next forced discovery)
+        :return: Deferred that fires with the item's discovery, or None if no adapter has it
+        """
+        found = self._discovery_cache.index.find(item_id=item_id, limit=1)
+        if len(found) > 0:
+            return defer.succeed(found[0])
+        return first_item_discovery(self.adapters, item_id)
+
+    def _broadcast_discovery_change(self, version, base_version, patch):
+        """
+        Announce a new discovery version to the world: the whole discovery on DISCOVERY_BROADCAST, for every client
+        that has always read it from there, and the patch from the last version on DISCOVERY_PATCH, for clients that
+        subscribe to that instead and keep track of the version
+        """
+        self.publish({'TOPICS': {'type': 'DISCOVERY_BROADCAST'},
+                      'CONTENTS': {'status': 'ok', 'version': version, 'discovery': self._discovery_cache.discovery}})
+        self.publish({'TOPICS': {'type': 'DISCOVERY_PATCH'},
+                      'CONTENTS': {'status': 'ok', 'version': version, 'base_version': base_version, 'patch': patch}})
+
+    def get_host_discovery(self, force, progress=None):
+        """
+        Discover every adapter on this host: ours, and those of the other processes in the cluster
+        :param force: True to clear the adapters' discovery caches
+        :param progress: function(entries) to call with each of our adapters' discovery as it arrives
+        :return: Deferred that fires with the combined discovery list
+        """
+        d = self.get_local_discovery(force, progress)
+        if self._cluster is not None:
+            d.addCallback(lambda local: self._cluster.discover(force).addCallback(lambda rest: local + rest))
+        return d
+
+    def get_federation(self):
+        """
+        Get this broker's Federation, creating it the first time
+        :rtype: Federation
+        """
+        if self._federation is None:
+            self._federation = Federation(self)
+        return self._federation
+
+    def federate(self, url, codecs=None):
+        """
+        Open a federation link to the broker on another host, and keep it open
+        :param url: websocket url of the other broker, e.g. ws://rack2:8085
+        :param codecs: names of the codecs to offer the other broker, most preferred first (default: JSON only)
+        """
+        factory = FederationClientFactory(self, url, codecs=codecs)
+        Broker.call_on_stop(factory.stopTrying)
+        connectWS(factory)
+        return factory
+
+    def remove_federation_peer(self, owner):
+        """
+        Forget the broker on the other end of a closed federation link
+        """
+        if self._federation is not None:
+            self._federation.remove_peer(owner)
+
     def handle_subscribe_message(self, msg, message_callback):
-        self.subscribe(message_callback, **(msg['CONTENTS']['TOPICS']))
+        topics = msg['CONTENTS']['TOPICS']
+        # the flight recorder holds on to msg itself, so leave it as it came in
         resp_msg = msg.copy()
-        resp_msg['TOPICS']['type'] = 'subscribe_response'
+        resp_msg['TOPICS'] = dict(msg['TOPICS'], type='subscribe_response')
+        resp_msg['CONTENTS'] = dict(msg['CONTENTS'])
+        try:
+            # 'MAX_RATE_HZ' and 'COALESCE' to throttle stream samples and property values
+            self.subscribe(message_callback, _max_rate_hz_=msg['CONTENTS'].get('MAX_RATE_HZ', None),
+                           _coalesce_=msg['CONTENTS'].get('COALESCE', 'latest'), **topics)
+        except ValueError as e:
+            resp_msg['CONTENTS']['status'] = str(e)
+            message_callback(resp_msg)
+            return
         resp_msg['CONTENTS']['status'] = 'ok'
 
         # send the reply
         message_callback(resp_msg)
+        # then the retained values, if they were asked for
+        if msg['CONTENTS'].get('RETAINED', False):
+            self._retained.replay(topics, message_callback)
 
     def handle_unsubscribe_message(self, msg, message_callback):
         if hasattr(message_callback, 'im_self') and message_callback.im_self is not None:
@@ -523,7 +1344,8 @@ class Broker(object):
 
         self.unsubscribe(owner, msg['CONTENTS']['TOPICS'])
         resp_msg = msg.copy()
-        resp_msg['TOPICS']['type'] = 'unsubscribe_response'
+        resp_msg['TOPICS'] = dict(msg['TOPICS'], type='unsubscribe_response')
+        resp_msg['CONTENTS'] = dict(msg['CONTENTS'])
         resp_msg['CONTENTS']['status'] = 'ok'
 
         # send the reply
@@ -534,6 +1356,7 @@ class Broker(object):
         called on exit to clean up the parlay environment
         """
         print "Cleaning Up"
+        self.stop_traffic_recorder()
         self._stopped.callback(None)
         if stop_reactor:
             self.reactor.stop()
@@ -555,6 +1378,47 @@ class Broker(object):
         except:
             return "UNKNOWN"
 
+    def _crash_hook(self, previous_hook):
+        """
+        Make an excepthook that dumps the flight recorder before handing the exception to previous_hook
+        """
+        def hook(exc_type, value, tb):
+            try:
+                self._flight_recorder.write_dump()
+            finally:
+                previous_hook(exc_type, value, tb)
+        return hook
+
+    def _error_log_observer(self, event):
+        """
+        Twisted log observer that dumps the flight recorder when an error is logged. Twisted catches the exceptions
+        raised in reactor calls and Deferred callbacks itself, so they never get to the excepthook
+        """
+        if event.get('isError', False):
+            self._error_logged()
+
+    def _error_logged(self):
+        """
+        Called when an error is logged (by Twisted, or by the listener circuit breaker). Dumps the flight recorder,
+        at most once every ERROR_DUMP_INTERVAL seconds so a failing listener doesn't bury the log in dumps
+        """
+        if not self._dump_on_error:
+            return
+        now = self.reactor.seconds()
+        if self._last_error_dump is not None and now - self._last_error_dump < self.ERROR_DUMP_INTERVAL:
+            return
+        self._last_error_dump = now
+        self._flight_recorder.write_dump()
+
+    def _set_websocket_options(self, factory):
+        """
+        Apply the broker's websocket settings to a WebSocketServerFactory
+        """
+        if self.websocket_compression:
+            factory.setProtocolOptions(perMessageCompressionAccept=message_codecs.accept_permessage_deflate)
+        else:
+            factory.setProtocolOptions()
+
     def run(self, mode=Modes.DEVELOPMENT, ssl_only=False, use_ssl=False, open_browser=True, ui_path=None, ui_caching=False):
         """
         Start up and run the broker. This method call with not return
@@ -564,6 +1428,10 @@ class Broker(object):
 
         # cleanup on sigint
         signal.signal(signal.SIGINT, lambda sig, frame: self.cleanup())
+        # if we crash, or something logs an error, say what we were doing
+        sys.excepthook = self._crash_hook(sys.excepthook)
+        self._dump_on_error = True
+        addObserver(self._error_log_observer)
 
         if mode == Broker.Modes.DEVELOPMENT:
             print "INFO: Broker running in DEVELOPER mode. This is fine for a development environment"
@@ -594,7 +1462,7 @@ class Broker(object):
 
                 factory = WebSocketServerFactory("wss://localhost:" + str(self.secure_websocket_port))
                 factory.protocol = WebSocketServerAdapter
-                factory.setProtocolOptions()
+                self._set_websocket_options(factory)
                 listenWS(factory, ssl_context_factory, interface=interface)
                 root.contentTypes['.crt'] = 'application/x-x509-ca-cert'
                 self.reactor.listenSSL(self.https_port, CacheControlledSite(ui_caching, root), ssl_context_factory, interface=interface)
@@ -610,7 +1478,15 @@ class Broker(object):
             # listen for websocket connections on port 8085
             factory = WebSocketServerFactory("ws://localhost:" + str(self.websocket_port))
             factory.protocol = WebSocketServerAdapter
-            self.reactor.listenTCP(self.websocket_port, factory, interface=interface)
+            self._set_websocket_options(factory)
+            if self.cluster_workers > 1:
+                # share the websocket port with the worker processes
+                self._cluster = cluster.Cluster(self, 0, self.cluster_workers, cluster.make_ipc_dir())
+                Broker.call_on_stop(self._cluster.stop)
+                self._cluster.listen_websocket(factory, self.websocket_port, interface, self.get_config())
+                self._cluster.start()
+            else:
+                self.reactor.listenTCP(self.websocket_port, factory, interface=interface)
 
             # http server
             self.reactor.listenTCP(self.http_port, CacheControlledSite(ui_caching, root), interface=interface)
@@ -619,6 +1495,9 @@ class Broker(object):
                 self.reactor.callLater(.5, lambda: webbrowser.open_new_tab("http://localhost:"+str(self.http_port)))
 
 
+        for url in self.federate_urls:
+            self.federate(url)
+
         # add advertising
         reactor.listenMulticast(self.websocket_port, advertiser.ParlayAdvertiser(),
                                 listenMultiple=True)
@@ -0,0 +1,185 @@
+"""
+A circuit breaker for listeners that keep failing.
+
+A listener that raises (a websocket whose connection died underneath it, an item whose state is broken) used to be
+reported and called again on the very next message, forever.  The broker's dispatch scheduler now tells a
+ListenerCircuitBreaker about every failure.  It counts consecutive failures per listener; any successful call
+resets the count.  Once a listener has failed max_failures times in a row it is quarantined: the broker takes it out
+of every subscription it's on and remembers where it was, so it can be put back later.
+
+Failures are logged with their traceback at most once every TRACEBACK_INTERVAL seconds per listener, and
+quarantining a listener logs one error saying which listener, which subscriptions and the last error.
+
+The quarantined listeners are listed (and put back, with 'release') by the 'get_quarantined_listeners' broker
+request.  When the owner of a quarantined listener unsubscribes everything (a websocket closing), its quarantined
+listeners are forgotten.
+"""
+import logging
+import traceback
+
+from parlay.server.listener_profile import listener_key
+
+logger = logging.getLogger(__name__)
+
+
+def listener_id(func):
+    """
+    :return: a hashable identity for a listener. Bound methods are identified by their object's identity, so
+    listeners owned by unhashable objects can be tracked too
+    """
+    key = getattr(func, 'key', None)  # BatchListener, ThrottledListener
+    if key is not None:
+        return key
+    bound_to = getattr(func, '__self__', None)
+    if bound_to is None:
+        return None, func
+    return id(bound_to), getattr(func, 'im_func', func.__name__)
+
+
+class QuarantinedListener(object):
+    """
+    A listener taken out of its subscriptions, and where it was
+    """
+    __slots__ = ('id', 'func', 'entries', 'failures', 'error', 'time')
+
+    def __init__(self, id_, func, entries, failures, error, time):
+        """
+        :param entries: list of (topics, listener, owner) the listener was subscribed with
+        """
+        self.id = id_
+        self.func = func
+        self.entries = entries
+        self.failures = failures
+        self.error = error
+        self.time = time
+
+    def get_stats(self):
+        owner, function = listener_key(self.func)
+        return {'id': self.id, 'owner': owner, 'function': function, 'failures': self.failures,
+                'error': self.error, 'time': self.time, 'subscriptions': [topics for topics, _, _ in self.entries]}
+
+
+class ListenerCircuitBreaker(object):
+    """
+    Counts consecutive listener failures and quarantines listeners that fail too often
+    """
+
+    DEFAULT_MAX_FAILURES = 5
+    TRACEBACK_INTERVAL = 60  # seconds between logged tracebacks of the same listener
+
+    def __init__(self, broker, max_failures=DEFAULT_MAX_FAILURES):
+        """
+        :param broker: the broker whose subscriptions listeners are quarantined from
+        :param max_failures: consecutive failures before a listener is quarantined. 0 never quarantines
+        """
+        self._broker = broker
+        self.max_failures = max_failures
+        # dict: K->V = listener_id -> [consecutive failures, time a traceback was last logged]. Only listeners that
+        # are failing are in here, so it's empty (and costs nothing) while everything works
+        self.failing = {}
+        self._quarantined = []  # QuarantinedListeners, oldest first
+        self._quarantined_ids = {}  # dict: K->V = listener_id -> its QuarantinedListener
+        self._next_id = 0
+
+        # counters
+        self.failures = 0
+        self.quarantines = 0
+
+    def succeeded(self, func):
+        """
+        func was called without raising. Only needs calling while self.failing isn't empty
+        """
+        try:
+            self.failing.pop(listener_id(func), None)
+        except TypeError:  # unhashable listener
+            pass
+
+    def failed(self, func, msg, error):
+        """
+        func raised error when it was called with msg. Call from inside the except block, for the traceback
+        """
+        self.failures += 1
+        try:
+            key = listener_id(func)
+            quarantined = self._quarantined_ids.get(key, None)
+            if quarantined is not None:
+                # queued for a message before it was quarantined, or subscribed again since. It stays quarantined
+                # until it's released
+                quarantined.entries.extend(self._broker._quarantine_listener(func))
+                return
+            state = self.failing.get(key, None)
+        except TypeError:  # unhashable listener, so no breaker. Just report it
+            logger.exception("Uncaught exception in listener %r", func)
+            return
+        if state is None:
+            state = self.failing[key] = [0, None]
+        state[0] += 1
+
+        now = self._broker.reactor.seconds()
+        if state[1] is None or now - state[1] >= self.TRACEBACK_INTERVAL:
+            state[1] = now
+            owner, function = listener_key(func)
+            logger.error("Uncaught exception in listener %s.%s (%d in a row) handling %r:\n%s", owner, function,
+                         state[0], _topics(msg), traceback.format_exc())
+            self._broker._error_logged()
+
+        if self.max_failures > 0 and state[0] >= self.max_failures:
+            del self.failing[key]
+            self._quarantine(key, func, state[0], error, now)
+
+    def _quarantine(self, key, func, failures, error, now):
+        entries = self._broker._quarantine_listener(func)
+        if len(entries) == 0:
+            return  # not subscribed (waiting on a response, say), so nothing to take it out of
+        self.quarantines += 1
+        self._next_id += 1
+        quarantined = QuarantinedListener(self._next_id, func, entries, failures, repr(error), now)
+        self._quarantined.append(quarantined)
+        self._quarantined_ids[key] = quarantined
+        stats = quarantined.get_stats()
+        logger.error("Quarantined listener %s.%s after %d consecutive failures: %s", stats['owner'],
+                     stats['function'], failures, stats)
+
+    def release(self, ids=None):
+        """
+        Take listeners out of quarantine
+        :param ids: the QuarantinedListener ids to release, or None for all of them
+        :return: the released QuarantinedListeners, for the broker to subscribe again
+        """
+        released = [x for x in self._quarantined if ids is None or x.id in ids]
+        for quarantined in released:
+            self._quarantined.remove(quarantined)
+            self._forget(quarantined)
+        return released
+
+    def forget_owner(self, owner):
+        """
+        owner unsubscribed everything, so there's nothing to put its quarantined listeners back into
+        """
+        for quarantined in list(self._quarantined):
+            quarantined.entries = [x for x in quarantined.entries if x[2] is not owner]
+            if len(quarantined.entries) == 0:
+                self._quarantined.remove(quarantined)
+                self._forget(quarantined)
+
+    def _forget(self, quarantined):
+        try:
+            self._quarantined_ids.pop(listener_id(quarantined.func), None)
+        except TypeError:
+            pass
+
+    def get_stats(self):
+        return {'max_failures': self.max_failures, 'failures': self.failures, 'quarantines': self.quarantines,
+                'failing': len(self.failing), 'quarantined': [x.get_stats() for x in self._quarantined]}
+
+
+def _topics(msg):
+    """
+    The TOPICS of msg, or of each message of a batch
+    """
+    if isinstance(msg, list):
+        return [_topics(x) for x in msg]
+    try:
+        return msg['TOPICS']
+    except (TypeError, KeyError):
+        return msg
@@ -0,0 +1,345 @@
+"""
+Cluster mode: one broker spread across several worker processes so it isn't capped at one core.
+
+The primary process (the one that called Broker.run) opens the websocket listening socket and starts
+cluster_workers - 1 worker processes that share it, so the kernel spreads websocket connections (and the adapters
+and subscriptions that come with them) across the workers.  The primary keeps everything else: the HTTP server, the
+Python items and protocols created by the script, and secure websockets.
+
+Every process is connected to every other one by a unix socket, and each tells the others which topics it has
+subscribers for.  A message published in one process is dispatched locally and forwarded only to the processes
+whose interest table matches it, exactly once: forwarded messages are never forwarded again.  'get_discovery'
+asks every process for its adapters' discovery, so clients still see a single broker.
+
+Workers are started with the primary's settings (Broker.get_config), so queue sizes, rate limits and the rest
+apply to every connection no matter which process it lands on.  Rate limit buckets are per process.
+"""
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+
+from twisted.internet import defer, protocol
+from twisted.protocols.basic import Int32StringReceiver
+
+from parlay.server.envelope import encode_message
+from parlay.server.message_codecs import JSON
+from parlay.server.subscriptions import InterestTable
+
+# the first byte of every frame on a cluster link
+PUBLISH_FRAME = 'P'  # the rest is an encoded Parlay message
+CONTROL_FRAME = 'C'  # the rest is an encoded control dict
+
+WORKER_MODULE = 'parlay.server.cluster'
+
+
+class ClusterLink(Int32StringReceiver):
+    """
+    One process's connection to another process in the cluster
+    """
+
+    MAX_LENGTH = 64 * 1024 * 1024
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.peer_index = None  # the other process's worker index, once it says hello
+        self.interest = InterestTable()  # what the other process has subscribers for
+
+    def connectionMade(self):
+        self.send_control({'type': 'hello', 'worker': self.cluster.index, 'interest': self.cluster.local_interest()})
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self.cluster.link_lost(self)
+
+    def stringReceived(self, frame):
+        kind, body = frame[:1], frame[1:]
+        try:
+            data = JSON.decode(body)
+        except Exception as e:
+            print "Bad frame from cluster worker " + str(self.peer_index) + ": " + str(e)
+            return
+
+        if kind == PUBLISH_FRAME:
+            self.cluster.publish_from_peer(data)
+        else:
+            self.cluster.control_received(self, data)
+
+    def send_publish(self, msg):
+        # the broker's envelope caches this encoding for every other link (and JSON websocket) that sends msg
+        self.sendString(PUBLISH_FRAME + encode_message(msg))
+
+    def send_control(self, control):
+        self.sendString(CONTROL_FRAME + JSON.encode(control))
+
+
+class ClusterLinkServerFactory(protocol.ServerFactory):
+    """
+    Accepts links from the processes started after us
+    """
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+    def buildProtocol(self, addr):
+        return ClusterLink(self.cluster)
+
+
+class ClusterLinkClientFactory(protocol.ReconnectingClientFactory):
+    """
+    Links to a process started before us, retrying until its socket is up
+    """
+    maxDelay = 1
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        return ClusterLink(self.cluster)
+
+
+class Cluster(object):
+    """
+    This process's view of the cluster: its links to the other processes and their interest tables
+    """
+
+    DISCOVERY_TIMEOUT = 5
+
+    def __init__(self, broker, index, size, ipc_dir):
+        """
+        :param broker: this process's Broker
+        :param index: this process's worker index. The primary is 0
+        :param size: the number of processes in the cluster
+        :param ipc_dir: directory for the unix sockets that link the processes
+        """
+        self._broker = broker
+        self.index = index
+        self.size = size
+        self.ipc_dir = ipc_dir
+        self._links = []
+        self._link_port = None
+        self._link_factories = []
+        self._workers = []  # worker processes, if we're the primary
+        self._websocket_socket = None
+        self._pending_discovery = {}  # dict: K->V = request id -> Deferred
+        self._next_request_id = 0
+
+    def socket_path(self, index):
+        return os.path.join(self.ipc_dir, "worker-" + str(index) + ".sock")
+
+    def start(self):
+        """
+        Listen for the processes after us and connect to the ones before us
+        """
+        reactor = self._broker.reactor
+        self._link_port = reactor.listenUNIX(self.socket_path(self.index), ClusterLinkServerFactory(self))
+        if self.index == 0:
+            # once every socket in it is closed
+            reactor.addSystemEventTrigger('after', 'shutdown', shutil.rmtree, self.ipc_dir, ignore_errors=True)
+        for i in range(self.index):
+            factory = ClusterLinkClientFactory(self)
+            self._link_factories.append(factory)
+            reactor.connectUNIX(self.socket_path(i), factory)
+
+    def listen_websocket(self, factory, port, interface, config=None):
+        """
+        Open the websocket listening socket and start the worker processes that share it. Only the primary does this
+        :param config: the settings to start the workers with, from Broker.get_config()
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((interface, port))
+        sock.listen(50)
+        sock.setblocking(False)
+        self._websocket_socket = sock  # keep it open for the workers we start
+        self._broker.reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+
+        for i in range(1, self.size):
+            args = [sys.executable, '-m', WORKER_MODULE] + self.worker_args(i, sock.fileno(), config)
+            self._workers.append(subprocess.Popen(args, close_fds=False))
+
+    def worker_args(self, index, websocket_fd, config=None):
+        """
+        :return: the command line arguments of worker 'index', for parse_worker_args()
+        """
+        return ['--worker', str(index), '--workers', str(self.size), '--ipc-dir', self.ipc_dir,
+                '--websocket-fd', str(websocket_fd), '--config', json.dumps(config if config is not None else {})]
+
+    def stop(self):
+        for factory in self._link_factories:
+            factory.stopTrying()
+        for worker in self._workers:
+            if worker.poll() is None:
+                worker.terminate()
+        if self._link_port is not None:
+            return self._link_port.stopListening()
+
+    def local_interest(self):
+        """
+        :return: the topics of every subscription in this process
+        """
+        return [sub.topics for sub in self._broker._subscription_index.subscriptions()]
+
+    # called by the broker
+    def interest_added(self, topics):
+        for link in self._links:
+            link.send_control({'type': 'interest', 'add': [topics]})
+
+    def interest_removed(self, topics):
+        for link in self._links:
+            link.send_control({'type': 'interest', 'remove': [topics]})
+
+    def forward(self, msg):
+        """
+        Send a locally published message to every process that has subscribers for it
+        """
+        for link in self._links:
+            if link.interest.wants(msg['TOPICS']):
+                link.send_publish(msg)
+
+    def discover(self, force):
+        """
+        Ask every other process for its adapters' discovery
+        :return: Deferred that fires with the combined discovery list. Processes that don't answer in time are left
+        out
+        """
+        ds = []
+        for link in self._links:
+            self._next_request_id += 1
+            request_id = self._next_request_id
+            d = defer.Deferred()
+            self._pending_discovery[request_id] = d
+            link.send_control({'type': 'discovery_request', 'id': request_id, 'force': force})
+
+            def timeout(request_id=request_id):
+                pending = self._pending_discovery.pop(request_id, None)
+                if pending is not None:
+                    pending.callback([])
+
+            timer = self._broker.reactor.callLater(self.DISCOVERY_TIMEOUT, timeout)
+
+            def answered(discovery, timer=timer):
+                if timer.active():
+                    timer.cancel()
+                return discovery
+
+            d.addCallback(answered)
+            ds.append(d)
+
+        def combine(results):
+            discovery = []
+            for ok, result in results:
+                if ok:
+                    discovery.extend(result)
+            return discovery
+
+        return defer.DeferredList(ds).addCallback(combine)
+
+    # called by the links
+    def publish_from_peer(self, msg):
+        self._broker._publish(msg, forward=False)
+
+    def control_received(self, link, control):
+        control_type = control.get('type', None)
+        if control_type == 'hello':
+            link.peer_index = control['worker']
+            self._links.append(link)
+            for topics in control.get('interest', []):
+                link.interest.add(topics)
+
+        elif control_type == 'interest':
+            for topics in control.get('add', []):
+                link.interest.add(topics)
+            for topics in control.get('remove', []):
+                link.interest.remove(topics)
+
+        elif control_type == 'discovery_request':
+            def respond(discovery):
+                link.send_control({'type': 'discovery_response', 'id': control['id'], 'discovery': discovery})
+
+            def error(failure):
+                print "Error during cluster discovery: " + str(failure.value)
+                respond([])
+
+            self._broker.get_local_discovery(control.get('force', False)).addCallbacks(respond, error)
+
+        elif control_type == 'discovery_response':
+            d = self._pending_discovery.pop(control['id'], None)
+            if d is not None:
+                d.callback(control.get('discovery', []))
+
+    def link_lost(self, link):
+        if link in self._links:
+            self._links.remove(link)
+        # workers don't outlive the primary
+        if self.index != 0 and link.peer_index == 0 and not self._broker._stopped.called:
+            print "Lost the cluster primary. Exiting"
+            self._broker.cleanup()
+
+
+def make_ipc_dir():
+    return tempfile.mkdtemp(prefix="parlay-cluster-")
+
+
+def parse_worker_args(argv=None):
+    """
+    Parse a cluster worker's command line (see Cluster.worker_args)
+    :param argv: the arguments, or None for sys.argv
+    """
+    parser = argparse.ArgumentParser(description="Parlay cluster worker")
+    parser.add_argument("--worker", type=int, required=True)
+    parser.add_argument("--workers", type=int, required=True)
+    parser.add_argument("--ipc-dir", required=True)
+    parser.add_argument("--websocket-fd", type=int, required=True)
+    parser.add_argument("--config", type=json.loads, default={}, help="the primary's Broker.get_config(), as JSON")
+    return parser.parse_args(argv)
+
+
+def configure_worker(broker, args):
+    """
+    Give a worker's broker the primary's settings
+    """
+    broker.configure(**dict((str(k), v) for k, v in args.config.iteritems()))
+
+
+def worker_main():
+    """
+    Entry point of a cluster worker process. The primary starts these, don't run it by hand
+    """
+    from autobahn.twisted.websocket import WebSocketServerFactory
+    from parlay.server.broker import Broker
+    from parlay.protocols.websocket import WebSocketServerAdapter
+
+    args = parse_worker_args()
+
+    broker = Broker.get_instance()
+    configure_worker(broker, args)
+    broker._cluster = Cluster(broker, args.worker, args.workers, args.ipc_dir)
+    Broker.call_on_stop(broker._cluster.stop)
+
+    factory = WebSocketServerFactory()
+    factory.protocol = WebSocketServerAdapter
+    broker._set_websocket_options(factory)
+    broker.reactor.adoptStreamPort(args.websocket_fd, socket.AF_INET, factory)
+    os.close(args.websocket_fd)  # the reactor has its own copy
+
+    broker._cluster.start()
+
+    def stop():
+        if not broker._stopped.called:
+            broker.cleanup()
+
+    # the primary stops us with SIGTERM
+    signal.signal(signal.SIGTERM, lambda sig, frame: broker.reactor.callFromThread(stop))
+    signal.signal(signal.SIGINT, lambda sig, frame: broker.reactor.callFromThread(stop))
+    broker.reactor.callWhenRunning(broker._started.callback, None)
+    broker.reactor.run(installSignalHandlers=False)
+
+
+if __name__ == "__main__":
+    worker_main()
@@ -0,0 +1,128 @@
+"""
+Request/response correlation.
+
+Instead of every waiting command adding a listener that looks at every message for its MSG_ID, the requester
+registers what it is waiting for in a ResponseTable keyed by (requester, responder, MSG_ID).  A RESPONSE is routed
+to its waiting callbacks with a single dict lookup, no matter how many commands are outstanding.
+
+Entries stay registered through PROGRESS responses and are removed by the first response with any other status,
+by cancel(), or when their timeout expires.
+"""
+
+
+class PendingResponse(object):
+    """
+    One outstanding request waiting for its response
+    """
+    __slots__ = ('key', 'callback', 'on_timeout', 'timer')
+
+    def __init__(self, key, callback, on_timeout=None):
+        self.key = key
+        self.callback = callback
+        self.on_timeout = on_timeout
+        self.timer = None
+
+    def __repr__(self):
+        return "PendingResponse(" + repr(self.key) + ")"
+
+
+class ResponseTable(object):
+    """
+    Outstanding requests, keyed by (requester, responder, MSG_ID)
+    """
+
+    # requests that don't ask for a timeout are still evicted after this long so the table can't grow forever
+    DEFAULT_EVICTION_TIME = 600
+
+    def __init__(self, owner):
+        """
+        :param owner: the broker or adapter whose reactor runs the timeouts
+        """
+        self._owner = owner
+        self._pending = {}  # dict: K->V = (requester, responder, MSG_ID) -> list of PendingResponses
+
+        # counters
+        self.delivered = 0
+        self.evicted = 0
+
+    @staticmethod
+    def response_key(msg):
+        """
+        The key a RESPONSE is filed under. A response goes TO the requester, FROM the responder
+        """
+        topics = msg['TOPICS']
+        return topics.get('TO', None), topics.get('FROM', None), topics.get('MSG_ID', None)
+
+    def expect(self, requester, responder, msg_id, callback, timeout=0, on_timeout=None):
+        """
+        Register a callback for the responses to a request
+        :param requester: the ID of the item that sent the request (its FROM)
+        :param responder: the ID of the item the request was sent to (its TO)
+        :param msg_id: the request's MSG_ID
+        :param callback: function(msg) to call with each response, until the final one
+        :param timeout: seconds to wait for the final response, or 0 to use DEFAULT_EVICTION_TIME
+        :param on_timeout: optional function() to call if the timeout expires first
+        :return: the PendingResponse, which can be passed to cancel()
+        :rtype: PendingResponse
+        """
+        key = (requester, responder, msg_id)
+        pending = PendingResponse(key, callback, on_timeout)
+        self._pending.setdefault(key, []).append(pending)
+
+        timeout = timeout if timeout > 0 else self.DEFAULT_EVICTION_TIME
+        pending.timer = self._owner.reactor.callLater(timeout, self._expire, pending)
+        return pending
+
+    def cancel(self, pending):
+        """
+        Stop waiting for a response. It's fine to cancel something that has already finished
+        :type pending: PendingResponse
+        """
+        if self._remove(pending) and pending.timer is not None and pending.timer.active():
+            pending.timer.cancel()
+
+    def match(self, msg):
+        """
+        Get the callbacks waiting for a RESPONSE message. If it's a final response (anything but PROGRESS) they are
+        removed from the table.
+        :type msg: dict
+        :rtype: list
+        """
+        try:
+            key = self.response_key(msg)
+            waiting = self._pending.get(key, None)
+        except TypeError:  # unhashable values can't be waited on
+            return []
+
+        if waiting is None:
+            return []
+
+        callbacks = [x.callback for x in waiting]
+        if msg['TOPICS'].get('MSG_STATUS', None) != 'PROGRESS':
+            del self._pending[key]
+            for pending in waiting:
+                if pending.timer is not None and pending.timer.active():
+                    pending.timer.cancel()
+        self.delivered += len(callbacks)
+        return callbacks
+
+    def _remove(self, pending):
+        waiting = self._pending.get(pending.key, None)
+        if waiting is None or pending not in waiting:
+            return False
+        waiting.remove(pending)
+        if len(waiting) == 0:
+            del self._pending[pending.key]
+        return True
+
+    def _expire(self, pending):
+        if self._remove(pending):
+            self.evicted += 1
+            if pending.on_timeout is not None:
+                pending.on_timeout()
+
+    def __len__(self):
+        return sum(len(x) for x in self._pending.itervalues())
+
+    def get_stats(self):
+        return {'outstanding': len(self), 'delivered': self.delivered, 'evicted': self.evicted}
@@ -0,0 +1,319 @@
+"""
+Single-flight, versioned discovery.
+
+Every 'get_discovery' fans out to every adapter, and for serial devices that means real round trips.  The
+DiscoveryCache makes concurrent requests share one fan out: a request that arrives while a discovery is already
+running waits for that one instead of starting another (a forced request waits for the next forced one).
+
+Each discovery that differs from the last one gets the next version number.  DISCOVERY_BROADCAST still carries the
+whole tree (and now its version).  Clients that opt in by subscribing to DISCOVERY_PATCH get just a JSON-patch style
+list of operations from the previous version instead, and a client that missed some patches can ask for the changes
+since the version it has with 'get_discovery_changes'.
+The latest discovery is also indexed (see parlay.server.discovery_index) for 'find_items'.
+
+A discovery can report its parts as they arrive (one per adapter or protocol) to the requests waiting on it, so a
+client that asked for a progressive discovery doesn't have to wait for the slowest device to see the rest.
+
+Lazy discovery of a single item ('get_item_discovery') is single-flight too, per item: see SingleFlight.
+"""
+import copy
+from collections import deque
+
+from twisted.internet import defer
+from twisted.python import failure
+
+from parlay.server.discovery_index import DiscoveryIndex
+
+
+def with_deadline(d, seconds, clock, on_timeout):
+    """
+    Give d a deadline without cancelling it, so anyone else waiting on d still gets its result
+    :param d: the Deferred to wait on
+    :param seconds: how long to wait. None to wait forever
+    :param clock: something with callLater, e.g. the reactor
+    :param on_timeout: function() whose return value we fire with if d doesn't fire in time
+    :return: Deferred that fires with d's result, or on_timeout()'s if d is too late
+    """
+    if seconds is None:
+        return d
+
+    result = defer.Deferred()
+
+    def expired():
+        if not result.called:
+            result.callback(on_timeout())
+
+    timer = clock.callLater(seconds, expired)
+
+    def fired(value):
+        if timer.active():
+            timer.cancel()
+        if not result.called:
+            result.callback(value)
+        elif isinstance(value, failure.Failure):
+            return None  # too late to matter, don't log it as unhandled
+        return value
+
+    d.addBoth(fired)
+    return result
+
+
+def first_item_discovery(sources, item_id):
+    """
+    Ask each source (adapters or protocols) for an item's discovery in turn, until one has it
+    :param sources: things with a get_item_discovery(item_id) that returns the discovery (or a Deferred of it), or
+    None if they don't have the item
+    :return: Deferred that fires with the first discovery found, or None if none of them have it
+    """
+    sources = list(sources)
+
+    def try_next(discovery):
+        if discovery is not None or len(sources) == 0:
+            return discovery
+        return defer.maybeDeferred(sources.pop(0).get_item_discovery, item_id).addCallback(try_next)
+
+    return defer.succeed(None).addCallback(try_next)
+
+
+class SingleFlight(object):
+    """
+    Concurrent calls for the same key share one call: a call that comes in while one for its key is running waits
+    for that one's result instead of starting another
+    """
+
+    def __init__(self):
+        self._waiters = {}  # dict: K->V = key -> [Deferreds waiting on the call that's running for it]
+
+    def call(self, key, func, *args):
+        """
+        Call func(*args), unless a call for key is already running
+        :return: Deferred that fires with the result of the running call
+        """
+        d = defer.Deferred()
+        waiters = self._waiters.get(key, None)
+        if waiters is not None:
+            waiters.append(d)
+            return d
+        self._waiters[key] = [d]
+        defer.maybeDeferred(func, *args).addBoth(self._finish, key)
+        return d
+
+    def running(self, key):
+        return key in self._waiters
+
+    def _finish(self, result, key):
+        for d in self._waiters.pop(key):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+def _escape(token):
+    return str(token).replace('~', '~0').replace('/', '~1')
+
+
+def _unescape(token):
+    return token.replace('~1', '/').replace('~0', '~')
+
+
+def json_diff(old, new, path=''):
+    """
+    Compute the operations that turn old into new
+    :return: list of JSON-patch style operations ({'op': 'add'|'remove'|'replace', 'path': ..., 'value': ...})
+    """
+    if type(old) != type(new):
+        return [{'op': 'replace', 'path': path, 'value': new}]
+
+    if isinstance(old, dict):
+        ops = []
+        for k in sorted(old.keys()):
+            child = path + '/' + _escape(k)
+            if k not in new:
+                ops.append({'op': 'remove', 'path': child})
+            else:
+                ops.extend(json_diff(old[k], new[k], child))
+        for k in sorted(new.keys()):
+            if k not in old:
+                ops.append({'op': 'add', 'path': path + '/' + _escape(k), 'value': new[k]})
+        return ops
+
+    if isinstance(old, list):
+        ops = []
+        common = min(len(old), len(new))
+        for i in range(common):
+            ops.extend(json_diff(old[i], new[i], path + '/' + str(i)))
+        for i in range(common, len(new)):
+            ops.append({'op': 'add', 'path': path + '/' + str(i), 'value': new[i]})
+        # remove from the end so the indexes stay valid
+        for i in reversed(range(common, len(old))):
+            ops.append({'op': 'remove', 'path': path + '/' + str(i)})
+        return ops
+
+    if old != new:
+        return [{'op': 'replace', 'path': path, 'value': new}]
+    return []
+
+
+def apply_patch(doc, ops):
+    """
+    Apply operations from json_diff to a copy of doc
+    :return: the patched copy
+    """
+    doc = copy.deepcopy(doc)
+    for op in ops:
+        if op['path'] == '':
+            doc = copy.deepcopy(op['value'])
+            continue
+
+        tokens = [_unescape(x) for x in op['path'].split('/')[1:]]
+        parent = doc
+        for token in tokens[:-1]:
+            parent = parent[int(token)] if isinstance(parent, list) else parent[token]
+        last = tokens[-1]
+
+        if isinstance(parent, list):
+            index = int(last)
+            if op['op'] == 'add':
+                parent.insert(index, copy.deepcopy(op['value']))
+            elif op['op'] == 'remove':
+                del parent[index]
+            else:
+                parent[index] = copy.deepcopy(op['value'])
+        else:
+            if op['op'] == 'remove':
+                del parent[last]
+            else:
+                parent[last] = copy.deepcopy(op['value'])
+    return doc
+
+
+class DiscoveryCache(object):
+    """
+    The broker's latest discovery, its version, and the patches between recent versions
+    """
+
+    DEFAULT_HISTORY = 32  # how many versions of patches to keep for clients that fall behind
+
+    def __init__(self, discover, on_change=None, history=DEFAULT_HISTORY):
+        """
+        :param discover: function(force, progress) that runs a full discovery and returns a Deferred of the discovery
+        list. It calls progress(entries) with each part of the discovery as it arrives
+        :param on_change: function(version, base_version, patch) called when a discovery changes the tree
+        :param history: how many versions of patches to keep
+        """
+        self._discover = discover
+        self._on_change = on_change
+        self.discovery = []
+        self.version = 0
+        self.index = DiscoveryIndex()  # for find_items, always over self.discovery
+        self._history = deque(maxlen=history)  # (version, patch from version - 1)
+
+        self._waiters = None  # Deferreds waiting on the discovery that's running, None if none is
+        self._running_forced = False
+        self._forced_waiters = []  # forced requests that came in during an unforced discovery
+        self._progress = []  # progress listeners of the requests waiting on the running discovery
+        self._forced_progress = []  # and of the forced requests waiting on the next one
+
+        # counters
+        self.requests = 0
+        self.discoveries = 0
+
+    def get(self, force=False, progress=None):
+        """
+        Get a fresh discovery, sharing one that's already running if possible
+        :param force: True to clear the adapters' discovery caches
+        :param progress: function(entries) to call with each part of the discovery as it arrives. Joining a discovery
+        that's already running only reports the parts that arrive after joining
+        :return: Deferred that fires with the discovery list
+        """
+        self.requests += 1
+        d = defer.Deferred()
+        progress = [progress] if progress is not None else []
+        if self._waiters is None:
+            self._start(force, [d], progress)
+        elif force and not self._running_forced:
+            self._forced_waiters.append(d)
+            self._forced_progress.extend(progress)
+        else:
+            self._waiters.append(d)
+            self._progress.extend(progress)
+        return d
+
+    def _start(self, force, waiters, progress):
+        self._waiters = waiters
+        self._progress = progress
+        self._running_forced = force
+        self.discoveries += 1
+        d = defer.maybeDeferred(self._discover, force, self._report_progress)
+        d.addCallbacks(self._done, self._failed)
+
+    def _report_progress(self, entries):
+        for listener in list(self._progress):
+            try:
+                listener(entries)
+            except Exception as e:
+                print "Error reporting discovery progress: " + str(e)
+
+    def _finish(self, fire):
+        waiters = self._waiters
+        self._waiters = None
+        self._progress = []
+        forced, forced_progress = self._forced_waiters, self._forced_progress
+        self._forced_waiters, self._forced_progress = [], []
+        for d in waiters:
+            fire(d)
+        if len(forced) > 0:
+            # one of the waiters may have already started another discovery
+            if self._waiters is None:
+                self._start(True, forced, forced_progress)
+            elif self._running_forced:
+                self._waiters.extend(forced)
+                self._progress.extend(forced_progress)
+            else:
+                self._forced_waiters.extend(forced)
+                self._forced_progress.extend(forced_progress)
+
+    def _done(self, discovery):
+        self.update(discovery)
+        self._finish(lambda d: d.callback(self.discovery))
+
+    def _failed(self, failure):
+        self._finish(lambda d: d.errback(failure))
+
+    def update(self, discovery):
+        """
+        Store a new discovery, bumping the version if it changed
+        :return: True if it changed
+        """
+        # our own copy, so adapters updating their cached discovery in place can't change history
+        discovery = copy.deepcopy(discovery)
+        patch = json_diff(self.discovery, discovery)
+        if len(patch) == 0:
+            return False
+
+        self.discovery = discovery
+        self.index.rebuild(discovery)
+        self.version += 1
+        self._history.append((self.version, patch))
+        if self._on_change is not None:
+            self._on_change(self.version, self.version - 1, patch)
+        return True
+
+    def changes_since(self, version):
+        """
+        :return: the patch from 'version' to the current version, or None if we don't have history back that far
+        """
+        if version == self.version:
+            return []
+        if version > self.version or len(self._history) == 0 or self._history[0][0] > version + 1:
+            return None
+        patch = []
+        for v, ops in self._history:
+            if v > version:
+                patch.extend(ops)
+        return patch
+
+    def get_stats(self):
+        return {'version': self.version, 'requests': self.requests, 'discoveries': self.discoveries,
+                'history': len(self._history)}
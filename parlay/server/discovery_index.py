@@ -0,0 +1,115 @@
+"""
+Indexes over the items in a discovery tree, so 'find_items' can answer a query by ID, NAME, TYPE prefix or
+interface without the client pulling (and scanning) the whole tree.  Also the skeleton 'tree' level of discovery.
+"""
+import bisect
+
+# the keys a discovery tree keeps (see discovery_tree)
+TREE_KEYS = ('ID', 'NAME', 'TYPE', 'TEMPLATE', 'INTERFACES', 'interfaces', 'ORIGIN')
+
+
+def discovery_tree(node):
+    """
+    Strip a discovery node down to its IDs, names and types, for the first level of lazy discovery.
+    Details (commands, fields, properties, streams) come from 'get_item_discovery'
+    :param node: a discovery node (protocol or item), or a list of them
+    """
+    if isinstance(node, list):
+        return [discovery_tree(x) for x in node]
+    if not isinstance(node, dict):
+        return node
+    tree = dict((k, node[k]) for k in TREE_KEYS if k in node)
+    tree['CHILDREN'] = discovery_tree(node.get('CHILDREN', []))
+    return tree
+
+
+class DiscoveryIndex(object):
+    """
+    ID, NAME, TYPE and interface indexes over every item (any node with an ID) in a discovery tree. Protocol nodes
+    (and the STALE stand-ins for them) only have a NAME, and are walked but not indexed
+    """
+
+    def __init__(self):
+        self._items = []  # every indexed node, in tree order
+        self._by_id = {}  # dict: K->V = ID -> [item positions]
+        self._by_name = {}  # dict: K->V = NAME -> [item positions]
+        self._by_interface = {}  # dict: K->V = interface -> [item positions]
+        self._types = []  # sorted (TYPE, position) for prefix searches
+
+    def rebuild(self, discovery):
+        """
+        Index a new discovery tree
+        :type discovery: list
+        """
+        self._items = []
+        self._by_id = {}
+        self._by_name = {}
+        self._by_interface = {}
+        self._types = []
+        self._walk(discovery)
+        self._types.sort()
+
+    def _walk(self, nodes):
+        for node in nodes:
+            if not isinstance(node, dict):
+                continue
+            if 'ID' in node and node.get('TEMPLATE', None) != 'Protocol':
+                self._add(node)
+            self._walk(node.get('CHILDREN', []))
+
+    def _add(self, node):
+        position = len(self._items)
+        self._items.append(node)
+        for index, key in ((self._by_id, 'ID'), (self._by_name, 'NAME')):
+            try:
+                if key in node:
+                    index.setdefault(node[key], []).append(position)
+            except TypeError:  # unhashable values can't be looked up anyway
+                pass
+        for interface in node.get('INTERFACES', node.get('interfaces', [])) or []:
+            try:
+                self._by_interface.setdefault(interface, []).append(position)
+            except TypeError:
+                pass
+        item_type = node.get('TYPE', None)
+        if isinstance(item_type, basestring):
+            self._types.append((item_type, position))
+
+    def _type_prefix(self, prefix):
+        positions = []
+        i = bisect.bisect_left(self._types, (prefix,))
+        while i < len(self._types) and self._types[i][0].startswith(prefix):
+            positions.append(self._types[i][1])
+            i += 1
+        return positions
+
+    def find(self, item_id=None, name=None, type_prefix=None, interface=None, limit=None):
+        """
+        Find the items that match every given criteria
+        :param item_id: the item's ID
+        :param name: the item's NAME
+        :param type_prefix: the start of the item's TYPE, e.g. 'sscom' or 'sscom/STD_ITEM'
+        :param interface: an interface the item has
+        :param limit: most items to return
+        :return: the matching item nodes (with their CHILDREN), in tree order
+        """
+        candidates = None
+        for index, value in ((self._by_id, item_id), (self._by_name, name), (self._by_interface, interface)):
+            if value is None:
+                continue
+            try:
+                positions = set(index.get(value, ()))
+            except TypeError:
+                positions = set()
+            candidates = positions if candidates is None else candidates & positions
+        if type_prefix is not None:
+            positions = set(self._type_prefix(type_prefix))
+            candidates = positions if candidates is None else candidates & positions
+
+        if candidates is None:  # no criteria, everything matches
+            candidates = range(len(self._items))
+        found = [self._items[i] for i in sorted(candidates)]
+        return found if limit is None else found[:limit]
+
+    def __len__(self):
+        return len(self._items)
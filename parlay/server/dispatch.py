@@ -0,0 +1,169 @@
+"""
+The Broker's cooperative dispatch scheduler.
+
+Calling listeners happens in priority lanes instead of all at once.  Responses and errors are delivered first,
+then commands and properties (and anything else), then STREAM and DATA telemetry.  The scheduler runs for at most
+'budget' seconds per reactor callback, then yields back to the reactor so websocket reads, PCOM ACKs and timers get
+a turn, and picks up where it left off on the next reactor iteration.
+
+Messages published while listeners are being called (a listener replying to a command, for example) are queued
+and delivered in the same pass, in priority order, instead of recursing into the publish.
+"""
+from collections import deque
+import time
+
+
+class DispatchPriority(object):
+    """
+    The dispatch lanes, most urgent first
+    """
+    RESPONSE = 0  # RESPONSE messages and anything with MSG_STATUS ERROR
+    COMMAND = 1  # COMMAND, PROPERTY, EVENT and everything that isn't telemetry
+    TELEMETRY = 2  # STREAM and DATA
+
+    ALL = (RESPONSE, COMMAND, TELEMETRY)
+
+
+_PRIORITY_BY_MSG_TYPE = {'RESPONSE': DispatchPriority.RESPONSE,
+                         'COMMAND': DispatchPriority.COMMAND,
+                         'PROPERTY': DispatchPriority.COMMAND,
+                         'STREAM': DispatchPriority.TELEMETRY,
+                         'DATA': DispatchPriority.TELEMETRY}
+
+
+def message_priority(msg):
+    """
+    Get the dispatch lane for a message
+    :type msg: dict
+    """
+    topics = msg['TOPICS']
+    if topics.get('MSG_STATUS', None) == 'ERROR':
+        return DispatchPriority.RESPONSE
+    try:
+        return _PRIORITY_BY_MSG_TYPE.get(topics.get('MSG_TYPE', None), DispatchPriority.COMMAND)
+    except TypeError:  # unhashable MSG_TYPE
+        return DispatchPriority.COMMAND
+
+
+class DispatchScheduler(object):
+    """
+    Priority lanes of pending listener calls, drained cooperatively within a time budget
+    """
+
+    DEFAULT_BUDGET = 0.01  # seconds of listener calls per reactor callback
+
+    def __init__(self, broker, budget=DEFAULT_BUDGET):
+        """
+        :param broker: the broker whose reactor we yield to
+        :param budget: the most time (in seconds) to spend calling listeners before yielding to the reactor
+        """
+        self._broker = broker
+        self.budget = budget
+        # each lane holds [arg, funcs, next index]. Each func in funcs is called with arg
+        self._lanes = tuple(deque() for _ in DispatchPriority.ALL)
+        self._draining = False
+        self._drain_scheduled = False
+
+        # times every listener call while listener profiling is on (see parlay.server.listener_profile)
+        self.profiler = None
+        # told about every listener failure, so listeners that keep failing can be quarantined (see
+        # parlay.server.circuit_breaker). None just prints them
+        self.breaker = None
+
+        # counters
+        self.yields = 0
+        self.max_pending = 0
+
+    def schedule(self, priority, arg, funcs):
+        """
+        Queue calls to every function in funcs with arg, and deliver as much as the budget allows right now.
+        :param priority: a DispatchPriority lane
+        :param arg: the argument to call each function with (a message, or a list of messages for batch listeners)
+        :param funcs: list of functions
+        """
+        if len(funcs) == 0:
+            return
+        self._lanes[priority].append([arg, funcs, 0])
+        pending = self.pending()
+        if pending > self.max_pending:
+            self.max_pending = pending
+
+        # if we're already calling listeners, the drain loop will get to it
+        if not self._draining:
+            self.drain()
+
+    def drain(self):
+        """
+        Call pending listeners, most urgent lane first, until there are none left or the budget runs out
+        """
+        self._drain_scheduled = False
+        if self._draining:
+            return
+        self._draining = True
+        try:
+            deadline = time.time() + self.budget
+            profiler = self.profiler
+            breaker = self.breaker
+            while True:
+                lane, work = self._next_work()
+                if work is None:
+                    return
+
+                arg, funcs, i = work
+                while i < len(funcs):
+                    func = funcs[i]
+                    i += 1
+                    try:
+                        if profiler is None:
+                            func(arg)
+                        else:
+                            profiler.call(func, arg)
+                    except Exception as e:
+                        if breaker is None:
+                            print "UNCAUGHT EXCEPTION IN PROTOCOL"
+                            print e
+                        else:
+                            breaker.failed(func, arg, e)
+                    else:
+                        if breaker is not None and len(breaker.failing) > 0:
+                            breaker.succeeded(func)
+
+                    if time.time() > deadline:
+                        break
+
+                work[2] = i
+                if i < len(funcs):
+                    # out of time in the middle of a fan out. Put the rest back at the front of its lane
+                    lane.appendleft(work)
+
+                if time.time() > deadline and self.pending() > 0:
+                    self._yield()
+                    return
+        finally:
+            self._draining = False
+
+    def _next_work(self):
+        for lane in self._lanes:
+            if len(lane) > 0:
+                return lane, lane.popleft()
+        return None, None
+
+    def _yield(self):
+        self.yields += 1
+        if not self._drain_scheduled:
+            self._drain_scheduled = True
+            self._broker.reactor.callLater(0, self.drain)
+
+    def pending(self):
+        """
+        :return: number of messages (or batches) that still have listeners waiting to be called
+        """
+        return sum(len(lane) for lane in self._lanes)
+
+    def reset(self):
+        self.yields = 0
+        self.max_pending = 0
+
+    def get_stats(self):
+        return {'budget': self.budget, 'pending': [len(lane) for lane in self._lanes], 'yields': self.yields,
+                'max_pending': self.max_pending}
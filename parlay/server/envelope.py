@@ -0,0 +1,147 @@
+"""
+The Broker's internal message type, and encoding one published message once no matter how many subscribers send
+it out.
+
+The Broker wraps every message it publishes in a ParlayMessage: a dict subclass (so it is still a plain Parlay
+message dict to every listener, json.dumps() and isinstance(msg, dict) included) with one __slots__ field for its
+encoded bytes per codec.  Items and protocols that build messages at a high rate (ParlayStandardItem.send_message,
+ThreadedItem.make_msg, PCOMMessage.to_json_msg) build a ParlayMessage directly, so the broker doesn't copy them on
+the way through, and adapters that only route a message pass it along as is.
+
+Adapters that write messages to the outside world (websockets, serial lines, the cloud link) should call
+encode_message() instead of json.dumps() so the first one pays for the encoding and the rest reuse the bytes.
+
+NOTE: The encoded bytes are cached the first time they are asked for.  Setting a top level key drops them, but a
+listener that modifies TOPICS or CONTENTS after that point will not change what later subscribers send.
+"""
+from parlay.server.message_codecs import CODECS
+
+JSON = 'json'
+
+_TOPICS = 'TOPICS'
+_CONTENTS = 'CONTENTS'
+
+
+def intern_topics(topics):
+    """
+    Topics decoded from JSON have unicode keys, which every lookup with a str key ('TO', 'FROM', ...) has to compare
+    the slow way. Swap them for interned str keys, in place: the TOPICS dict stays the same object (the replayer and
+    anything else that shares it can still find it) and no new dict is made
+    """
+    unicode_keys = [k for k in topics if type(k) is unicode]
+    for k in unicode_keys:
+        try:
+            interned = intern(k.encode('ascii'))
+        except UnicodeEncodeError:
+            continue
+        topics[interned] = topics.pop(k)
+
+
+class ParlayMessage(dict):
+    """
+    A Parlay message dict that caches its encoded bytes, keyed by codec
+    """
+    __slots__ = ('_encoded',)
+
+    def __init__(self, topics, contents, extra=None):
+        """
+        :param topics: the TOPICS dict. Shared, not copied
+        :param contents: the CONTENTS dict. Shared, not copied
+        :param extra: dict of any other top level keys, or None
+        """
+        dict.__init__(self)
+        if extra:
+            dict.update(self, extra)
+        dict.__setitem__(self, _TOPICS, topics)
+        dict.__setitem__(self, _CONTENTS, contents)
+        self._encoded = None  # dict: K->V = codec name -> encoded bytes, once something's been encoded
+
+    @classmethod
+    def from_dict(cls, msg):
+        """
+        Make a ParlayMessage from a message dict (or another ParlayMessage). Only the top level is copied, TOPICS and
+        CONTENTS are shared
+        :rtype: ParlayMessage
+        """
+        extra = None
+        if len(msg) > 2:
+            extra = dict((k, v) for k, v in msg.iteritems() if k != _TOPICS and k != _CONTENTS)
+        topics = msg[_TOPICS]
+        if type(topics) is dict:
+            intern_topics(topics)
+        return cls(topics, msg.get(_CONTENTS, None), extra)
+
+    def __reduce__(self):
+        # copy, deepcopy and pickle would otherwise make one without calling __init__
+        return ParlayMessage.from_dict, (dict(self),)
+
+    def encode(self, codec=JSON):
+        """
+        Get the message encoded with 'codec', encoding it only the first time
+        """
+        encoded = self._encoded
+        if encoded is None:
+            encoded = self._encoded = {}
+        else:
+            try:
+                return encoded[codec]
+            except KeyError:
+                pass
+        data = CODECS[codec].encode(self)
+        encoded[codec] = data
+        return data
+
+    # anything that changes the top level drops the cached encodings
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._encoded = None
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._encoded = None
+
+    def pop(self, key, *default):
+        self._encoded = None
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        self._encoded = None
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        self._encoded = None
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._encoded = None
+
+    def clear(self):
+        dict.clear(self)
+        self._encoded = None
+
+
+# the name older code wraps messages with
+MessageEnvelope = ParlayMessage.from_dict
+
+
+def wrap_message(msg):
+    """
+    Wrap msg in a ParlayMessage if it isn't one already
+    :rtype: ParlayMessage
+    """
+    if isinstance(msg, ParlayMessage):
+        return msg
+    return ParlayMessage.from_dict(msg)
+
+
+def encode_message(msg, codec=JSON):
+    """
+    Encode a message, reusing the cached bytes if msg is a ParlayMessage that has been encoded before
+    :param msg: Parlay message
+    :type msg: dict
+    :param codec: name of the codec to encode with (see parlay.server.message_codecs)
+    """
+    if isinstance(msg, ParlayMessage):
+        return msg.encode(codec)
+    return CODECS[codec].encode(msg)
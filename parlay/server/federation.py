@@ -0,0 +1,307 @@
+"""
+Federation: link brokers on different hosts so each one sees the others' items and traffic.
+
+A broker federates with another by opening a websocket to it (Broker.federate, or Broker.start(federate=[...])).
+Over that link both brokers exchange interest tables: the topics of every subscription they have.  A message
+published on one broker is sent to a peer only if the peer has a subscriber for it, so a rack broker doesn't mirror
+all of its traffic to a central one.  get_discovery merges every peer's discovery, with each top level entry tagged
+with the 'ORIGIN' broker it came from.
+
+Messages sent over a federation link are tagged with the ORIGIN broker id too, and a tagged message is never
+forwarded again.  Together with refusing a second link to a broker we're already federated with (or a link to
+ourselves), that means a message crosses at most one link and there can be no routing loops, whatever the topology.
+Link every broker that needs a combined view to each broker it wants to see.
+
+Federation control messages have TOPICS type 'federation' and are handled here instead of being published.
+In cluster mode the federation runs in the primary process and covers the subscriptions and traffic there.  A
+link that lands on a worker (they share the websocket port) is refused with 'retry', and the other broker reconnects
+until it reaches the primary.
+"""
+import socket
+
+from autobahn.twisted.websocket import WebSocketClientFactory, WebSocketClientProtocol
+from twisted.internet import defer, protocol
+
+from parlay.server.envelope import ParlayMessage
+from parlay.server import message_codecs
+from parlay.server.outbound_queue import QueuedWebSocketMixin
+from parlay.server.subscriptions import InterestTable
+
+# top level key of a message (or discovery entry) that says which broker it came from
+ORIGIN_KEY = 'ORIGIN'
+# TOPICS type of federation control messages
+FEDERATION_TYPE = 'federation'
+
+
+def _control(request, contents):
+    return {'TOPICS': {'type': FEDERATION_TYPE, 'request': request}, 'CONTENTS': contents}
+
+
+class FederationPeer(object):
+    """
+    A broker we're federated with
+    """
+
+    def __init__(self, broker_id, send):
+        """
+        :param broker_id: the peer's federation id
+        :param send: function that sends a message dict to the peer
+        """
+        self.broker_id = broker_id
+        self.send = send
+        self.interest = InterestTable()  # what the peer has subscribers for
+        self.forwarded = 0
+
+
+class Federation(object):
+    """
+    This broker's federation links and the interest tables of the brokers on the other end
+    """
+
+    DISCOVERY_TIMEOUT = 5
+
+    def __init__(self, broker, broker_id=None):
+        """
+        :param broker: this host's Broker
+        :param broker_id: the name other brokers know us by. Defaults to hostname:websocket port
+        """
+        self._broker = broker
+        self.broker_id = broker_id if broker_id is not None else \
+            socket.gethostname() + ":" + str(broker.websocket_port)
+        self._peers = {}  # dict: K->V = owner of the link (the websocket protocol) -> FederationPeer
+        self._pending_discovery = {}  # dict: K->V = request id -> Deferred
+        self._next_request_id = 0
+
+    def local_interest(self):
+        """
+        :return: the topics of every subscription on this broker
+        """
+        return [sub.topics for sub in self._broker._subscription_index.subscriptions()]
+
+    def hello(self, request='hello'):
+        return _control(request, {'broker_id': self.broker_id, 'interest': self.local_interest()})
+
+    # called by the broker
+    def interest_added(self, topics):
+        for peer in self._peers.itervalues():
+            peer.send(_control('interest', {'add': [topics]}))
+
+    def interest_removed(self, topics):
+        for peer in self._peers.itervalues():
+            peer.send(_control('interest', {'remove': [topics]}))
+
+    def forward(self, msg):
+        """
+        Send a locally published message to every peer that has subscribers for it.
+        Messages that came from a peer are never forwarded again
+        """
+        if ORIGIN_KEY in msg or len(self._peers) == 0:
+            return
+
+        topics = msg['TOPICS']
+        tagged = None
+        for peer in self._peers.itervalues():
+            if peer.interest.wants(topics):
+                if tagged is None:
+                    # one tagged copy (and so one encoding) for every peer
+                    tagged = ParlayMessage.from_dict(msg)
+                    tagged[ORIGIN_KEY] = self.broker_id
+                peer.send(tagged)
+                peer.forwarded += 1
+
+    def discover(self, force):
+        """
+        Ask every peer for its discovery
+        :return: Deferred that fires with the peers' discovery entries, each tagged with its ORIGIN. Peers that
+        don't answer in time are left out
+        """
+        ds = []
+        for peer in self._peers.values():
+            self._next_request_id += 1
+            request_id = self._next_request_id
+            d = defer.Deferred()
+            self._pending_discovery[request_id] = d
+            peer.send(_control('discovery', {'id': request_id, 'force': force}))
+
+            def timeout(request_id=request_id):
+                pending = self._pending_discovery.pop(request_id, None)
+                if pending is not None:
+                    pending.callback([])
+
+            timer = self._broker.reactor.callLater(self.DISCOVERY_TIMEOUT, timeout)
+
+            def answered(discovery, timer=timer, origin=peer.broker_id):
+                if timer.active():
+                    timer.cancel()
+                tagged = []
+                for entry in discovery:
+                    entry = dict(entry)
+                    entry.setdefault(ORIGIN_KEY, origin)
+                    tagged.append(entry)
+                return tagged
+
+            d.addCallback(answered)
+            ds.append(d)
+
+        def combine(results):
+            discovery = []
+            for ok, result in results:
+                if ok:
+                    discovery.extend(result)
+            return discovery
+
+        return defer.DeferredList(ds).addCallback(combine)
+
+    def handle_message(self, msg, write_method):
+        """
+        Handle a federation control message from either end of a link
+        :param write_method: the link's method to send messages back with
+        """
+        request = msg['TOPICS'].get('request', None)
+        contents = msg.get('CONTENTS', {})
+        owner = getattr(write_method, 'im_self', write_method)
+
+        cluster = self._broker._cluster
+        if request == 'hello' and cluster is not None and cluster.index != 0:
+            # a worker's peers would only see its share of the cluster. Have the other broker try again, the kernel
+            # hands the next connection to any of the processes
+            write_method(_control('refused', {'broker_id': self.broker_id, 'retry': True}))
+            return
+
+        if request in ('hello', 'hello_response'):
+            peer_id = contents.get('broker_id', None)
+            if peer_id == self.broker_id or \
+                    any(p.broker_id == peer_id for o, p in self._peers.iteritems() if o is not owner):
+                # a link to ourselves, or a second link to the same broker, would deliver messages twice
+                print "Refusing federation with " + str(peer_id) + ". Already federated with it"
+                write_method(_control('refused', {'broker_id': self.broker_id}))
+                return
+
+            peer = FederationPeer(peer_id, write_method)
+            for topics in contents.get('interest', []):
+                peer.interest.add(topics)
+            self._peers[owner] = peer
+            # the peer's discovery comes through us now, don't ask its link for protocol discovery too
+            if owner in self._broker.adapters:
+                self._broker.adapters.remove(owner)
+            print "Federated with broker " + str(peer_id)
+            if request == 'hello':
+                write_method(self.hello('hello_response'))
+            return
+
+        peer = self._peers.get(owner, None)
+        if peer is None:
+            return  # not a link we're federated over
+
+        if request == 'interest':
+            for topics in contents.get('add', []):
+                peer.interest.add(topics)
+            for topics in contents.get('remove', []):
+                peer.interest.remove(topics)
+
+        elif request == 'discovery':
+            def respond(discovery):
+                write_method(_control('discovery_response', {'id': contents.get('id', None),
+                                                             'discovery': discovery}))
+
+            def error(failure):
+                print "Error during federation discovery: " + str(failure.value)
+                respond([])
+
+            self._broker.get_host_discovery(contents.get('force', False)).addCallbacks(respond, error)
+
+        elif request == 'refused':
+            # the other end won't federate over this link after all
+            self.remove_peer(owner)
+
+        elif request == 'discovery_response':
+            d = self._pending_discovery.pop(contents.get('id', None), None)
+            if d is not None:
+                d.callback(contents.get('discovery', []))
+
+    def remove_peer(self, owner):
+        peer = self._peers.pop(owner, None)
+        if peer is not None:
+            print "Lost federation with broker " + str(peer.broker_id)
+
+    def get_stats(self):
+        return {'broker_id': self.broker_id,
+                'peers': [{'broker_id': p.broker_id, 'interest': len(p.interest), 'forwarded': p.forwarded}
+                          for p in self._peers.itervalues()]}
+
+
+class FederationClientProtocol(QueuedWebSocketMixin, WebSocketClientProtocol):
+    """
+    Our end of a federation link that we opened to another broker
+    """
+
+    def __init__(self):
+        WebSocketClientProtocol.__init__(self)
+        self._codec = message_codecs.DEFAULT_CODEC
+        self.outbound_queue = None
+
+    def onConnect(self, response):
+        # the other broker tells us which of our offered codecs it picked. No subprotocol means plain JSON
+        self._codec, _ = message_codecs.negotiate([response.protocol])
+
+    def onOpen(self):
+        broker = self.factory.broker
+        self.factory.resetDelay()
+        self.open_outbound_queue(broker)
+        self.send_message(broker.get_federation().hello())
+
+    def onMessage(self, payload, isBinary):
+        try:
+            msg = self._codec.decode(payload)
+        except Exception as e:
+            print "Could not decode " + self._codec.name + " message from " + str(self) + ": " + str(e)
+            return
+
+        broker = self.factory.broker
+        if msg['TOPICS'].get('type', None) == FEDERATION_TYPE:
+            broker.get_federation().handle_message(msg, self.send_message)
+            contents = msg.get('CONTENTS', {})
+            if msg['TOPICS'].get('request', None) == 'refused':
+                if contents.get('retry', False):
+                    # we reached a cluster worker instead of the primary. The factory reconnects
+                    self.transport.loseConnection()
+                    return
+                # we're already federated with that broker (or it's us). Reconnecting would just be refused again
+                print "Federation refused by " + str(contents.get('broker_id', None)) + \
+                      ". Not reconnecting to " + str(self.factory.url)
+                self.factory.stopTrying()
+                self.transport.loseConnection()
+        else:
+            broker.publish(msg, self.send_message)
+
+    def onClose(self, wasClean, code, reason):
+        self.factory.broker.remove_federation_peer(self)
+
+    def __str__(self):
+        return "Federation link to " + str(self.factory.url)
+
+
+class FederationClientFactory(WebSocketClientFactory, protocol.ReconnectingClientFactory):
+    """
+    Opens (and keeps re-opening) a federation link to another broker
+    """
+    protocol = FederationClientProtocol
+    maxDelay = 10
+
+    def __init__(self, broker, url, codecs=None):
+        """
+        :param broker: our Broker
+        :param url: websocket url of the other broker, e.g. ws://rack2:8085
+        :param codecs: names of the codecs to offer the other broker, most preferred first (default: JSON only)
+        """
+        kwargs = {}
+        if codecs is not None:
+            kwargs['protocols'] = message_codecs.subprotocols_for(codecs)
+        WebSocketClientFactory.__init__(self, url, **kwargs)
+        self.broker = broker
+
+    def clientConnectionFailed(self, connector, reason):
+        self.retry(connector)
+
+    def clientConnectionLost(self, connector, reason):
+        self.retry(connector)
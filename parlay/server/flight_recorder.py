@@ -0,0 +1,85 @@
+"""
+The Broker's flight recorder: a fixed size ring buffer of the most recently published messages.
+
+Recording a message only stores a reference to it and a timestamp, so it costs next to nothing on the publish
+path.  Nothing is turned into a string until someone asks for a dump, with the 'get_flight_recorder' broker request,
+or the broker crashes or logs an error (a listener raising, an unhandled error in a Deferred).  Error dumps are
+written at most once every Broker.ERROR_DUMP_INTERVAL seconds.
+"""
+from collections import deque
+import json
+import sys
+import time
+
+
+class FlightRecorder(object):
+    """
+    Remembers the last 'size' published messages (or every Nth one, if sampling)
+    """
+
+    DEFAULT_SIZE = 1000
+
+    def __init__(self, size=DEFAULT_SIZE, sample_every=1):
+        """
+        :param size: how many messages to remember
+        :param sample_every: only record one of every sample_every messages. 1 records them all, 0 turns the
+        recorder off
+        """
+        self._buffer = deque(maxlen=size)  # (timestamp, message) tuples
+        self.sample_every = sample_every
+        self._count = 0  # every message offered to the recorder, recorded or not
+
+    @property
+    def size(self):
+        return self._buffer.maxlen
+
+    def configure(self, size=None, sample_every=None):
+        """
+        Change the size or sampling of the recorder. Resizing keeps the newest messages that fit
+        """
+        if size is not None and size != self._buffer.maxlen:
+            self._buffer = deque(self._buffer, maxlen=size)
+        if sample_every is not None:
+            self.sample_every = sample_every
+
+    def record(self, msg):
+        """
+        Remember a message. Only a reference is kept, so this is cheap enough to call for every publish
+        """
+        self._count += 1
+        sample_every = self.sample_every
+        if sample_every == 1 or (sample_every > 0 and self._count % sample_every == 0):
+            self._buffer.append((time.time(), msg))
+
+    def dump(self, count=None):
+        """
+        :param count: the number of most recent messages to get, or None for all of them
+        :return: list of {'TIME': timestamp, 'MSG': message} dicts, oldest first
+        """
+        entries = list(self._buffer)
+        if count is not None:
+            entries = entries[-count:] if count > 0 else []
+        return [{'TIME': t, 'MSG': msg} for t, msg in entries]
+
+    def write_dump(self, stream=None):
+        """
+        Write every recorded message to 'stream' (stderr by default), one JSON line each
+        """
+        stream = sys.stderr if stream is None else stream
+        stream.write("FLIGHT RECORDER: last " + str(len(self._buffer)) + " messages\n")
+        for entry in self.dump():
+            try:
+                stream.write(json.dumps(entry) + "\n")
+            except (TypeError, ValueError):
+                stream.write(repr(entry) + "\n")
+        stream.flush()
+
+    def clear(self):
+        self._buffer.clear()
+
+    def get_stats(self):
+        return {'size': self.size, 'sample_every': self.sample_every, 'recorded': len(self._buffer),
+                'seen': self._count}
+
+    def __len__(self):
+        return len(self._buffer)
@@ -0,0 +1,166 @@
+"""
+Opt-in timing of every listener call the Broker makes, to find the subscriber that makes publishing slow.
+
+While profiling is on, the dispatch scheduler times each listener call (an item's on_message, a websocket
+connection's send_message, a ThreadedItem's listeners, ...) and files the duration under the listener's
+(owner, function).  Each keeps a count, total, max and a histogram with power of two microsecond buckets, which is
+enough for percentile estimates without keeping every sample.  A call that takes longer than 'budget' seconds is
+counted against its listener, remembered in a short list of recent slow calls and logged (once per listener, so a
+slow subscriber can't flood the log).
+
+Turn it on and off at runtime with Broker.profile_listeners() or the 'get_listener_profile' broker request.  Off,
+it costs the dispatcher one attribute check per message.
+
+Durations come from a monotonic clock: time.monotonic on Python 3, the 'monotonic' package on Python 2
+(pip install parlay[profiling]), or time.time if neither is available.
+"""
+from collections import deque
+import logging
+import time
+import weakref
+
+try:
+    from time import monotonic
+except ImportError:
+    try:
+        from monotonic import monotonic
+    except ImportError:
+        monotonic = time.time
+
+logger = logging.getLogger(__name__)
+
+# histogram bucket i counts calls that took less than 2**i microseconds. The last one counts everything longer
+HISTOGRAM_BUCKETS = 32
+
+
+def listener_key(func):
+    """
+    :return: (owner name, function name) for a listener. Wrapped listeners (batched or rate limited) are named after
+    the listener they wrap
+    """
+    func = getattr(func, 'func', func)  # BatchListener, ThrottledListener
+    owner = getattr(func, '__self__', None)
+    if owner is None:
+        owner_name = getattr(func, '__module__', None)
+    else:
+        owner_name = getattr(owner, 'item_id', None)
+        if owner_name is None:
+            owner_name = type(owner).__name__ + " at " + hex(id(owner))
+    return str(owner_name), getattr(func, '__name__', type(func).__name__)
+
+
+class _ListenerTimes(object):
+    """
+    Call durations of one listener
+    """
+    __slots__ = ('calls', 'total', 'max', 'over_budget', 'histogram')
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.over_budget = 0
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, seconds):
+        self.calls += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.histogram[min(int(seconds * 1000000).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+
+    def percentile(self, fraction):
+        """
+        :return: upper bound in seconds of the bucket the 'fraction' (0 - 1) percentile falls in
+        """
+        wanted = fraction * self.calls
+        seen = 0
+        for i, count in enumerate(self.histogram):
+            seen += count
+            if seen >= wanted and seen > 0:
+                return min((2 ** i) / 1000000.0, self.max)
+        return self.max
+
+
+class ListenerProfiler(object):
+    """
+    Per (owner, function) call time histograms of the broker's listeners
+    """
+
+    DEFAULT_BUDGET = 0.001  # seconds one listener call may take before it's flagged
+    RECENT_SLOW_CALLS = 100
+
+    def __init__(self, budget=DEFAULT_BUDGET, clock=monotonic):
+        """
+        :param budget: seconds a listener call may take before it is flagged as slow
+        :param clock: function that returns the time in seconds. Should be monotonic
+        """
+        self.budget = budget
+        self.clock = clock
+        self._times = {}  # dict: K->V = (owner name, function name) -> _ListenerTimes
+        # dict: K->V = listener -> (owner name, function name), so naming happens once per listener. Weak, so
+        # profiling doesn't keep unsubscribed listeners' owners alive
+        self._keys = weakref.WeakKeyDictionary()
+        self.slow_calls = deque(maxlen=self.RECENT_SLOW_CALLS)  # (wall clock time, owner, function, seconds)
+
+    def call(self, func, arg):
+        """
+        Call func(arg) and record how long it took, even if it raised
+        """
+        clock = self.clock
+        start = clock()
+        try:
+            return func(arg)
+        finally:
+            self.record(func, max(clock() - start, 0.0))
+
+    def record(self, func, seconds):
+        try:
+            key = self._keys[func]
+        except KeyError:
+            key = listener_key(func)
+            try:
+                self._keys[func] = key
+            except TypeError:  # can't be weakly referenced
+                pass
+        except TypeError:  # unhashable listener
+            key = listener_key(func)
+        times = self._times.get(key, None)
+        if times is None:
+            times = self._times[key] = _ListenerTimes()
+        times.add(seconds)
+
+        if seconds > self.budget:
+            times.over_budget += 1
+            self.slow_calls.append((time.time(), key[0], key[1], seconds))
+            if times.over_budget == 1:
+                logger.warning("Listener %s.%s took %.1f ms, over the %.1f ms budget", key[0], key[1],
+                               seconds * 1000, self.budget * 1000)
+
+    def reset(self):
+        self._times.clear()
+        self._keys.clear()
+        self.slow_calls.clear()
+
+    def get_slowest(self, top=10, sort='total'):
+        """
+        :param top: how many listeners to report, None for all of them
+        :param sort: 'total' (time spent in the listener, the ones slowing the broker down the most), 'max', 'mean'
+        or 'over_budget'
+        :return: list of per listener stats dicts, slowest first
+        :raise ValueError if sort isn't one of those
+        """
+        if sort not in ('total', 'max', 'mean', 'over_budget'):
+            raise ValueError("sort must be one of total, max, mean or over_budget, not " + str(sort))
+        rows = []
+        for (owner, function), times in self._times.iteritems():
+            rows.append({'owner': owner, 'function': function, 'calls': times.calls, 'total': times.total,
+                         'mean': times.total / times.calls, 'max': times.max, 'p50': times.percentile(0.5),
+                         'p99': times.percentile(0.99), 'over_budget': times.over_budget})
+        rows.sort(key=lambda r: r[sort], reverse=True)
+        return rows if top is None else rows[:top]
+
+    def get_stats(self, top=10, sort='total'):
+        return {'budget': self.budget, 'listeners': len(self._times), 'slowest': self.get_slowest(top, sort),
+                'slow_calls': [{'time': t, 'owner': owner, 'function': function, 'seconds': seconds}
+                               for t, owner, function, seconds in self.slow_calls]}
@@ -0,0 +1,175 @@
+"""
+Wire codecs for Parlay messages.
+
+JSON is always available and is the default.  MessagePack and CBOR are binary codecs that are registered only if
+their libraries are installed (pip install parlay[binary]).  Websocket clients pick a codec by offering its
+subprotocol name in the Sec-WebSocket-Protocol header, in order of preference.  A client that offers nothing
+(like the browser UI) gets JSON.
+"""
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+class Codec(object):
+    """
+    Base class for wire codecs. Subclass this and call register_codec() to add a new one
+    """
+    name = None  # short name used as the encoding cache key, e.g. 'json'
+    subprotocol = None  # websocket subprotocol that selects this codec
+    is_binary = False  # True if encoded messages must be sent as binary websocket frames
+
+    def encode(self, msg):
+        """
+        :param msg: Parlay message
+        :type msg: dict
+        :rtype: str
+        """
+        raise NotImplementedError()
+
+    def decode(self, payload):
+        """
+        :param payload: encoded Parlay message
+        :type payload: str
+        :rtype: dict
+        """
+        raise NotImplementedError()
+
+
+class JSONCodec(Codec):
+    name = 'json'
+    subprotocol = 'parlay.json'
+    is_binary = False
+
+    def encode(self, msg):
+        return json.dumps(msg)
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+class MsgPackCodec(Codec):
+    name = 'msgpack'
+    subprotocol = 'parlay.msgpack'
+    is_binary = True
+
+    def encode(self, msg):
+        # python 2 str goes out as msgpack str (not bin) so other languages see text, like they would with JSON
+        return msgpack.packb(msg, use_bin_type=False)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+
+class CBORCodec(Codec):
+    name = 'cbor'
+    subprotocol = 'parlay.cbor'
+    is_binary = True
+
+    def encode(self, msg):
+        return cbor2.dumps(_text_strings(msg))
+
+    def decode(self, payload):
+        return cbor2.loads(payload)
+
+
+def _text_strings(obj):
+    """
+    cbor2 encodes python 2 str as a CBOR byte string. Convert any that are valid UTF-8 to unicode so other
+    languages see text, like they would with JSON
+    """
+    if isinstance(obj, str):
+        try:
+            return obj.decode('utf-8')
+        except UnicodeDecodeError:
+            return obj  # real binary data, leave it as bytes
+    elif isinstance(obj, dict):
+        return {_text_strings(k): _text_strings(v) for k, v in obj.iteritems()}
+    elif isinstance(obj, (list, tuple)):
+        return [_text_strings(x) for x in obj]
+    return obj
+
+
+JSON = JSONCodec()
+DEFAULT_CODEC = JSON
+
+# dict: K->V = codec name -> codec
+CODECS = {}
+# dict: K->V = websocket subprotocol -> codec
+_SUBPROTOCOLS = {}
+
+
+def register_codec(codec):
+    """
+    Make a codec available for encoding and for websocket negotiation
+    :type codec: Codec
+    """
+    CODECS[codec.name] = codec
+    _SUBPROTOCOLS[codec.subprotocol] = codec
+
+
+register_codec(JSON)
+if msgpack is not None:
+    register_codec(MsgPackCodec())
+if cbor2 is not None:
+    register_codec(CBORCodec())
+
+
+def get_codec(name):
+    """
+    Look up a codec by name or raise a LookupError if it isn't available
+    :rtype: Codec
+    """
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise LookupError("Codec '" + str(name) + "' is not available. Available codecs: " + str(CODECS.keys()))
+
+
+def negotiate(offered_subprotocols):
+    """
+    Pick the codec for a websocket connection from the subprotocols the client offered (in the client's order of
+    preference). Returns (codec, subprotocol to accept), where the subprotocol is None if the client didn't offer
+    anything we support and gets the default codec.
+    """
+    for subprotocol in offered_subprotocols or []:
+        codec = _SUBPROTOCOLS.get(subprotocol, None)
+        if codec is not None:
+            return codec, subprotocol
+    return DEFAULT_CODEC, None
+
+
+def subprotocols_for(codec_names):
+    """
+    Get the websocket subprotocols to offer for a list of codec names, in the same order
+    """
+    return [get_codec(name).subprotocol for name in codec_names]
+
+
+def accept_permessage_deflate(offers):
+    """
+    Websocket server perMessageCompressionAccept hook that accepts a client's permessage-deflate offer
+    """
+    from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer):
+            return PerMessageDeflateOfferAccept(offer)
+    return None
+
+
+def accept_permessage_deflate_response(response):
+    """
+    Websocket client perMessageCompressionAccept hook that accepts the server's permessage-deflate response
+    """
+    from autobahn.websocket.compress import PerMessageDeflateResponse, PerMessageDeflateResponseAccept
+    if isinstance(response, PerMessageDeflateResponse):
+        return PerMessageDeflateResponseAccept(response)
+    return None
@@ -0,0 +1,202 @@
+"""
+Bounded outbound queues for adapters that write to the outside world.
+
+An OutboundQueue is registered as a streaming producer on its connection's transport.  While the transport keeps
+up, messages go straight through.  When the transport's write buffer fills (a stalled browser tab, a slow serial
+line) Twisted pauses the producer and messages are held in a bounded queue instead of piling up in the transport
+without limit.  When the queue is full, the queue's policy decides what to give up.
+
+Websocket connections (the broker's clients and its federation links) share their sending side through
+QueuedWebSocketMixin.
+"""
+from collections import deque
+from zope.interface import implementer
+from twisted.internet.interfaces import IPushProducer
+
+from parlay.server.envelope import encode_message
+
+
+class SlowConsumerPolicy(object):
+    """
+    What an OutboundQueue does when it is full
+    """
+    DROP_OLDEST = 'drop_oldest'  # throw away the oldest queued message
+    LATEST_VALUE = 'latest_value'  # keep only the newest STREAM value per (FROM, STREAM), then drop oldest
+    DISCONNECT = 'disconnect'  # give up on the connection
+
+    ALL = (DROP_OLDEST, LATEST_VALUE, DISCONNECT)
+
+
+@implementer(IPushProducer)
+class OutboundQueue(object):
+    """
+    A bounded queue of messages waiting for a slow connection
+    """
+
+    DEFAULT_MAX_SIZE = 1000
+    DEFAULT_POLICY = SlowConsumerPolicy.DROP_OLDEST
+
+    def __init__(self, write, disconnect, max_size=DEFAULT_MAX_SIZE, policy=DEFAULT_POLICY, name=""):
+        """
+        :param write: function(msg) that actually writes a message to the connection
+        :param disconnect: function() that drops the connection (used by the DISCONNECT policy)
+        :param max_size: the most messages to hold while the connection is paused
+        :param policy: a SlowConsumerPolicy value
+        :param name: name of the connection, used when reporting
+        """
+        if policy not in SlowConsumerPolicy.ALL:
+            raise ValueError("Unknown slow consumer policy: " + str(policy) + ". Must be one of " +
+                             str(SlowConsumerPolicy.ALL))
+        self._write = write
+        self._disconnect = disconnect
+        self.max_size = max_size
+        self.policy = policy
+        self.name = name
+
+        self._q = deque()  # messages, or (FROM, STREAM) keys into self._latest for the LATEST_VALUE policy
+        self._latest = {}  # dict: K->V = (FROM, STREAM) -> newest queued STREAM message
+        self._paused = False
+        self._stopped = False
+
+        # counters
+        self.sent = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.pauses = 0
+        self.disconnected = False
+
+    def send(self, msg):
+        """
+        Write msg now, or queue it if the connection is paused (or still draining)
+        """
+        if self._stopped:
+            self.dropped += 1
+            return
+
+        if not self._paused and len(self._q) == 0:
+            self.sent += 1
+            self._write(msg)
+        else:
+            self._enqueue(msg)
+
+    def _enqueue(self, msg):
+        if self.policy == SlowConsumerPolicy.LATEST_VALUE:
+            key = self._stream_key(msg)
+            if key is not None:
+                if key in self._latest:
+                    # replace the queued value in place. The old one will never be sent
+                    self._latest[key] = msg
+                    self.dropped += 1
+                    return
+                self._latest[key] = msg
+                msg = key
+
+        if len(self._q) >= self.max_size:
+            if self.policy == SlowConsumerPolicy.DISCONNECT:
+                self.dropped += len(self._q) + 1
+                self._give_up()
+                return
+            self._drop_oldest()
+
+        self._q.append(msg)
+        self.max_depth = max(self.max_depth, len(self._q))
+
+    def _drop_oldest(self):
+        oldest = self._q.popleft()
+        if type(oldest) is tuple:
+            del self._latest[oldest]
+        self.dropped += 1
+
+    def _give_up(self):
+        self._q.clear()
+        self._latest.clear()
+        self._stopped = True
+        self.disconnected = True
+        self._disconnect()
+
+    @staticmethod
+    def _stream_key(msg):
+        """
+        (FROM, STREAM) for STREAM value messages, None for everything else
+        """
+        topics = msg['TOPICS']
+        if topics.get('MSG_TYPE', None) == 'STREAM' and 'STREAM' in topics:
+            try:
+                key = (topics.get('FROM', None), topics['STREAM'])
+                hash(key)
+                return key
+            except TypeError:
+                return None
+        return None
+
+    def _flush(self):
+        """
+        Write queued messages until the queue is empty or the transport pauses us again
+        """
+        while len(self._q) > 0 and not self._paused and not self._stopped:
+            msg = self._q.popleft()
+            if type(msg) is tuple:
+                msg = self._latest.pop(msg)
+            self.sent += 1
+            self._write(msg)
+
+    def get_stats(self):
+        """
+        :return: dict of queue depth and counters, suitable for sending in a message
+        """
+        return {'name': self.name, 'policy': self.policy, 'max_size': self.max_size, 'depth': len(self._q),
+                'max_depth': self.max_depth, 'sent': self.sent, 'dropped': self.dropped, 'pauses': self.pauses,
+                'paused': self._paused, 'disconnected': self.disconnected}
+
+    def __len__(self):
+        return len(self._q)
+
+    # IPushProducer
+    def pauseProducing(self):
+        if not self._paused:
+            self.pauses += 1
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        self._flush()
+
+    def stopProducing(self):
+        self._stopped = True
+        self.dropped += len(self._q)
+        self._q.clear()
+        self._latest.clear()
+
+
+class QueuedWebSocketMixin(object):
+    """
+    send_message() for autobahn websocket protocols: once the connection is open, messages go through a bounded
+    OutboundQueue, and they are encoded with the connection's negotiated codec (self._codec)
+    """
+
+    outbound_queue = None
+
+    def open_outbound_queue(self, broker):
+        """
+        Start queueing messages, with the broker's queue size and slow consumer policy. Call from onOpen
+        """
+        self.outbound_queue = OutboundQueue(self._write_message, self._drop_slow_connection,
+                                            max_size=broker.outbound_queue_size,
+                                            policy=broker.outbound_queue_policy, name=str(self))
+        self.registerProducer(self.outbound_queue, True)
+
+    def send_message(self, msg):
+        """
+        Send a message dictionary encoded with this connection's codec
+        """
+        if self.outbound_queue is None:  # not open yet
+            self._write_message(msg)
+        else:
+            self.outbound_queue.send(msg)
+
+    def _write_message(self, msg):
+        self.sendMessage(encode_message(msg, self._codec.name), isBinary=self._codec.is_binary)
+
+    def _drop_slow_connection(self):
+        print "Dropping " + str(self) + ". Its outbound queue is full"
+        self.dropConnection(abort=True)
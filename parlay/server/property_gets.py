@@ -0,0 +1,151 @@
+"""
+Coalescing of PROPERTY GET requests.
+
+UI panels and scripts often poll the same property of the same item at the same time, and every GET that reaches
+a serial device is a packet competing for its ACK window.  While a GET for an item's property is waiting on its
+response, the broker holds on to any identical GETs (same TO and PROPERTY) instead of publishing them, and when the
+response comes back it sends each of them a copy with their own TO and MSG_ID.
+
+Items can also turn on a response cache per property (ParlayProperty(cache_ttl=...), add_property(cache_ttl=...),
+or the 'get_property_coalescing' broker request).  A GET for a cached property is answered by the broker without
+reaching the item until the value is ttl seconds old.  A SET of the property drops its cached value.
+"""
+
+
+class _InFlightGet(object):
+    """
+    A GET that's been published and is waiting on its response, and the identical GETs waiting with it
+    """
+    __slots__ = ('requester', 'followers', 'timer')
+
+    def __init__(self, requester, timer):
+        self.requester = requester  # (FROM, MSG_ID) of the GET that was published
+        self.followers = []  # the GETs that are waiting on its response
+        self.timer = timer
+
+
+class PropertyGetCoalescer(object):
+    """
+    The broker's in flight PROPERTY GETs and cached property values
+    """
+
+    # seconds to wait on a response before publishing the GETs that were waiting on it
+    IN_FLIGHT_TIMEOUT = 10
+
+    def __init__(self, broker):
+        self._broker = broker
+        self._in_flight = {}  # dict: K->V = (item ID, property ID) -> _InFlightGet
+        self._ttls = {}  # dict: K->V = (item ID, property ID) -> seconds its value is cached for
+        self._cached = {}  # dict: K->V = (item ID, property ID) -> (time it expires, response)
+
+        # counters
+        self.requests = 0
+        self.coalesced = 0
+        self.cache_hits = 0
+
+    def set_cache_ttl(self, item_id, property_id, ttl):
+        """
+        Cache the responses to GETs of a property
+        :param ttl: seconds a value is good for. None or 0 stops caching it
+        """
+        key = (item_id, property_id)
+        self._cached.pop(key, None)
+        if ttl:
+            self._ttls[key] = ttl
+        else:
+            self._ttls.pop(key, None)
+
+    def admit(self, msg):
+        """
+        Look at a PROPERTY message before it's published
+        :return: False if the broker should not publish it, because it was answered from the cache or is waiting on
+        an identical GET
+        """
+        topics, contents = msg['TOPICS'], msg.get('CONTENTS', None)
+        if not isinstance(contents, dict):
+            return True
+        action = contents.get('ACTION', None)
+        try:
+            key = (topics.get('TO', None), contents.get('PROPERTY', None))
+            hash(key)
+        except TypeError:
+            return True
+
+        if action == 'SET':
+            self._cached.pop(key, None)
+            return True
+        if action != 'GET' or 'FROM' not in topics or 'MSG_ID' not in topics:
+            return True
+
+        self.requests += 1
+        cached = self._cached.get(key, None)
+        if cached is not None:
+            if cached[0] > self._broker.reactor.seconds():
+                self.cache_hits += 1
+                self._broker._publish(self._answer(cached[1], msg))
+                return False
+            del self._cached[key]
+
+        requester = (topics['FROM'], topics['MSG_ID'])
+        in_flight = self._in_flight.get(key, None)
+        if in_flight is None:
+            timer = self._broker.reactor.callLater(self.IN_FLIGHT_TIMEOUT, self._expired, key)
+            self._in_flight[key] = _InFlightGet(requester, timer)
+            return True
+        if in_flight.requester == requester:
+            return True  # the same request sent again, not an identical one
+        in_flight.followers.append(msg)
+        self.coalesced += 1
+        return False
+
+    def response_published(self, msg):
+        """
+        Look at a RESPONSE after it's been published, to answer the GETs waiting on it and cache its value
+        """
+        topics, contents = msg['TOPICS'], msg.get('CONTENTS', None)
+        if not isinstance(contents, dict) or contents.get('ACTION', None) != 'RESPONSE' or 'PROPERTY' not in contents:
+            return
+        try:
+            key = (topics.get('FROM', None), contents['PROPERTY'])
+            in_flight = self._in_flight.get(key, None)
+        except TypeError:
+            return
+
+        ttl = self._ttls.get(key, None)
+        if ttl is not None and 'VALUE' in contents and topics.get('MSG_STATUS', 'OK') != 'ERROR':
+            self._cached[key] = (self._broker.reactor.seconds() + ttl, msg)
+
+        if in_flight is None or in_flight.requester != (topics.get('TO', None), topics.get('MSG_ID', None)):
+            return
+        del self._in_flight[key]
+        if in_flight.timer.active():
+            in_flight.timer.cancel()
+        for request in in_flight.followers:
+            self._broker._publish(self._answer(msg, request))
+
+    def _expired(self, key):
+        """
+        The response never came. Publish the GETs that were waiting on it (the first one of them goes out, the rest
+        wait on it)
+        """
+        in_flight = self._in_flight.pop(key, None)
+        if in_flight is None:
+            return
+        for request in in_flight.followers:
+            self._broker._publish(request)
+
+    @staticmethod
+    def _answer(response, request):
+        """
+        :return: a copy of response addressed to the requester of 'request'
+        """
+        topics = dict(response['TOPICS'])
+        topics['TO'] = request['TOPICS']['FROM']
+        topics['MSG_ID'] = request['TOPICS']['MSG_ID']
+        return {'TOPICS': topics, 'CONTENTS': dict(response['CONTENTS'])}
+
+    def get_stats(self):
+        return {'requests': self.requests, 'coalesced': self.coalesced, 'cache_hits': self.cache_hits,
+                'in_flight': len(self._in_flight),
+                'cached': [{'ID': item_id, 'PROPERTY': property_id, 'ttl': ttl}
+                           for (item_id, property_id), ttl in self._ttls.iteritems()]}
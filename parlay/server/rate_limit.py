@@ -0,0 +1,290 @@
+"""
+Token bucket rate limits on what connections publish into the Broker.
+
+A runaway script or a buggy device on a websocket or serial line can publish faster than the reactor can deliver,
+and everything else on the broker waits behind it.  Every adapter that reads messages from the outside world hands
+them to its ConnectionLimiter instead of straight to Broker.publish.  A message is published only if both its
+connection's bucket and its FROM's bucket (shared by every connection, so a device can't get around the limit by
+reconnecting) have a token.  Buckets refill at 'rate' messages a second and hold at most 'burst' tokens.  Limits
+are off (None) by default; set them with Broker.start or the 'get_publish_limits' broker request.
+
+What happens to a message over the limit is the RateLimitPolicy:
+    drop    throw it away
+    delay   hold it (in order, with everything the connection sends after it) until there are tokens again. At most
+            MAX_DELAYED messages are held per connection, anything past that is dropped
+    reject  throw it away and, if it has a MSG_ID, send the sender an ERROR RESPONSE saying it was rate limited
+
+Every limit hit is counted, per policy outcome and per FROM.
+"""
+from collections import deque
+import weakref
+
+
+class RateLimitPolicy(object):
+    """
+    What a ConnectionLimiter does with a message over the limit
+    """
+    DROP = 'drop'
+    DELAY = 'delay'
+    REJECT = 'reject'
+
+    ALL = (DROP, DELAY, REJECT)
+
+
+class TokenBucket(object):
+    """
+    'rate' tokens a second, holding at most 'burst' of them
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst  # start full
+        self.updated = now
+
+    def available(self, now):
+        """
+        :return: the tokens in the bucket at 'now'
+        """
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        return self.tokens
+
+    def has_token(self, now):
+        # allowing for rounding in the refill, or a bucket could ask to be waited on for 1e-17 seconds
+        return self.available(now) > 1 - 1e-9
+
+    def wait(self, now):
+        """
+        :return: seconds until there is a whole token
+        """
+        return max(0.0, (1 - self.available(now)) / self.rate)
+
+
+class PublishLimits(object):
+    """
+    The broker's publish rate limits: the configuration, the per FROM buckets and the counters
+    """
+
+    DEFAULT_POLICY = RateLimitPolicy.DROP
+    MAX_DELAYED = 1000  # messages a connection may have held by the 'delay' policy
+    MAX_FROM_BUCKETS = 10000  # forget FROMs with full buckets past this many
+
+    def __init__(self, broker):
+        self._broker = broker
+        self.connection_rate = None
+        self.connection_burst = None
+        self.from_rate = None
+        self.from_burst = None
+        self.policy = self.DEFAULT_POLICY
+        self._from_buckets = {}  # dict: K->V = FROM -> TokenBucket
+        self._connections = weakref.WeakSet()
+
+        # counters
+        self.limited = 0
+        self.dropped = 0
+        self.delayed = 0
+        self.rejected = 0
+        self.limited_from = {}  # dict: K->V = FROM -> limit hits
+
+    def configure(self, connection_rate=None, connection_burst=None, from_rate=None, from_burst=None, policy=None):
+        """
+        Set the limits. A rate of 0 turns that limit off, None leaves it as is
+        :param connection_rate: messages a second each connection may publish
+        :param connection_burst: messages a connection may publish at once after being idle. Defaults to a second's
+        worth
+        :param from_rate: messages a second each FROM may publish
+        :param from_burst: like connection_burst, for each FROM
+        :param policy: a RateLimitPolicy
+        :raise ValueError if the policy isn't valid
+        """
+        if policy is not None:
+            if policy not in RateLimitPolicy.ALL:
+                raise ValueError("Unknown rate limit policy: " + str(policy) + ". Must be one of " +
+                                 str(RateLimitPolicy.ALL))
+            self.policy = policy
+        # only limits that actually change get new buckets (that pick up the new limits), so setting a limit to
+        # what it already is doesn't refill anyone's bucket
+        connection_limits = (self.connection_rate, self.connection_burst)
+        if connection_rate is not None:
+            self.connection_rate = connection_rate or None
+        if connection_burst is not None:
+            self.connection_burst = connection_burst
+        if (self.connection_rate, self.connection_burst) != connection_limits:
+            for connection in self._connections:
+                connection.bucket = None
+
+        from_limits = (self.from_rate, self.from_burst)
+        if from_rate is not None:
+            self.from_rate = from_rate or None
+        if from_burst is not None:
+            self.from_burst = from_burst
+        if (self.from_rate, self.from_burst) != from_limits:
+            self._from_buckets.clear()
+
+    @property
+    def enabled(self):
+        return self.connection_rate is not None or self.from_rate is not None
+
+    def connection(self, name):
+        """
+        :return: a ConnectionLimiter for a new connection
+        """
+        limiter = ConnectionLimiter(self, self._broker, name)
+        self._connections.add(limiter)
+        return limiter
+
+    @staticmethod
+    def _bucket(rate, burst, now):
+        return TokenBucket(float(rate), float(burst if burst else max(rate, 1)), now)
+
+    def take(self, connection, msg, now):
+        """
+        Take a token from connection's bucket and msg's FROM bucket if they both have one
+        :return: 0 if they did, else the seconds until they will
+        """
+        connection_bucket = None
+        if self.connection_rate is not None:
+            connection_bucket = connection.bucket
+            if connection_bucket is None:
+                connection_bucket = connection.bucket = self._bucket(self.connection_rate, self.connection_burst, now)
+            if not connection_bucket.has_token(now):
+                return connection_bucket.wait(now)
+
+        from_bucket = None
+        if self.from_rate is not None:
+            from_ = msg['TOPICS'].get('FROM', None)
+            try:
+                from_bucket = self._from_buckets.get(from_, None)
+                if from_bucket is None and from_ is not None:
+                    if len(self._from_buckets) >= self.MAX_FROM_BUCKETS:
+                        self._forget_idle(now)
+                    from_bucket = self._from_buckets[from_] = self._bucket(self.from_rate, self.from_burst, now)
+            except TypeError:  # unhashable FROM
+                from_bucket = None
+            if from_bucket is not None and not from_bucket.has_token(now):
+                return from_bucket.wait(now)
+
+        if connection_bucket is not None:
+            connection_bucket.tokens -= 1
+        if from_bucket is not None:
+            from_bucket.tokens -= 1
+        return 0
+
+    def _forget_idle(self, now):
+        for from_, bucket in self._from_buckets.items():
+            if bucket.available(now) >= bucket.burst:
+                del self._from_buckets[from_]
+
+    def count(self, msg):
+        """
+        Count a limit hit by msg
+        """
+        self.limited += 1
+        from_ = msg['TOPICS'].get('FROM', None)
+        try:
+            self.limited_from[from_] = self.limited_from.get(from_, 0) + 1
+        except TypeError:  # unhashable FROM
+            pass
+
+    def get_stats(self, top=10):
+        limited_from = sorted(self.limited_from.iteritems(), key=lambda x: x[1], reverse=True)[:top]
+        return {'connection_rate': self.connection_rate, 'connection_burst': self.connection_burst,
+                'from_rate': self.from_rate, 'from_burst': self.from_burst, 'policy': self.policy,
+                'limited': self.limited, 'dropped': self.dropped, 'delayed': self.delayed, 'rejected': self.rejected,
+                'limited_from': [{'FROM': from_, 'limited': count} for from_, count in limited_from],
+                'connections': [x.get_stats() for x in self._connections if x.limited > 0]}
+
+
+class ConnectionLimiter(object):
+    """
+    Publishes what one connection receives, within the broker's PublishLimits
+    """
+
+    def __init__(self, limits, broker, name=""):
+        self._limits = limits
+        self._broker = broker
+        self.name = name
+        self.bucket = None  # this connection's TokenBucket, made when it's first needed
+        self._delayed = deque()  # (message, write_method) held by the 'delay' policy
+        self._release_call = None
+        self.limited = 0
+
+    def publish(self, msg, write_method=None):
+        """
+        Publish msg if it's within the limits, otherwise drop, delay or reject it
+        :param msg: the message the connection received
+        :param write_method: the connection's method to send a response with
+        """
+        if len(self._delayed) > 0:
+            self._delay(msg, write_method)  # behind what's already waiting, so order is kept
+            return
+        limits = self._limits
+        if not limits.enabled:
+            self._broker.publish(msg, write_method)
+            return
+
+        wait = limits.take(self, msg, self._broker.reactor.seconds())
+        if wait == 0:
+            self._broker.publish(msg, write_method)
+            return
+
+        self.limited += 1
+        limits.count(msg)
+        if limits.policy == RateLimitPolicy.DELAY:
+            self._delay(msg, write_method, wait)
+        elif limits.policy == RateLimitPolicy.REJECT:
+            limits.rejected += 1
+            self._reject(msg, write_method)
+        else:
+            limits.dropped += 1
+
+    def _delay(self, msg, write_method, wait=None):
+        if len(self._delayed) >= PublishLimits.MAX_DELAYED:
+            self._limits.dropped += 1
+            return
+        self._limits.delayed += 1
+        self._delayed.append((msg, write_method))
+        if self._release_call is None and wait is not None:
+            self._release_call = self._broker.reactor.callLater(wait, self._release)
+
+    def _release(self):
+        """
+        Publish the held messages that there are tokens for now
+        """
+        self._release_call = None
+        limits = self._limits
+        now = self._broker.reactor.seconds()
+        while len(self._delayed) > 0:
+            msg, write_method = self._delayed[0]
+            wait = limits.take(self, msg, now) if limits.enabled else 0
+            if wait > 0:
+                self._release_call = self._broker.reactor.callLater(wait, self._release)
+                return
+            self._delayed.popleft()
+            self._broker.publish(msg, write_method)
+
+    def _reject(self, msg, write_method):
+        topics = msg['TOPICS']
+        if write_method is None or 'MSG_ID' not in topics:
+            return
+        write_method({'TOPICS': {'TO': topics.get('FROM', None), 'FROM': topics.get('TO', None),
+                                 'MSG_TYPE': 'RESPONSE', 'MSG_ID': topics['MSG_ID'], 'MSG_STATUS': 'ERROR',
+                                 'RESPONSE_REQ': False},
+                      'CONTENTS': {'ERROR': 'RATE LIMITED',
+                                   'DESCRIPTION': "Message dropped, " + self.name + " is publishing too fast"}})
+
+    def close(self):
+        """
+        The connection is gone. Drop anything still held
+        """
+        if self._release_call is not None and self._release_call.active():
+            self._release_call.cancel()
+        self._release_call = None
+        self._limits.dropped += len(self._delayed)
+        self._delayed.clear()
+
+    def get_stats(self):
+        return {'name': self.name, 'limited': self.limited, 'delayed': len(self._delayed)}
@@ -0,0 +1,179 @@
+"""
+Replay a traffic log (see parlay.server.traffic_log) into a Broker.
+
+Messages are re-published with their original timing, N times faster, or as fast as the broker will take them.
+With measure_latency on, the replay also times how long each message takes from when it should have been
+published to when the broker dispatches it, which makes a replay of real field traffic a realistic benchmark.
+
+Run it from the command line to start a broker and replay a log into it::
+
+    python -m parlay.server.replay traffic.log --speed 10 --latency
+"""
+import argparse
+import time
+
+from twisted.internet import defer
+
+from parlay.server.envelope import ParlayMessage
+from parlay.server.traffic_log import TrafficLogReader
+
+# broker requests and (un)subscribes need the connection that sent them, so they aren't replayed by default
+CONNECTION_MESSAGE_TYPES = ('broker', 'subscribe', 'unsubscribe')
+
+
+class TrafficReplayer(object):
+    """
+    Re-publishes the messages in a traffic log into a broker
+    """
+
+    MAX_SPEED_BATCH = 500  # messages to publish per reactor iteration at max speed
+
+    def __init__(self, broker, path, speed=1.0, start_time=None, measure_latency=False,
+                 include_connection_messages=False):
+        """
+        :param broker: the Broker to publish into
+        :param path: the traffic log to replay
+        :param speed: 1.0 for real time, N for N times faster, None (or 0) for as fast as possible
+        :param start_time: skip the part of the log recorded before this timestamp
+        :param measure_latency: if True, time each message from when it should have been published until the
+        broker dispatches it
+        :param include_connection_messages: if True, replay broker and (un)subscribe messages too
+        """
+        self._broker = broker
+        self._reader = TrafficLogReader(path)
+        self.speed = speed if speed else None
+        self.start_time = start_time
+        self.measure_latency = measure_latency
+        self.include_connection_messages = include_connection_messages
+
+        self._records = None
+        self._next = None  # the next (timestamp, msg) to publish
+        self._first_timestamp = None
+        self._started_at = None
+        self._done = None
+
+        self._sent = {}  # dict: K->V = id of a replayed ParlayMessage -> time it was due
+        self._latencies = []  # seconds from due to dispatched
+        self.published = 0
+        self.skipped = 0
+
+    def start(self):
+        """
+        Start replaying
+        :return: Deferred that fires with the replay's stats when every message has been published
+        """
+        self._done = defer.Deferred()
+        self._records = self._reader.records(self.start_time)
+        self._next = next(self._records, None)
+        if self._next is not None:
+            self._first_timestamp = self._next[0]
+        self._started_at = time.time()
+
+        if self.measure_latency:
+            # a catch-all subscription is the first thing the broker calls for every message
+            self._broker.subscribe(self._on_dispatch, _owner_=self)
+
+        self._publish_due()
+        return self._done
+
+    def _due_time(self, timestamp):
+        return self._started_at + (timestamp - self._first_timestamp) / self.speed
+
+    def _publish_due(self):
+        """
+        Publish every message that's due (or a batch of them at max speed), then wait for the next one
+        """
+        batch = []
+        now = time.time()
+        while self._next is not None:
+            timestamp, msg = self._next
+            due = now if self.speed is None else self._due_time(timestamp)
+            if due > now or (self.speed is None and len(batch) >= self.MAX_SPEED_BATCH):
+                break
+
+            if not self.include_connection_messages and \
+                    msg.get('TOPICS', {}).get('type', None) in CONNECTION_MESSAGE_TYPES:
+                self.skipped += 1
+            else:
+                if self.measure_latency:
+                    # the broker publishes a ParlayMessage as is, so it's the same object when it's dispatched
+                    msg = ParlayMessage.from_dict(msg)
+                    self._sent[id(msg)] = due
+                batch.append(msg)
+            self._next = next(self._records, None)
+
+        if len(batch) > 0:
+            self.published += len(batch)
+            self._broker.publish_many(batch)
+
+        if self._next is None:
+            self._finish()
+        else:
+            delay = 0 if self.speed is None else max(0, self._due_time(self._next[0]) - time.time())
+            self._broker.reactor.callLater(delay, self._publish_due)
+
+    def _on_dispatch(self, msg):
+        due = self._sent.pop(id(msg), None)
+        if due is not None:
+            self._latencies.append(time.time() - due)
+
+    def _finish(self):
+        if self.measure_latency:
+            self._broker.unsubscribe_all(self)
+        self._reader.close()
+        self._done.callback(self.get_stats())
+
+    def get_stats(self):
+        """
+        :return: dict of message counts, rate and (if measured) latency percentiles in milliseconds
+        """
+        elapsed = time.time() - self._started_at if self._started_at is not None else 0
+        stats = {'published': self.published, 'skipped': self.skipped, 'seconds': elapsed,
+                 'rate': self.published / elapsed if elapsed > 0 else 0}
+        if self.measure_latency:
+            latencies = sorted(self._latencies)
+            stats['undelivered'] = len(self._sent)
+            if len(latencies) > 0:
+                stats['latency_ms'] = {'p50': 1000 * latencies[len(latencies) // 2],
+                                       'p99': 1000 * latencies[min(len(latencies) - 1, int(len(latencies) * .99))],
+                                       'max': 1000 * latencies[-1]}
+        return stats
+
+
+def main():
+    """
+    Start a broker and replay a traffic log into it
+    """
+    from parlay.server.broker import Broker
+
+    parser = argparse.ArgumentParser(description="Replay a Parlay traffic log into a broker")
+    parser.add_argument("path", help="the traffic log to replay")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed. 1 is real time (default: 1)")
+    parser.add_argument("--max-speed", action="store_true", help="replay as fast as possible")
+    parser.add_argument("--start", type=float, default=None, help="timestamp in the log to start from")
+    parser.add_argument("--latency", action="store_true", help="measure dispatch latency")
+    parser.add_argument("--exit", action="store_true", help="stop the broker when the replay is done")
+    parser.add_argument("--websocket-port", type=int, default=8085)
+    parser.add_argument("--http-port", type=int, default=8080)
+    args = parser.parse_args()
+
+    broker = Broker.get_instance()
+    replayer = TrafficReplayer(broker, args.path, speed=None if args.max_speed else args.speed,
+                               start_time=args.start, measure_latency=args.latency)
+
+    def replay():
+        d = replayer.start()
+
+        def done(stats):
+            print "Replay finished: " + str(stats)
+            if args.exit:
+                broker.cleanup()
+
+        d.addCallback(done)
+
+    broker.reactor.callWhenRunning(replay)
+    Broker.start(open_browser=False, websocket_port=args.websocket_port, http_port=args.http_port)
+
+
+if __name__ == "__main__":
+    main()
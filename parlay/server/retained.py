@@ -0,0 +1,143 @@
+"""
+The Broker's retained value cache: the last STREAM sample, PROPERTY value and EVENT of every item.
+
+It's filled passively from the messages the broker publishes, so it costs a couple of dict lookups per message and
+never asks a device for anything.  A listener that subscribes with _retained_=True (or a websocket client that
+subscribes with 'RETAINED': True in CONTENTS) is immediately sent the retained messages that match its
+subscription, so a dashboard doesn't have to wait for the next sample or send a PROPERTY GET to a slow serial device
+to show something.
+
+The cache holds at most max_size values, dropping the least recently updated first, and values older than ttl
+seconds are never replayed.  Replayed messages are tagged with a top level 'RETAINED' key holding their age in
+seconds.
+"""
+from collections import OrderedDict
+import time
+
+from parlay.server.envelope import ParlayMessage
+from parlay.server.subscriptions import compile_topics, topics_match
+
+# top level key of a replayed message, its age in seconds
+RETAINED_KEY = 'RETAINED'
+
+
+def retain_key(msg):
+    """
+    :return: the (FROM, kind, name) a message is retained under, or None if it isn't a value worth retaining
+    """
+    topics, contents = msg['TOPICS'], msg.get('CONTENTS', None)
+    if not isinstance(contents, dict):
+        return None
+    msg_type = topics.get('MSG_TYPE', None)
+
+    if msg_type == 'STREAM':
+        if 'VALUE' not in contents:
+            return None  # a request to start or stop a stream, not a sample
+        return topics.get('FROM', None), 'STREAM', topics.get('STREAM', contents.get('STREAM', None))
+
+    if msg_type == 'RESPONSE':
+        # the answer to a PROPERTY GET
+        if contents.get('ACTION', None) != 'RESPONSE' or 'PROPERTY' not in contents or 'VALUE' not in contents \
+                or topics.get('MSG_STATUS', 'OK') == 'ERROR':
+            return None
+        return topics.get('FROM', None), 'PROPERTY', contents['PROPERTY']
+
+    if msg_type == 'EVENT':
+        return topics.get('FROM', None), 'EVENT', contents.get('EVENT', None)
+
+    return None
+
+
+class RetainedValues(object):
+    """
+    The last value message of every (FROM, STREAM/PROPERTY/EVENT), with bounded size and a time to live
+    """
+
+    DEFAULT_MAX_SIZE = 10000
+    DEFAULT_TTL = 300
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL, clock=time.time):
+        """
+        :param max_size: most values to keep. 0 turns retaining off
+        :param ttl: seconds a value is good for. None for forever
+        :param clock: function that returns the time in seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._values = OrderedDict()  # dict: K->V = (FROM, kind, name) -> (time, message), oldest update first
+
+        # counters
+        self.retained = 0
+        self.replayed = 0
+
+    def configure(self, max_size=None, ttl=None):
+        if max_size is not None:
+            self.max_size = max_size
+            self._evict()
+        if ttl is not None:
+            self.ttl = ttl
+
+    def observe(self, msg):
+        """
+        Retain msg if it's a stream sample, property value or event. Cheap enough to call for every publish
+        """
+        if self.max_size <= 0:
+            return
+        try:
+            key = retain_key(msg)
+            if key is None:
+                return
+            self._values.pop(key, None)  # so the newest update is always last
+            self._values[key] = (self._clock(), msg)
+        except TypeError:  # an unhashable FROM or name
+            return
+        self.retained += 1
+        self._evict()
+
+    def _evict(self):
+        while len(self._values) > self.max_size:
+            self._values.popitem(last=False)
+        if self.ttl is not None:
+            expired = self._clock() - self.ttl
+            while len(self._values) > 0 and next(self._values.itervalues())[0] < expired:
+                self._values.popitem(last=False)
+
+    def match(self, topics):
+        """
+        :param topics: subscription topics. A retained message matches if its TOPICS have every one of them
+        (predicates included)
+        :return: the retained messages that match, tagged with their age, oldest update first
+        :raise ValueError if topics has a predicate that isn't valid
+        """
+        topics = compile_topics(topics)
+        self._evict()
+        now = self._clock()
+        found = []
+        for t, msg in self._values.itervalues():
+            if topics_match(topics, msg['TOPICS']):
+                tagged = ParlayMessage.from_dict(msg)
+                tagged[RETAINED_KEY] = now - t
+                found.append(tagged)
+        return found
+
+    def replay(self, topics, func):
+        """
+        Call func with every retained message that matches topics
+        :return: the number of messages replayed
+        """
+        found = self.match(topics)
+        for msg in found:
+            func(msg)
+        self.replayed += len(found)
+        return len(found)
+
+    def clear(self):
+        self._values.clear()
+
+    def get_stats(self):
+        return {'max_size': self.max_size, 'ttl': self.ttl, 'values': len(self._values),
+                'retained': self.retained, 'replayed': self.replayed}
+
+    def __len__(self):
+        return len(self._values)
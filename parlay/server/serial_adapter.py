@@ -6,6 +6,8 @@ from twisted.internet.serialport import SerialPort
 from twisted.protocols.basic import LineReceiver
 from parlay.server.adapter import Adapter
 from parlay.server.broker import Broker
+from parlay.server.envelope import encode_message
+from parlay.server.outbound_queue import OutboundQueue
 
 
 class FileTransport(FileDescriptor):
@@ -78,7 +80,14 @@ class LineTransportServerAdapter(Adapter, LineReceiver):
         self._discovery_response_defer = None
         self.reactor = self.broker.reactor
         self.delimiter = str(delimiter).decode("string_escape")
+        # the queue must exist before the transport connects, in case we write as soon as we're connected
+        self.outbound_queue = OutboundQueue(self._write_message, self._drop_slow_connection,
+                                            max_size=self.broker.outbound_queue_size,
+                                            policy=self.broker.outbound_queue_policy, name=self.__class__.__name__)
+        self.publish_limiter = self.broker.publish_limiter(self.__class__.__name__)
         self.transport = transport_factory(self, **kwargs)
+        # a separate producer object, LineReceiver's own pause/resumeProducing are for the read side
+        self.transport.registerProducer(self.outbound_queue, True)
         self._cached_discovery = None
         self.discovery_timeout_time = self.DEFAULT_DISCOVERY_TIMEOUT_TIME
         Adapter.__init__(self)
@@ -105,9 +114,9 @@ class LineTransportServerAdapter(Adapter, LineReceiver):
             self._discovery_response_defer.callback(discovery)
             self._discovery_response_defer = None
 
-        # else it's just a regular message, publish it
+        # else it's just a regular message, publish it (within the rate limits)
         else:
-            self.broker.publish(msg, self.send_message_as_json)
+            self.publish_limiter.publish(msg, self.send_message_as_json)
 
     def discover(self, force):
         """
@@ -140,10 +149,18 @@ class LineTransportServerAdapter(Adapter, LineReceiver):
         """
         Transforms parlay message dictionary to JSON, adds delimiting character,
         and sends it over the transport.
+        If the transport can't keep up, the message waits in this adapter's bounded outbound queue.
         :param msg:
         :return:
         """
-        self.sendLine(json.dumps(msg))
+        self.outbound_queue.send(msg)
+
+    def _write_message(self, msg):
+        self.sendLine(encode_message(msg))
+
+    def _drop_slow_connection(self):
+        print "Closing " + str(self.__class__.__name__) + ". Its outbound queue is full"
+        self.transport.loseConnection()
 
 
 class FileDeviceServerAdapter(LineTransportServerAdapter):
@@ -0,0 +1,514 @@
+"""
+The compiled subscription index the Broker uses to find the subscriptions that match a published message.
+
+Every subscription is an exact set of topic key/value pairs.  Instead of walking the listener trie for every
+message, each subscription is filed once in a posting list under a single 'anchor' key/value pair and only its
+remaining pairs are checked when a message carries that anchor.  Subscriptions on nothing but a TO value (every
+item subscribes like that) live in a separate DIRECT table and need no checking at all.
+
+Matching a message costs roughly one dict lookup per topic key plus the number of candidate subscriptions,
+instead of (number of topic keys) * (depth of the trie).
+
+A topic value can also be a predicate instead of an exact value, written as a one key JSON object:
+    {"$prefix": "subsystem3/"}          string values that start with "subsystem3/"
+    {"$in": ["ERROR", "WARNING"]}        any of the listed values
+    {"$range": [0, 100]}                 numbers from 0 to 100, inclusive. Either bound can be null
+e.g. {"FROM": {"$prefix": "subsystem3/"}, "MSG_STATUS": {"$in": ["ERROR", "WARNING"]}}.  Predicates are compiled
+into the index too: a $in is filed under each of its values, a $prefix in a per key prefix table, and only a
+subscription with nothing but $range predicates has to be tested against every message that has its key.
+"""
+import numbers
+
+
+class BatchListener(object):
+    """
+    Wraps a listener that takes a *list* of messages. Broker.publish_many hands it every message of a batch that
+    matched in one call, a plain publish hands it a list of one.
+    """
+    __slots__ = ('func', 'key')
+
+    def __init__(self, func):
+        self.func = func
+        # bound methods are compared by the identity of their object, so lists and dicts can own batch listeners
+        bound_to = getattr(func, '__self__', None)
+        if bound_to is None:
+            self.key = (None, func)
+        else:
+            self.key = (id(bound_to), getattr(func, 'im_func', func.__name__))
+
+    def __call__(self, msg):
+        return self.func([msg])
+
+    def __eq__(self, other):
+        return isinstance(other, BatchListener) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return "BatchListener(" + repr(self.func) + ")"
+
+
+PREDICATE_OPS = ('$in', '$prefix', '$range')  # in the order we prefer to anchor subscriptions on them
+
+
+class Predicate(dict):
+    """
+    A topic value that matches by prefix, set membership or numeric range instead of equality.  It's still the
+    JSON object it was written as, so it can be sent to other brokers, but it's hashable so the broker can file it
+    like any other topic value
+    """
+    __slots__ = ('op', 'arg', 'test', '_key')
+
+    def __init__(self, spec):
+        """
+        :param spec: a one key dict, e.g. {'$prefix': 'subsystem3/'}
+        :raise ValueError if spec isn't a valid predicate
+        """
+        if not isinstance(spec, dict) or len(spec) != 1:
+            raise ValueError("A topic predicate must have exactly one of " + ", ".join(PREDICATE_OPS) + ": " +
+                             str(spec))
+        op, arg = spec.items()[0]
+
+        if op == '$prefix':
+            if not isinstance(arg, basestring):
+                raise ValueError("$prefix must be a string, not " + str(arg))
+            key = arg
+            self.test = self._test_prefix
+        elif op == '$in':
+            if not isinstance(arg, (list, tuple, set, frozenset)):
+                raise ValueError("$in must be a list, not " + str(arg))
+            try:
+                key = frozenset(arg)
+            except TypeError:
+                raise ValueError("$in values must be strings or numbers: " + str(arg))
+            arg = list(arg)
+            self.test = self._test_in
+        elif op == '$range':
+            if not isinstance(arg, (list, tuple)) or len(arg) != 2 or \
+                    not all(x is None or _is_number(x) for x in arg):
+                raise ValueError("$range must be [low, high], with null for no bound, not " + str(arg))
+            key = tuple(arg)
+            arg = list(arg)
+            self.test = self._test_range
+        else:
+            raise ValueError("Unknown topic predicate " + str(op) + ". Use one of " + ", ".join(PREDICATE_OPS))
+
+        dict.__init__(self, {op: arg})
+        self.op = op
+        self.arg = key
+        self._key = (op, key)
+
+    def _test_prefix(self, value):
+        return isinstance(value, basestring) and value.startswith(self.arg)
+
+    def _test_in(self, value):
+        try:
+            return value in self.arg
+        except TypeError:
+            return False
+
+    def _test_range(self, value):
+        low, high = self.arg
+        return _is_number(value) and (low is None or value >= low) and (high is None or value <= high)
+
+    def __eq__(self, other):
+        return isinstance(other, Predicate) and self._key == other._key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key)
+
+
+def _is_number(value):
+    return isinstance(value, numbers.Number) and not isinstance(value, bool)
+
+
+def prefix(value_prefix):
+    """
+    Topic predicate for string values that start with value_prefix. e.g. subscribe(fn, FROM=prefix("sub3/"))
+    """
+    return Predicate({'$prefix': value_prefix})
+
+
+def one_of(*values):
+    """
+    Topic predicate for any of values. e.g. subscribe(fn, MSG_STATUS=one_of("ERROR", "WARNING"))
+    """
+    return Predicate({'$in': list(values)})
+
+
+def between(low=None, high=None):
+    """
+    Topic predicate for numbers from low to high, inclusive. None for no bound
+    """
+    return Predicate({'$range': [low, high]})
+
+
+def compile_topics(topics):
+    """
+    Turn the predicates (JSON objects) in subscription topics into Predicates
+    :raise ValueError if a predicate isn't valid
+    :rtype: dict
+    """
+    return dict((k, Predicate(v) if isinstance(v, dict) and not isinstance(v, Predicate) else v)
+                for k, v in topics.iteritems())
+
+
+def topics_match(topics, msg_topics):
+    """
+    :param topics: compiled subscription topics
+    :param msg_topics: the TOPICS of a message
+    :return: True if every subscription topic matches
+    """
+    for k, v in topics.iteritems():
+        if k not in msg_topics:
+            return False
+        if isinstance(v, Predicate):
+            if not v.test(msg_topics[k]):
+                return False
+        elif msg_topics[k] != v:
+            return False
+    return True
+
+
+class Subscription(object):
+    """
+    A single subscription: the exact topics that must all match and every (func, owner) listener registered
+    on those topics.
+    """
+    __slots__ = ('topics', 'listeners', 'anchor', 'rest')
+
+    def __init__(self, topics):
+        """
+        :param topics: The key/value pairs that must **all** be in a message's TOPICS for it to match. Values can be
+        Predicates (see compile_topics)
+        :type topics: dict
+        """
+        self.topics = topics
+        # a tuple (not a set) so the broker can iterate it while listeners subscribe and unsubscribe
+        self.listeners = ()
+        self.anchor = None  # (key, value) this subscription is filed under in the index
+        self.rest = ()  # the other (key, value, Predicate test or None) that still need checking
+
+    def add(self, func, owner):
+        """
+        Add a listener. Adding the same (func, owner) twice has no effect
+        :return: True if the listener was added
+        """
+        entry = (func, owner)
+        if entry in self.listeners:
+            return False
+        self.listeners += (entry,)
+        return True
+
+    def remove_owner(self, owner):
+        """
+        Remove every listener owned by 'owner'
+        :return: True if any listener was removed
+        """
+        remaining = tuple(x for x in self.listeners if x[1] != owner)
+        removed = len(remaining) != len(self.listeners)
+        self.listeners = remaining
+        return removed
+
+    def remove_listener(self, func):
+        """
+        Remove every listener that is (or wraps) func, whatever its owner
+        :return: the (func, owner) entries removed
+        """
+        removed = tuple(x for x in self.listeners if x[0] == func or getattr(x[0], 'func', None) == func)
+        if len(removed) > 0:
+            self.listeners = tuple(x for x in self.listeners if x not in removed)
+        return removed
+
+    def matches(self, topics):
+        """
+        Check the pairs that aren't covered by the index lookup
+        :type topics: dict
+        """
+        for k, v, test in self.rest:
+            if k not in topics:
+                return False
+            if test is None:
+                if topics[k] != v:
+                    return False
+            elif not test(topics[k]):
+                return False
+        return True
+
+    def __len__(self):
+        return len(self.listeners)
+
+    def __repr__(self):
+        return "Subscription(" + repr(self.topics) + ", " + str(len(self.listeners)) + " listeners)"
+
+
+class SubscriptionIndex(object):
+    """
+    Inverted index from topic key/value pairs to the subscriptions filed under them.
+    Only subscriptions that have at least one listener should be in the index.
+    """
+
+    DIRECT_KEY = 'TO'
+
+    def __init__(self):
+        self._catch_all = None  # the subscription with no topics, it matches everything
+        self._direct = {}  # dict: K->V = TO value -> subscription on exactly {TO: value}
+        self._postings = {}  # dict: K->V = topic key -> {topic value -> [subscriptions anchored there]}
+        self._prefixes = {}  # dict: K->V = topic key -> {prefix -> [subscriptions anchored on that $prefix]}
+        self._prefix_lengths = {}  # dict: K->V = topic key -> {prefix length -> number of prefixes that long}
+        self._ranges = {}  # dict: K->V = topic key -> [subscriptions anchored on a $range of it]
+        self._predicate_anchored = set()  # every subscription anchored on a Predicate
+
+    def add(self, sub):
+        """
+        File a subscription in the index
+        :type sub: Subscription
+        """
+        topics = sub.topics
+        if len(topics) == 0:
+            self._catch_all = sub
+            return
+
+        if len(topics) == 1 and self.DIRECT_KEY in topics and not isinstance(topics[self.DIRECT_KEY], Predicate):
+            sub.anchor = (self.DIRECT_KEY, topics[self.DIRECT_KEY])
+            sub.rest = ()
+            self._direct[sub.anchor[1]] = sub
+            return
+
+        anchor_key = self._choose_anchor(topics)
+        anchor = topics[anchor_key]
+        sub.anchor = (anchor_key, anchor)
+        sub.rest = tuple((k, v, v.test if isinstance(v, Predicate) else None)
+                         for k, v in sorted(topics.items()) if k != anchor_key)
+        if not isinstance(anchor, Predicate):
+            self._postings.setdefault(anchor_key, {}).setdefault(anchor, []).append(sub)
+            return
+
+        self._predicate_anchored.add(sub)
+        if anchor.op == '$in':
+            # filed under each of its values, so it's found like an exact subscription
+            for value in anchor.arg:
+                self._postings.setdefault(anchor_key, {}).setdefault(value, []).append(sub)
+        elif anchor.op == '$prefix':
+            self._prefixes.setdefault(anchor_key, {}).setdefault(anchor.arg, []).append(sub)
+            lengths = self._prefix_lengths.setdefault(anchor_key, {})
+            lengths[len(anchor.arg)] = lengths.get(len(anchor.arg), 0) + 1
+        else:
+            self._ranges.setdefault(anchor_key, []).append(sub)
+
+    def remove(self, sub):
+        """
+        Remove a subscription from the index (no-op if it isn't there)
+        :type sub: Subscription
+        """
+        if len(sub.topics) == 0:
+            if self._catch_all is sub:
+                self._catch_all = None
+            return
+
+        if sub.anchor is None:
+            return
+
+        k, v = sub.anchor
+        sub.anchor = None
+        if len(sub.topics) == 1 and k == self.DIRECT_KEY and not isinstance(v, Predicate):
+            if self._direct.get(v) is sub:
+                del self._direct[v]
+            return
+
+        if not isinstance(v, Predicate):
+            self._unfile(self._postings, k, v, sub)
+            return
+
+        self._predicate_anchored.discard(sub)
+        if v.op == '$in':
+            for value in v.arg:
+                self._unfile(self._postings, k, value, sub)
+        elif v.op == '$prefix':
+            if self._unfile(self._prefixes, k, v.arg, sub):
+                lengths = self._prefix_lengths[k]
+                lengths[len(v.arg)] -= 1
+                if lengths[len(v.arg)] == 0:
+                    del lengths[len(v.arg)]
+                if len(lengths) == 0:
+                    del self._prefix_lengths[k]
+        else:
+            subs = self._ranges.get(k, [])
+            if sub in subs:
+                subs.remove(sub)
+            if len(subs) == 0 and k in self._ranges:
+                del self._ranges[k]
+
+    @staticmethod
+    def _unfile(table, k, v, sub):
+        """
+        Take sub out of table[k][v], and don't leave empty buckets around for _publish to look at
+        :return: True if it was there
+        """
+        by_value = table.get(k, {})
+        bucket = by_value.get(v, [])
+        found = sub in bucket
+        if found:
+            bucket.remove(sub)
+        if len(bucket) == 0 and v in by_value:
+            del by_value[v]
+        if len(by_value) == 0 and k in table:
+            del table[k]
+        return found
+
+    def match(self, topics):
+        """
+        Get every subscription that matches a message's topics
+        :param topics: the TOPICS of the message being published
+        :type topics: dict
+        :rtype: list
+        """
+        matched = []
+        if self._catch_all is not None:
+            matched.append(self._catch_all)
+
+        # DIRECT fast path
+        if self.DIRECT_KEY in topics:
+            try:
+                sub = self._direct.get(topics[self.DIRECT_KEY])
+            except TypeError:  # unhashable values can't match anything
+                sub = None
+            if sub is not None:
+                matched.append(sub)
+
+        postings = self._postings
+        for k, v in topics.iteritems():
+            by_value = postings.get(k)
+            if by_value is None:
+                continue
+            try:
+                candidates = by_value.get(v)
+            except TypeError:  # unhashable values can't match anything
+                continue
+            if candidates:
+                for sub in candidates:
+                    if sub.matches(topics):
+                        matched.append(sub)
+
+        # only look at the keys that have $prefix or $range subscriptions anchored on them
+        for k, by_prefix in self._prefixes.iteritems():
+            v = topics.get(k, None)
+            if not isinstance(v, basestring):
+                continue
+            for length in self._prefix_lengths[k]:
+                if length > len(v):
+                    continue  # v[:length] would be all of v, and find the shorter prefix's subscriptions again
+                candidates = by_prefix.get(v[:length])
+                if candidates:
+                    for sub in candidates:
+                        if sub.matches(topics):
+                            matched.append(sub)
+
+        for k, subs in self._ranges.iteritems():
+            if k not in topics:
+                continue
+            v = topics[k]
+            for sub in subs:
+                if sub.anchor[1].test(v) and sub.matches(topics):
+                    matched.append(sub)
+
+        return matched
+
+    def _choose_anchor(self, topics):
+        """
+        Pick the key to file a multi-key subscription under. TO is the most selective key in Parlay traffic, so
+        prefer it, otherwise take the key with the least subscriptions already filed under its value. Exact values
+        are preferred to predicates, and $in (filed under its values) to $prefix to $range
+        """
+        exact = [k for k in sorted(topics.keys()) if not isinstance(topics[k], Predicate)]
+        if len(exact) == 0:
+            def selectivity(k):
+                p = topics[k]
+                return PREDICATE_OPS.index(p.op), len(p.arg) if p.op == '$in' else 0
+            return min(sorted(topics.keys()), key=selectivity)
+
+        if self.DIRECT_KEY in exact:
+            return self.DIRECT_KEY
+
+        def bucket_size(k):
+            return len(self._postings.get(k, {}).get(topics[k], ()))
+
+        return min(exact, key=bucket_size)
+
+    def subscriptions(self):
+        """
+        Generate every subscription in the index
+        """
+        if self._catch_all is not None:
+            yield self._catch_all
+        for sub in self._direct.itervalues():
+            yield sub
+        for by_value in self._postings.itervalues():
+            for bucket in by_value.itervalues():
+                for sub in bucket:
+                    if not isinstance(sub.anchor[1], Predicate):  # a $in is filed more than once
+                        yield sub
+        for sub in self._predicate_anchored:
+            yield sub
+
+    def __len__(self):
+        total = len(self._direct) + len(self._predicate_anchored) + (1 if self._catch_all is not None else 0)
+        for by_value in self._postings.itervalues():
+            for bucket in by_value.itervalues():
+                total += sum(1 for sub in bucket if not isinstance(sub.anchor[1], Predicate))
+        return total
+
+
+class InterestTable(object):
+    """
+    The topics a remote process or broker has subscribers for, so we only send it messages it can use.
+    Unlike the broker's own index there are no listeners, just the set of subscribed topics
+    """
+
+    def __init__(self):
+        self._index = SubscriptionIndex()
+        self._subs = {}  # dict: K->V = sorted topic items -> Subscription in self._index
+
+    def add(self, topics):
+        """
+        :type topics: dict
+        :raise ValueError if topics has a predicate that isn't valid
+        """
+        topics = compile_topics(topics)
+        key = tuple(sorted(topics.items()))
+        if key not in self._subs:
+            sub = Subscription(topics)
+            self._subs[key] = sub
+            self._index.add(sub)
+
+    def remove(self, topics):
+        """
+        :type topics: dict
+        """
+        try:
+            topics = compile_topics(topics)
+        except ValueError:
+            return  # never added
+        sub = self._subs.pop(tuple(sorted(topics.items())), None)
+        if sub is not None:
+            self._index.remove(sub)
+
+    def wants(self, topics):
+        """
+        :param topics: the TOPICS of a message
+        :return: True if any subscribed topics match
+        """
+        return len(self._index.match(topics)) > 0
+
+    def topics(self):
+        return [sub.topics for sub in self._subs.itervalues()]
+
+    def __len__(self):
+        return len(self._subs)
@@ -0,0 +1,170 @@
+"""
+Per-subscription delivery rate limits.
+
+A subscriber that only needs a few updates a second (a UI plot at 10 Hz) can subscribe with a maximum rate:
+subscribe(..., _max_rate_hz_=10) from Python, or 'MAX_RATE_HZ': 10 in a subscribe message's CONTENTS.  Stream
+samples and property values that match the subscription are then held and coalesced per (FROM, STREAM/PROPERTY),
+and delivered at most once per 1 / rate seconds.  Everything else that matches (commands, responses, events) is
+delivered right away.
+
+How held values are coalesced ('COALESCE' / _coalesce_):
+    latest  the last message (the default)
+    mean    the last message, with VALUE the mean of the numeric VALUEs held and COUNT how many there were
+    minmax  the last message, with MIN, MAX and COUNT of the numeric VALUEs held
+
+Every subscriber with the same rate shares one timer, so a high rate producer costs a low rate consumer an append
+per message and nothing else.
+"""
+from collections import OrderedDict
+import numbers
+
+from parlay.server.dispatch import message_priority
+from parlay.server.retained import retain_key
+
+COALESCE_MODES = ('latest', 'mean', 'minmax')
+
+# the kinds of retain_key() whose messages are held and coalesced
+_THROTTLED_KINDS = ('STREAM', 'PROPERTY')
+
+
+def _number(value):
+    return isinstance(value, numbers.Number) and not isinstance(value, bool)
+
+
+class ThrottledListener(object):
+    """
+    Wraps a listener so stream samples and property values reach it at most rate_hz times a second per stream or
+    property
+    """
+    __slots__ = ('func', 'rate_hz', 'coalesce', 'key', 'active', '_throttle', '_pending')
+
+    def __init__(self, func, rate_hz, coalesce, throttle):
+        self.func = func
+        self.rate_hz = rate_hz
+        self.coalesce = coalesce
+        self.active = True
+        self._throttle = throttle
+        self._pending = OrderedDict()  # dict: K->V = (FROM, kind, name) -> [last message, count, sum, min, max]
+        # the same func with the same rate is the same listener, like BatchListener
+        bound_to = getattr(func, '__self__', None)
+        if bound_to is None:
+            func_key = (None, func)
+        else:
+            func_key = (id(bound_to), getattr(func, 'im_func', func.__name__))
+        self.key = (func_key, rate_hz, coalesce)
+
+    def __call__(self, msg):
+        try:
+            key = retain_key(msg)
+        except TypeError:
+            key = None
+        if key is None or key[1] not in _THROTTLED_KINDS:
+            return self.func(msg)
+        if not self.active:
+            return
+
+        value = msg['CONTENTS'].get('VALUE', None)
+        try:
+            held = self._pending.get(key, None)
+        except TypeError:  # unhashable name
+            return self.func(msg)
+        if held is None:
+            if len(self._pending) == 0:
+                self._throttle.hold(self)
+            self._pending[key] = [msg, 1, value, value, value]
+            return
+        held[0] = msg
+        held[1] += 1
+        if self.coalesce != 'latest' and _number(value) and _number(held[2]):
+            held[2] += value
+            held[3] = min(held[3], value)
+            held[4] = max(held[4], value)
+        else:
+            held[2] = held[3] = held[4] = None  # not all numbers, so just the latest
+
+    def flush(self):
+        """
+        :return: the coalesced messages held since the last flush
+        """
+        pending = self._pending
+        self._pending = OrderedDict()
+        if not self.active:
+            return []
+
+        msgs = []
+        for msg, count, total, low, high in pending.itervalues():
+            if count == 1 or self.coalesce == 'latest' or total is None:
+                msgs.append(msg)  # untouched, so it keeps its shared encoding
+                continue
+            contents = dict(msg['CONTENTS'])
+            contents['COUNT'] = count
+            if self.coalesce == 'mean':
+                contents['VALUE'] = float(total) / count
+            else:
+                contents['MIN'] = low
+                contents['MAX'] = high
+            msgs.append({'TOPICS': msg['TOPICS'], 'CONTENTS': contents})
+        return msgs
+
+    def cancel(self):
+        """
+        Stop delivering, the listener has been unsubscribed
+        """
+        self.active = False
+        self._pending.clear()
+
+    def __eq__(self, other):
+        return isinstance(other, ThrottledListener) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return "ThrottledListener(" + repr(self.func) + ", " + str(self.rate_hz) + " Hz, " + self.coalesce + ")"
+
+
+class RateThrottle(object):
+    """
+    The broker's rate buckets: one timer per rate for every throttled listener holding messages
+    """
+
+    def __init__(self, broker):
+        self._broker = broker
+        self._buckets = {}  # dict: K->V = rate in Hz -> [listeners holding messages, timer or None]
+        self.flushes = 0
+
+    def listener(self, func, rate_hz, coalesce='latest'):
+        """
+        :return: a ThrottledListener for func
+        :raise ValueError if rate_hz or coalesce isn't valid
+        """
+        if coalesce not in COALESCE_MODES:
+            raise ValueError("COALESCE must be one of " + ", ".join(COALESCE_MODES) + ", not " + str(coalesce))
+        if not isinstance(rate_hz, numbers.Number) or rate_hz <= 0:
+            raise ValueError("MAX_RATE_HZ must be a positive number, not " + str(rate_hz))
+        return ThrottledListener(func, float(rate_hz), coalesce, self)
+
+    def hold(self, listener):
+        """
+        A listener started holding messages. Flush it on its bucket's next tick
+        """
+        bucket = self._buckets.get(listener.rate_hz, None)
+        if bucket is None:
+            bucket = self._buckets[listener.rate_hz] = [[], None]
+        bucket[0].append(listener)
+        if bucket[1] is None:
+            bucket[1] = self._broker.reactor.callLater(1.0 / listener.rate_hz, self._tick, listener.rate_hz)
+
+    def _tick(self, rate_hz):
+        bucket = self._buckets.pop(rate_hz)
+        schedule = self._broker._dispatcher.schedule
+        self.flushes += 1
+        for listener in bucket[0]:
+            for msg in listener.flush():
+                schedule(message_priority(msg), msg, [listener.func])
+
+    def get_stats(self):
+        return {'buckets': sorted(self._buckets.keys()), 'flushes': self.flushes}
@@ -0,0 +1,236 @@
+"""
+Persistent traffic logs: every message the Broker publishes, written to disk so it can be replayed later.
+
+A traffic log is two files:
+
+    <path>       An append-only data file.  A header (MAGIC, then the codec name) followed by one record per
+                 message: a little endian double timestamp, an unsigned 32 bit length and the encoded message.
+    <path>.idx   An index of fixed size (timestamp, offset) entries, one per record, so a reader can memory map it
+                 and binary search for a point in time instead of scanning the whole data file.
+
+Messages are encoded when they're recorded, on the reactor thread, so the log holds each message as it was
+published and not whatever routing and listeners made of it later.  Writing happens on a background thread, so
+recording never blocks the reactor on disk.  If the writer falls too far behind, new messages are dropped (and
+counted) instead of growing the backlog without limit.
+A log that was cut short by a crash can still be read up to its last complete record.
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+import Queue
+
+from parlay.server.envelope import encode_message
+from parlay.server.message_codecs import get_codec
+
+MAGIC = "PRLYLOG1"
+CODEC_NAME_LENGTH = 8
+HEADER = struct.Struct("<8s8s")  # MAGIC, codec name (null padded)
+RECORD_HEADER = struct.Struct("<dI")  # timestamp, length of the encoded message
+INDEX_ENTRY = struct.Struct("<dQ")  # timestamp, offset of the record in the data file
+INDEX_SUFFIX = ".idx"
+
+_STOP = object()  # tells the writer thread to finish up
+
+
+class TrafficLogError(Exception):
+    pass
+
+
+class TrafficRecorder(object):
+    """
+    Writes published messages to a traffic log on a background thread
+    """
+
+    MAX_BACKLOG = 100000  # messages waiting to be written before we start dropping them
+
+    def __init__(self, path, codec='json', max_backlog=MAX_BACKLOG):
+        """
+        :param path: the data file to write. Appends if it is already a traffic log written with the same codec
+        :param codec: name of the codec to encode messages with (see parlay.server.message_codecs)
+        :param max_backlog: the most messages to hold for the writer thread
+        """
+        get_codec(codec)  # fail now if we can't encode with it
+        if len(codec) > CODEC_NAME_LENGTH:
+            raise TrafficLogError("Codec name " + codec + " is too long for a traffic log header")
+        self.path = path
+        self.codec = codec
+
+        self._data = open(path, 'ab')
+        self._data.seek(0, os.SEEK_END)
+        if self._data.tell() == 0:
+            self._data.write(HEADER.pack(MAGIC, codec))
+        else:
+            existing_codec = read_header(path)
+            if existing_codec != codec:
+                self._data.close()
+                raise TrafficLogError(path + " was recorded with " + existing_codec + ", not " + codec)
+        self._index = open(path + INDEX_SUFFIX, 'ab')
+
+        self._queue = Queue.Queue(maxsize=max_backlog)
+        self._thread = threading.Thread(target=self._write_loop, name="Parlay traffic recorder")
+        self._thread.daemon = True
+        self._closed = False
+
+        # counters
+        self.recorded = 0
+        self.dropped = 0
+        self.errors = 0
+
+        self._thread.start()
+
+    def record(self, msg):
+        """
+        Encode a message and queue it to be written. Never blocks on disk
+        """
+        if self._closed:
+            return
+        if self._queue.full():
+            self.dropped += 1
+            return
+        try:
+            # now, before it's routed. The broker and its listeners may change the message (and its TOPICS) later
+            encoded = encode_message(msg, self.codec)
+        except Exception as e:
+            print "Could not record message in traffic log: " + str(e)
+            self.errors += 1
+            return
+        try:
+            self._queue.put_nowait((time.time(), encoded))
+        except Queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout=5):
+        """
+        Write everything that's been queued and close the files
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def _write_loop(self):
+        data, index, queue = self._data, self._index, self._queue
+        try:
+            while True:
+                item = queue.get()
+                if item is _STOP:
+                    break
+
+                timestamp, encoded = item
+                offset = data.tell()
+                data.write(RECORD_HEADER.pack(timestamp, len(encoded)))
+                data.write(encoded)
+                index.write(INDEX_ENTRY.pack(timestamp, offset))
+                self.recorded += 1
+
+                # only touch the disk when we've caught up
+                if queue.empty():
+                    data.flush()
+                    index.flush()
+        finally:
+            data.close()
+            index.close()
+
+    def get_stats(self):
+        return {'path': self.path, 'codec': self.codec, 'recorded': self.recorded, 'backlog': self._queue.qsize(),
+                'dropped': self.dropped, 'errors': self.errors}
+
+
+def read_header(path):
+    """
+    :return: the name of the codec a traffic log was recorded with
+    """
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise TrafficLogError(path + " is not a traffic log (too short)")
+    magic, codec = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise TrafficLogError(path + " is not a traffic log")
+    return codec.rstrip("\0")
+
+
+class TrafficLogReader(object):
+    """
+    Reads the messages in a traffic log, optionally starting from a point in time
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.codec = get_codec(read_header(path))
+        self._data = open(path, 'rb')
+
+        # the index is optional, without it we just can't seek
+        self._index_file = None
+        self._index = None
+        index_path = path + INDEX_SUFFIX
+        if os.path.exists(index_path) and os.path.getsize(index_path) >= INDEX_ENTRY.size:
+            self._index_file = open(index_path, 'rb')
+            self._index = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        """
+        Number of indexed records
+        """
+        if self._index is None:
+            return 0
+        return len(self._index) // INDEX_ENTRY.size
+
+    def _index_entry(self, i):
+        return INDEX_ENTRY.unpack_from(self._index, i * INDEX_ENTRY.size)
+
+    def offset_for_time(self, timestamp):
+        """
+        Binary search the index for the first record at or after timestamp
+        :return: offset of that record in the data file, or None if there is no such record
+        """
+        if self._index is None:
+            raise TrafficLogError("No index for " + self.path + ", can't seek")
+
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._index_entry(mid)[0] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(self):
+            return None
+        return self._index_entry(lo)[1]
+
+    def records(self, start_time=None):
+        """
+        Generate (timestamp, message) tuples in the order they were recorded
+        :param start_time: skip records before this timestamp
+        """
+        if start_time is None:
+            offset = HEADER.size
+        else:
+            offset = self.offset_for_time(start_time)
+            if offset is None:
+                return
+
+        data = self._data
+        data.seek(offset)
+        decode = self.codec.decode
+        while True:
+            header = data.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return  # end of the log (or a record cut short by a crash)
+            timestamp, length = RECORD_HEADER.unpack(header)
+            encoded = data.read(length)
+            if len(encoded) < length:
+                return
+            yield timestamp, decode(encoded)
+
+    def __iter__(self):
+        return self.records()
+
+    def close(self):
+        if self._index is not None:
+            self._index.close()
+            self._index_file.close()
+        self._data.close()
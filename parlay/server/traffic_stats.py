@@ -0,0 +1,152 @@
+"""
+Always-on traffic counters for the Broker, to find the item that is flooding it.
+
+For every (FROM, MSG_TYPE) the broker publishes it counts messages, estimates bytes and keeps per second counts for
+the last minute, so it can report 1 s, 10 s and 60 s rates.  For every TO it counts messages and how many listeners
+they were delivered to (the fan-out).  Recording a message is a couple of dict lookups and integer adds.
+
+Bytes are estimated by encoding one of every SAMPLE_EVERY messages per (FROM, MSG_TYPE) as JSON and scaling the
+average by the message count.  The sample isn't cached on the message: stats are recorded before the listeners run,
+and one of them changing the message afterwards would leave subscribers sending out the bytes we measured.
+
+Get the stats with the 'get_traffic_stats' broker request.  Its 'table' is the same rows as 'publishers' in a
+column/row layout, noisiest first, for the UI to show as is.
+"""
+import time
+
+from parlay.server.message_codecs import JSON
+
+# the windows rates are reported for, in seconds
+RATE_WINDOWS = (1, 10, 60)
+_HISTORY = max(RATE_WINDOWS) + 1  # the whole seconds rates are taken over, and the current one
+
+TABLE_COLUMNS = ['FROM', 'MSG_TYPE', 'messages', 'bytes', 'rate_1s', 'rate_10s', 'rate_60s']
+
+
+class _PublisherCounter(object):
+    """
+    Counts for one (FROM, MSG_TYPE)
+    """
+    __slots__ = ('messages', 'sampled', 'sampled_bytes', 'second', 'per_second')
+
+    def __init__(self, second):
+        self.messages = 0
+        self.sampled = 0
+        self.sampled_bytes = 0
+        self.second = second  # the second per_second[-1] counts
+        self.per_second = [0] * _HISTORY  # messages in each of the last _HISTORY seconds, oldest first
+
+    def advance(self, second):
+        """
+        Move the per second counts on to 'second'
+        """
+        elapsed = second - self.second
+        if elapsed <= 0:
+            return
+        if elapsed >= _HISTORY:
+            self.per_second = [0] * _HISTORY
+        else:
+            self.per_second = self.per_second[elapsed:] + [0] * elapsed
+        self.second = second
+
+    def rate(self, window):
+        """
+        :return: messages per second over the last 'window' whole seconds
+        """
+        return float(sum(self.per_second[-window - 1:-1])) / window
+
+    def bytes(self):
+        if self.sampled == 0:
+            return 0
+        return int(float(self.sampled_bytes) / self.sampled * self.messages)
+
+
+class TrafficStats(object):
+    """
+    Message, byte and fan-out counters for everything the broker publishes
+    """
+
+    SAMPLE_EVERY = 16
+
+    def __init__(self, clock=time.time):
+        """
+        :param clock: function that returns the time in seconds
+        """
+        self._clock = clock
+        self._publishers = {}  # dict: K->V = (FROM, MSG_TYPE) -> _PublisherCounter
+        self._destinations = {}  # dict: K->V = TO -> [messages, deliveries]
+        self.messages = 0
+        self.deliveries = 0
+        self.since = clock()
+
+    def record(self, msg, fan_out):
+        """
+        Count a published message
+        :param msg: the message
+        :param fan_out: how many listeners it was delivered to
+        """
+        topics = msg['TOPICS']
+        self.messages += 1
+        self.deliveries += fan_out
+        second = int(self._clock())
+        try:
+            key = (topics.get('FROM', None), topics.get('MSG_TYPE', None))
+            counter = self._publishers.get(key, None)
+            if counter is None:
+                counter = self._publishers[key] = _PublisherCounter(second)
+            to = topics.get('TO', None)
+            destination = self._destinations.get(to, None)
+            if destination is None:
+                destination = self._destinations[to] = [0, 0]
+        except TypeError:  # an unhashable FROM, MSG_TYPE or TO
+            return
+        destination[0] += 1
+        destination[1] += fan_out
+
+        counter.advance(second)
+        counter.per_second[-1] += 1
+        counter.messages += 1
+        if counter.messages % self.SAMPLE_EVERY == 1:
+            try:
+                counter.sampled_bytes += len(JSON.encode(msg))
+                counter.sampled += 1
+            except (TypeError, ValueError):
+                pass  # not JSON encodable, so it never leaves the broker anyway
+
+    def reset(self):
+        self._publishers.clear()
+        self._destinations.clear()
+        self.messages = 0
+        self.deliveries = 0
+        self.since = self._clock()
+
+    def get_publishers(self, top=None):
+        """
+        :param top: only the 'top' noisiest publishers, or None for all of them
+        :return: list of per (FROM, MSG_TYPE) stats dicts, highest 1 s rate (then message count) first
+        """
+        second = int(self._clock())
+        rows = []
+        for (from_, msg_type), counter in self._publishers.iteritems():
+            counter.advance(second)
+            row = {'FROM': from_, 'MSG_TYPE': msg_type, 'messages': counter.messages, 'bytes': counter.bytes()}
+            for window in RATE_WINDOWS:
+                row['rate_' + str(window) + 's'] = counter.rate(window)
+            rows.append(row)
+        rows.sort(key=lambda r: (r['rate_1s'], r['rate_10s'], r['messages']), reverse=True)
+        return rows if top is None else rows[:top]
+
+    def get_destinations(self):
+        """
+        :return: list of per TO stats dicts, most deliveries first
+        """
+        rows = [{'TO': to, 'messages': messages, 'deliveries': deliveries}
+                for to, (messages, deliveries) in self._destinations.iteritems()]
+        rows.sort(key=lambda r: (r['deliveries'], r['messages']), reverse=True)
+        return rows
+
+    def get_stats(self, top=None):
+        publishers = self.get_publishers(top)
+        return {'since': self.since, 'messages': self.messages, 'deliveries': self.deliveries,
+                'publishers': publishers, 'destinations': self.get_destinations(),
+                'table': {'columns': TABLE_COLUMNS, 'rows': [[row[c] for c in TABLE_COLUMNS] for row in publishers]}}
@@ -30,6 +30,13 @@ class PropertyTest(unittest.TestCase, AdapterMixin, ReactorMixin):
         self.prop_item.simple_property = "5"
         self.assertEqual(self.prop_item.simple_property, 5)
 
+    def testCachedPropertyOverNonPyAdapter(self):
+        CachedPropertyTestItem("CACHED_PROPERTY_ITEM", "CACHED_PROPERTY_ITEM", reactor=self.reactor,
+                               adapter=self.adapter)
+        self.assertEqual(self.adapter.last_published,
+                         {"TOPICS": {"type": "broker", "request": "get_property_coalescing"},
+                          "CONTENTS": {"ID": "CACHED_PROPERTY_ITEM", "PROPERTY": "speed", "ttl": 2}})
+
     def testCustomRWProp(self):
         # make sure we're clean
         self.assertEqual(PropertyTestItem.custom_list, [])
@@ -116,6 +123,14 @@ class PropertyTestItem(parlay_standard.ParlayCommandItem):
                                                        custom_write=lambda self, x: PropertyTestItem.custom_list.append(x))
 
 
+class CachedPropertyTestItem(parlay_standard.ParlayCommandItem):
+    """
+    Helper class to test properties the broker may cache
+    """
+
+    speed = parlay_standard.ParlayProperty(val_type=int, cache_ttl=2)
+
+
 class CommandTestItem(parlay_standard.ParlayCommandItem):
     """
     Helper class to test custom commands
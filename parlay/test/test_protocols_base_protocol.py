@@ -75,3 +75,17 @@ class BaseProtocolTest(unittest.TestCase, ReactorMixin):
 
     def tearDown(self):
         pass
+
+    def testLazyDiscovery(self):
+        from parlay.items.base import BaseItem
+        parent = BaseItem("lazy_parent", "Lazy Parent")
+        child = BaseItem("lazy_child", "Lazy Child", parents=parent)
+        self.protocol.items = [parent]
+
+        trees = []
+        self.protocol.get_discovery_tree().addCallback(trees.append)
+        self.assertEqual(trees[0]['CHILDREN'][0]['ID'], "lazy_parent")
+        self.assertEqual(trees[0]['CHILDREN'][0]['CHILDREN'][0]['NAME'], "Lazy Child")
+
+        self.assertEqual(self.protocol.get_item_discovery("lazy_child"), child.get_discovery())
+        self.assertEqual(self.protocol.get_item_discovery("not_an_item"), None)
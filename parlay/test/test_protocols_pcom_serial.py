@@ -0,0 +1,42 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from parlay.items.parlay_standard import ParlayStandardItem, INPUT_TYPES
+from parlay.protocols.pcom.pcom_serial import PCOMSerial
+
+
+class LazyDiscoveryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = PCOMSerial(None, None)
+        self.item = ParlayStandardItem(item_id=300, name="PUMP")
+        self.protocol.items = [self.item]
+        self.protocol._undetailed_items[300] = self.item
+        self.fetches = []  # Deferreds of the detail fetches that were started
+        self.protocol._get_item_details = self.get_item_details
+
+    def get_item_details(self, item_id, parlay_item):
+        d = defer.Deferred()
+        d.addCallback(lambda _: parlay_item.add_property('speed', input=INPUT_TYPES.NUMBER))
+        self.fetches.append(d)
+        return d
+
+    def testRequestsWhileLoadingWaitForDetails(self):
+        results = []
+        for _ in range(2):
+            self.protocol.get_item_discovery(300).addCallback(results.append)
+        self.assertEqual((len(self.fetches), results), (1, []))
+
+        self.fetches[0].callback(None)
+        self.assertEqual([[x['PROPERTY'] for x in r['PROPERTIES']] for r in results], [['speed'], ['speed']])
+        self.protocol.get_item_discovery(300).addCallback(results.append)
+        self.assertEqual(len(self.fetches), 1)
+        self.assertEqual(len(results), 3)
+
+    def testFailedFetchTriedAgain(self):
+        errors = []
+        self.protocol.get_item_discovery(300).addErrback(errors.append)
+        self.fetches[0].errback(IOError("serial timeout"))
+        self.assertEqual(len(errors), 1)
+        self.protocol.get_item_discovery(300)
+        self.assertEqual(len(self.fetches), 2)
@@ -1,10 +1,15 @@
+import sys
+import types
+from StringIO import StringIO
 from twisted.trial import unittest
 from twisted.internet import defer
 from twisted.web import static, server
 from twisted.web.test.requesthelper import DummyChannel
 
+from parlay.server.adapter import Adapter
 from parlay.server.broker import Broker, PARLAY_PATH
 from parlay.server.http_server import CacheControlledSite, FRESHNESS_TIME_SECS
+from parlay.server.envelope import encode_message
 
 
 class BrokerPubSubTests(unittest.TestCase):
@@ -30,6 +35,392 @@ class BrokerPubSubTests(unittest.TestCase):
         self._broker.publish({"TOPICS": {"simple_unit_test": True}, "CONTENTS": {}})
         self.assertTrue(not sub_called.called)
 
+    def testMultiKeyPubSub(self):
+        received = []
+        self._broker.subscribe(received.append, self, TO="multi_key_item", MSG_TYPE="COMMAND")
+        self._broker.publish({"TOPICS": {"TO": "multi_key_item", "MSG_TYPE": "EVENT"}, "CONTENTS": {}})
+        self.assertEqual(len(received), 0)
+        self._broker.publish({"TOPICS": {"TO": "multi_key_item", "MSG_TYPE": "COMMAND", "FROM": "x"}, "CONTENTS": {}})
+        self.assertEqual(len(received), 1)
+
+    def testDirectPubSub(self):
+        received = []
+        self._broker.subscribe(received.append, self, TO="direct_item")
+        self._broker.publish({"TOPICS": {"TO": "direct_item", "MSG_TYPE": "COMMAND"}, "CONTENTS": {}})
+        self._broker.publish({"TOPICS": {"TO": "other_item", "MSG_TYPE": "COMMAND"}, "CONTENTS": {}})
+        self.assertEqual(len(received), 1)
+
+    def testUnsubscribe(self):
+        received = []
+        self._broker.subscribe(received.append, self, TO="unsub_item", MSG_TYPE="COMMAND")
+        self._broker.unsubscribe(self, {"TO": "unsub_item", "MSG_TYPE": "COMMAND"})
+        self._broker.publish({"TOPICS": {"TO": "unsub_item", "MSG_TYPE": "COMMAND"}, "CONTENTS": {}})
+        self.assertEqual(len(received), 0)
+
+    def testUnsubscribeAllPrunesTrie(self):
+        received = []
+        self._broker.subscribe(received.append, self, prune_test_key="a", prune_test_other="b")
+        self._broker.subscribe(received.append, self, prune_test_key="c")
+        self._broker.unsubscribe_all(self)
+        self._broker.publish({"TOPICS": {"prune_test_key": "a", "prune_test_other": "b"}, "CONTENTS": {}})
+        self.assertEqual(len(received), 0)
+        self.assertNotIn("prune_test_key", self._broker._listeners)
+        self.assertNotIn(self, self._broker._owner_subscriptions)
+
+    def testUnsubscribeKeepsOtherOwners(self):
+        received = []
+        other_owner = object()
+        self._broker.subscribe(received.append, self, prune_test_key="shared")
+        self._broker.subscribe(received.append, other_owner, prune_test_key="shared")
+        self._broker.unsubscribe_all(self)
+        self._broker.publish({"TOPICS": {"prune_test_key": "shared"}, "CONTENTS": {}})
+        self.assertEqual(len(received), 1)
+        self._broker.unsubscribe_all(other_owner)
+        self.assertNotIn("prune_test_key", self._broker._listeners)
+
+    def testSerializeOnce(self):
+        encoded = []
+        def sub_me(msg):
+            encoded.append(encode_message(msg))
+        def sub_me_too(msg):
+            encoded.append(encode_message(msg))
+
+        self._broker.subscribe(sub_me, self, serialize_once_test=True)
+        self._broker.subscribe(sub_me_too, self, serialize_once_test=True)
+        self._broker.publish({"TOPICS": {"serialize_once_test": True}, "CONTENTS": {"VALUE": 1}})
+        self.assertEqual(len(encoded), 2)
+        self.assertIs(encoded[0], encoded[1])
+
+    def testUnhashableTopicValue(self):
+        received = []
+        self._broker.subscribe(received.append, self, TO="unhashable_item")
+        self._broker.publish({"TOPICS": {"TO": "unhashable_item", "LIST_TOPIC": [1, 2]}, "CONTENTS": {}})
+        self._broker.publish({"TOPICS": {"TO": ["unhashable_item"]}, "CONTENTS": {}})
+        self.assertEqual(len(received), 1)
+
+    def testPublishMany(self):
+        batches = []
+        singles = []
+        self._broker.subscribe_batch(batches.append, self, TO="batch_item")
+        self._broker.subscribe(singles.append, self, TO="batch_item")
+        self._broker.publish_many([{"TOPICS": {"TO": "batch_item", "MSG_ID": i}, "CONTENTS": {}} for i in range(3)] +
+                                  [{"TOPICS": {"TO": "other_item"}, "CONTENTS": {}}])
+        self.assertEqual(len(batches), 1)
+        self.assertEqual([x["TOPICS"]["MSG_ID"] for x in batches[0]], [0, 1, 2])
+        self.assertEqual(len(singles), 3)
+
+        # a plain publish gives batch listeners a list of one
+        self._broker.publish({"TOPICS": {"TO": "batch_item"}, "CONTENTS": {}})
+        self.assertEqual(len(batches[1]), 1)
+
+    def testPublishManySubscribeInOrder(self):
+        received = []
+        sub_msg = {"TOPICS": {"type": "subscribe"}, "CONTENTS": {"TOPICS": {"TO": "batch_sub_item"}}}
+        self._broker.publish_many([{"TOPICS": {"TO": "batch_sub_item", "MSG_ID": 0}, "CONTENTS": {}},
+                                   sub_msg,
+                                   {"TOPICS": {"TO": "batch_sub_item", "MSG_ID": 1}, "CONTENTS": {}}],
+                                  types.MethodType(lambda _self, msg: received.append(msg), self))
+        # only the message published after the subscribe is delivered
+        self.assertEqual([x["TOPICS"]["MSG_ID"] for x in received if "MSG_ID" in x["TOPICS"]], [1])
+
+    def testExpectResponse(self):
+        received = []
+        pending = self._broker.expect_response("requester_item", "responder_item", 42, received.append)
+        self._broker.publish({"TOPICS": {"TO": "requester_item", "FROM": "responder_item", "MSG_ID": 41,
+                                         "MSG_TYPE": "RESPONSE", "MSG_STATUS": "OK"}, "CONTENTS": {}})
+        self.assertEqual(len(received), 0)
+        self._broker.publish({"TOPICS": {"TO": "requester_item", "FROM": "responder_item", "MSG_ID": 42,
+                                         "MSG_TYPE": "RESPONSE", "MSG_STATUS": "OK"}, "CONTENTS": {}})
+        self.assertEqual(len(received), 1)
+        self._broker.cancel_response(pending)  # already done, so this does nothing
+
+    def testGetFlightRecorder(self):
+        replies = []
+        self._broker.publish({"TOPICS": {"flight_recorder_test": True}, "CONTENTS": {}})
+        self._broker.publish({"TOPICS": {"type": "broker", "request": "get_flight_recorder"},
+                              "CONTENTS": {"count": 2}}, replies.append)
+        messages = replies[0]["CONTENTS"]["messages"]
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(messages[0]["MSG"]["TOPICS"], {"flight_recorder_test": True})
+
+    def testFlightRecorderKeepsSubscribeRequests(self):
+        class Client(object):
+            def __init__(self):
+                self.received = []
+
+            def on_message(self, msg):
+                self.received.append(msg)
+
+        client = Client()
+        for request in ("subscribe", "unsubscribe"):
+            self._broker.publish({"TOPICS": {"type": request}, "CONTENTS": {"TOPICS": {"TO": "recorded_sub"}}},
+                                 client.on_message)
+            self.assertEqual(client.received[-1]["TOPICS"]["type"], request + "_response")
+            # the recorder has the request as it was published, not the response made from it
+            recorded = self._broker._flight_recorder.dump(1)[0]["MSG"]
+            self.assertEqual(recorded["TOPICS"]["type"], request)
+            self.assertNotIn("status", recorded["CONTENTS"])
+
+    def testLoggedErrorDumpsFlightRecorder(self):
+        stderr = StringIO()
+        self.patch(sys, "stderr", stderr)
+        self.patch(self._broker, "_dump_on_error", True)
+        self.patch(self._broker, "_last_error_dump", None)
+        self._broker.publish({"TOPICS": {"error_dump_test": True}, "CONTENTS": {}})
+        self._broker._error_log_observer({"isError": 0, "message": ("fine",)})
+        self.assertEqual(stderr.getvalue(), "")
+        self._broker._error_log_observer({"isError": 1, "message": ()})
+        self._broker._error_log_observer({"isError": 1, "message": ()})
+        self.assertEqual(stderr.getvalue().count("FLIGHT RECORDER"), 1)
+        self.assertIn("error_dump_test", stderr.getvalue())
+
+    def testGetTrafficStats(self):
+        replies = []
+        self._broker.subscribe(replies.append, self, TO="traffic_sink")
+        for _ in range(3):
+            self._broker.publish({"TOPICS": {"FROM": "noisy_item", "TO": "traffic_sink", "MSG_TYPE": "STREAM"},
+                                  "CONTENTS": {"VALUE": 1}})
+        self._broker.publish({"TOPICS": {"type": "broker", "request": "get_traffic_stats"}, "CONTENTS": {}},
+                             replies.append)
+        stats = replies[-1]["CONTENTS"]
+        noisy = [x for x in stats["publishers"] if x["FROM"] == "noisy_item"][0]
+        self.assertEqual((noisy["MSG_TYPE"], noisy["messages"]), ("STREAM", 3))
+        self.assertTrue(noisy["bytes"] > 0)
+        sink = [x for x in stats["destinations"] if x["TO"] == "traffic_sink"][0]
+        self.assertEqual((sink["messages"], sink["deliveries"]), (3, 3))
+        self.assertEqual(len(stats["table"]["rows"]), len(stats["publishers"]))
+
+    def testGetDispatchStats(self):
+        replies = []
+        budget = self._broker._dispatcher.budget
+        self._broker.publish({"TOPICS": {"type": "broker", "request": "get_dispatch_stats"},
+                              "CONTENTS": {"budget": 0.5}}, replies.append)
+        self._broker.publish({"TOPICS": {"type": "broker", "request": "get_dispatch_stats"},
+                              "CONTENTS": {"budget": budget, "reset": True}}, replies.append)
+        stats = replies[0]["CONTENTS"]
+        self.assertEqual(stats["budget"], 0.5)
+        self.assertEqual(len(stats["pending"]), 3)
+        self.assertTrue("yields" in stats and "max_pending" in stats)
+        self.assertEqual(replies[1]["CONTENTS"]["budget"], budget)
+        self.assertEqual(self._broker._dispatcher.max_pending, 0)
+
+    def testGetListenerProfile(self):
+        replies = []
+        self._broker.subscribe(replies.append, self, TO="profiled_item")
+        self._broker.publish({"TOPICS": {"type": "broker", "request": "get_listener_profile"},
+                              "CONTENTS": {"enabled": True}}, replies.append)
+        self._broker.publish({"TOPICS": {"TO": "profiled_item"}, "CONTENTS": {}})
+        self._broker.publish({"TOPICS": {"type": "broker", "request": "get_listener_profile"},
+                              "CONTENTS": {"enabled": False, "reset": True}}, replies.append)
+        stats = replies[-1]["CONTENTS"]
+        self.assertFalse(stats["enabled"])
+        self.assertIn("append", [x["function"] for x in stats["slowest"]])
+
+    def testGetPublishLimits(self):
+        replies = []
+        self._broker.publish({"TOPICS": {"type": "broker", "request": "get_publish_limits"},
+                              "CONTENTS": {"from_rate": 1, "policy": "reject"}}, replies.append)
+        self.assertEqual((replies[0]["CONTENTS"]["from_rate"], replies[0]["CONTENTS"]["policy"]), (1, "reject"))
+        limiter = self._broker.publish_limiter("test connection")
+        for msg_id in range(2):
+            limiter.publish({"TOPICS": {"FROM": "limited_script", "TO": "limited_item", "MSG_ID": msg_id},
+                             "CONTENTS": {}}, replies.append)
+        self.assertEqual(replies[-1]["CONTENTS"]["ERROR"], "RATE LIMITED")
+
+        # just asking for the stats doesn't refill the bucket
+        self._broker.publish({"TOPICS": {"type": "broker", "request": "get_publish_limits"}, "CONTENTS": {}},
+                             replies.append)
+        limiter.publish({"TOPICS": {"FROM": "limited_script", "TO": "limited_item", "MSG_ID": 2}, "CONTENTS": {}},
+                        replies.append)
+        self.assertEqual(replies[-1]["CONTENTS"]["ERROR"], "RATE LIMITED")
+
+        self._broker.publish({"TOPICS": {"type": "broker", "request": "get_publish_limits"},
+                              "CONTENTS": {"from_rate": 0, "policy": "drop"}}, replies.append)
+        self.assertEqual(replies[-1]["CONTENTS"]["limited_from"], [{"FROM": "limited_script", "limited": 2}])
+        self.assertIsNone(replies[-1]["CONTENTS"]["from_rate"])
+
+    def testFailingListenerQuarantined(self):
+        class Client(object):
+            def __init__(self):
+                self.received = []
+
+            def on_message(self, msg):
+                self.received.append(msg)
+                raise ValueError("broken state")
+
+        client = Client()
+        self._broker.subscribe(client.on_message, TO="quarantine_item")
+        self._broker.subscribe(client.on_message, TO="quarantine_item", MSG_TYPE="EVENT")
+        for _ in range(10):
+            self._broker.publish({"TOPICS": {"TO": "quarantine_item", "MSG_TYPE": "EVENT"}, "CONTENTS": {}})
+        # the 5th failure (the default max_failures) quarantines it in the middle of a message's fan out, and the
+        # call to it that was already queued still happens
+        self.assertEqual(len(client.received), 6)
+
+        replies = []
+        self._broker.publish({"TOPICS": {"type": "broker", "request": "get_quarantined_listeners"},
+                              "CONTENTS": {}}, replies.append)
+        quarantined = [x for x in replies[0]["CONTENTS"]["quarantined"] if x["function"] == "on_message"][0]
+        self.assertEqual(len(quarantined["subscriptions"]), 2)
+
+        self._broker.publish({"TOPICS": {"type": "broker", "request": "get_quarantined_listeners"},
+                              "CONTENTS": {"release": [quarantined["id"]]}}, replies.append)
+        self.assertEqual(replies[1]["CONTENTS"]["released"], 1)
+        self._broker.publish({"TOPICS": {"TO": "quarantine_item"}, "CONTENTS": {}})
+        self.assertEqual(len(client.received), 7)
+        self._broker.unsubscribe_all(client)
+
+    def testIdenticalPropertyGetsCoalesced(self):
+        device, ui, script = [], [], []
+        self._broker.subscribe(device.append, self, TO="coalesced_pump", MSG_TYPE="PROPERTY")
+        self._broker.subscribe(ui.append, self, TO="coalesce_ui")
+        self._broker.subscribe(script.append, self, TO="coalesce_script")
+        for requester, msg_id in (("coalesce_ui", 1), ("coalesce_script", 2)):
+            self._broker.publish({"TOPICS": {"TO": "coalesced_pump", "FROM": requester, "MSG_ID": msg_id,
+                                             "MSG_TYPE": "PROPERTY"},
+                                  "CONTENTS": {"PROPERTY": "speed", "ACTION": "GET"}})
+        self.assertEqual(len(device), 1)
+
+        request = device[0]["TOPICS"]
+        self._broker.publish({"TOPICS": {"TO": request["FROM"], "FROM": "coalesced_pump", "MSG_ID": request["MSG_ID"],
+                                         "MSG_TYPE": "RESPONSE", "MSG_STATUS": "OK"},
+                              "CONTENTS": {"PROPERTY": "speed", "ACTION": "RESPONSE", "VALUE": 42}})
+        self.assertEqual([(x["TOPICS"]["TO"], x["TOPICS"]["MSG_ID"], x["CONTENTS"]["VALUE"]) for x in ui + script],
+                         [("coalesce_ui", 1, 42), ("coalesce_script", 2, 42)])
+        self._broker.unsubscribe_all(self)
+
+    def testGetDiscoveryChanges(self):
+        replies = []
+        self._broker.publish({"TOPICS": {"type": "broker", "request": "get_discovery"}, "CONTENTS": {}},
+                             replies.append)
+        version = replies[0]["CONTENTS"]["version"]
+        self._broker.publish({"TOPICS": {"type": "broker", "request": "get_discovery_changes"},
+                              "CONTENTS": {"version": version}}, replies.append)
+        self.assertEqual(replies[1]["CONTENTS"]["patch"], [])
+        self.assertEqual(replies[1]["CONTENTS"]["version"], version)
+
+    def testDiscoveryBroadcastHasWholeDiscovery(self):
+        broadcasts, patches = [], []
+        self._broker.subscribe(broadcasts.append, self, type="DISCOVERY_BROADCAST")
+        self._broker.subscribe(patches.append, self, type="DISCOVERY_PATCH")
+        self.addCleanup(self._broker.unsubscribe_all, self)
+        cache = self._broker._discovery_cache
+        self._broker._broadcast_discovery_change(cache.version, cache.version - 1, [])
+        self.assertEqual(broadcasts[0]["CONTENTS"]["discovery"], cache.discovery)
+        self.assertEqual(broadcasts[0]["CONTENTS"]["version"], cache.version)
+        self.assertEqual(patches[0]["CONTENTS"]["patch"], [])
+
+    def testFindItems(self):
+        replies = []
+        self._broker.publish({"TOPICS": {"type": "broker", "request": "find_items"},
+                              "CONTENTS": {"ID": "__Broker__", "id": 5}}, replies.append)
+        self.assertEqual(replies[0]["CONTENTS"]["id"], 5)
+        self.assertEqual([x["NAME"] for x in replies[0]["CONTENTS"]["items"]], ["Broker"])
+
+    def testRetainedReplay(self):
+        self._broker.publish({"TOPICS": {"FROM": "retained_item", "MSG_TYPE": "STREAM", "STREAM": "temp"},
+                              "CONTENTS": {"VALUE": 21}})
+        self._broker.publish_many([{"TOPICS": {"FROM": "retained_item", "MSG_TYPE": "STREAM", "STREAM": "flow"},
+                                    "CONTENTS": {"VALUE": 3}}])
+        received = []
+        self._broker.subscribe(received.append, self, _retained_=True, FROM="retained_item")
+        self.assertEqual([x["CONTENTS"]["VALUE"] for x in received], [21, 3])
+        self.assertIn("RETAINED", received[0])
+
+        class Client(object):
+            def __init__(self):
+                self.replies = []
+
+            def send_message(self, msg):
+                self.replies.append(msg)
+
+        client = Client()
+        self._broker.publish({"TOPICS": {"type": "subscribe"},
+                              "CONTENTS": {"TOPICS": {"FROM": "retained_item"}, "RETAINED": True}},
+                             client.send_message)
+        self.assertEqual(client.replies[0]["TOPICS"]["type"], "subscribe_response")
+        self.assertEqual(client.replies[1]["CONTENTS"]["VALUE"], 21)
+        self._broker.unsubscribe_all(client)
+
+    def testPredicateSubscription(self):
+        received = []
+        self._broker.subscribe(received.append, self, FROM={"$prefix": "subsystem3/"},
+                               MSG_STATUS={"$in": ["ERROR", "WARNING"]})
+        for from_, status in [("subsystem3/pump", "ERROR"), ("subsystem3/pump", "OK"), ("subsystem4/pump", "ERROR")]:
+            self._broker.publish({"TOPICS": {"FROM": from_, "MSG_STATUS": status}, "CONTENTS": {}})
+        self.assertEqual([(x["TOPICS"]["FROM"], x["TOPICS"]["MSG_STATUS"]) for x in received],
+                         [("subsystem3/pump", "ERROR")])
+
+        self._broker.unsubscribe(self, {"FROM": {"$prefix": "subsystem3/"},
+                                        "MSG_STATUS": {"$in": ["WARNING", "ERROR"]}})
+        self._broker.publish({"TOPICS": {"FROM": "subsystem3/pump", "MSG_STATUS": "ERROR"}, "CONTENTS": {}})
+        self.assertEqual(len(received), 1)
+
+    def testThrottledSubscription(self):
+        received = []
+        self._broker.subscribe(received.append, self, _max_rate_hz_=1000, FROM="throttled_item")
+        for i in range(5):
+            self._broker.publish({"TOPICS": {"FROM": "throttled_item", "MSG_TYPE": "STREAM", "STREAM": "x"},
+                                  "CONTENTS": {"VALUE": i}})
+        self.assertEqual(received, [])
+        done = defer.Deferred()
+        self._broker.reactor.callLater(0.01, done.callback, None)
+        return done.addCallback(lambda _: self.assertEqual([x["CONTENTS"]["VALUE"] for x in received], [4]))
+
+    def testWedgedAdapterMarkedStale(self):
+        class WedgedAdapter(Adapter):
+            def discover(self, force):
+                return defer.Deferred()  # never answers
+
+        wedged = WedgedAdapter()
+        self._broker._adapter_discovery[wedged] = [{"NAME": "wedged board"}]
+        self._broker.adapters.append(wedged)
+        self._broker.discovery_deadline = 0.01
+        replies = []
+        done = defer.Deferred()
+
+        def reply(msg):
+            replies.append(msg)
+            if msg["TOPICS"]["response"] == "get_discovery_response":
+                done.callback(msg)
+
+        self._broker.publish({"TOPICS": {"type": "broker", "request": "get_discovery"},
+                              "CONTENTS": {"force": True, "progressive": True}}, reply)
+
+        def check(msg):
+            self._broker.adapters.remove(wedged)
+            self._broker.discovery_deadline = 10
+            self.assertIn({"NAME": "wedged board", "STALE": True}, msg["CONTENTS"]["discovery"])
+            # anything streamed came before the response, and never the stale adapter
+            for progress in replies[:-1]:
+                self.assertEqual(progress["TOPICS"]["response"], "get_discovery_progress")
+                self.assertNotIn({"NAME": "wedged board", "STALE": True}, progress["CONTENTS"]["discovery"])
+
+        return done.addCallback(check)
+
+    def testWedgedProtocolMarkedStaleWithinAdapter(self):
+        class WedgedProtocol(object):
+            def get_discovery(self):
+                return defer.Deferred()  # never answers
+
+            def __str__(self):
+                return "wedged protocol"
+
+        wedged = WedgedProtocol()
+        self._broker.pyadapter.open_protocols.append(wedged)
+        self._broker.discovery_deadline = 0.05
+        done = defer.Deferred()
+        self._broker.publish({"TOPICS": {"type": "broker", "request": "get_discovery"},
+                              "CONTENTS": {"force": True}}, done.callback)
+
+        def check(msg):
+            self._broker.pyadapter.open_protocols.remove(wedged)
+            self._broker.discovery_deadline = 10
+            # just the protocol is stale, the rest of the python adapter's discovery made it
+            self.assertIn({"NAME": "wedged protocol", "CHILDREN": [], "STALE": True}, msg["CONTENTS"]["discovery"])
+
+        return done.addCallback(check)
+
     def tearDown(self):
         # always use self as the owner of any subscriptions so that this single call will clean it up
         self._broker.unsubscribe_all(self)
@@ -0,0 +1,85 @@
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from parlay.server.circuit_breaker import ListenerCircuitBreaker
+
+
+class FakeBroker(object):
+    def __init__(self):
+        self.reactor = Clock()
+        self.subscriptions = []  # (topics, listener, owner)
+        self.errors_logged = 0
+
+    def _error_logged(self):
+        self.errors_logged += 1
+
+    def _quarantine_listener(self, func):
+        removed = [x for x in self.subscriptions if x[1] == func]
+        self.subscriptions = [x for x in self.subscriptions if x[1] != func]
+        return removed
+
+
+class Connection(object):
+    def __init__(self):
+        self.calls = 0
+
+    def send_message(self, msg):
+        self.calls += 1
+        raise IOError("connection closed")
+
+
+class ListenerCircuitBreakerTests(unittest.TestCase):
+
+    MSG = {'TOPICS': {'FROM': 'pump'}, 'CONTENTS': {}}
+
+    def setUp(self):
+        self.broker = FakeBroker()
+        self.breaker = ListenerCircuitBreaker(self.broker, max_failures=3)
+        self.connection = Connection()
+        self.broker.subscriptions.append(({'FROM': 'pump'}, self.connection.send_message, self.connection))
+
+    def fail(self, times=1):
+        for _ in range(times):
+            try:
+                self.connection.send_message(self.MSG)
+            except IOError as e:
+                self.breaker.failed(self.connection.send_message, self.MSG, e)
+
+    def testQuarantinedAfterConsecutiveFailures(self):
+        self.fail(2)
+        self.assertEqual(len(self.broker.subscriptions), 1)
+        self.fail()
+        self.assertEqual(self.broker.subscriptions, [])
+        quarantined = self.breaker.get_stats()['quarantined']
+        self.assertEqual([(x['function'], x['failures'], x['subscriptions']) for x in quarantined],
+                         [('send_message', 3, [{'FROM': 'pump'}])])
+
+    def testSuccessResetsCount(self):
+        self.fail(2)
+        self.breaker.succeeded(self.connection.send_message)
+        self.fail(2)
+        self.assertEqual(len(self.broker.subscriptions), 1)
+        self.assertEqual(self.breaker.quarantines, 0)
+
+    def testTracebackLoggedOncePerInterval(self):
+        self.fail(2)
+        self.assertEqual(self.broker.errors_logged, 1)
+        self.broker.reactor.advance(ListenerCircuitBreaker.TRACEBACK_INTERVAL)
+        self.fail()
+        self.assertEqual(self.broker.errors_logged, 2)
+
+    def testRelease(self):
+        self.fail(3)
+        released = self.breaker.release()
+        self.assertEqual([x.entries[0][0] for x in released], [{'FROM': 'pump'}])
+        self.assertEqual(self.breaker.get_stats()['quarantined'], [])
+
+    def testForgetOwner(self):
+        self.fail(3)
+        self.breaker.forget_owner(self.connection)
+        self.assertEqual(self.breaker.get_stats()['quarantined'], [])
+
+    def testNotSubscribedIsNotQuarantined(self):
+        self.broker.subscriptions = []
+        self.fail(3)
+        self.assertEqual(self.breaker.quarantines, 0)
@@ -0,0 +1,74 @@
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from parlay.server.broker import Broker
+from parlay.server.cluster import Cluster, ClusterLink, CONTROL_FRAME, parse_worker_args, configure_worker
+from parlay.server.message_codecs import JSON
+from parlay.server.subscriptions import Subscription, SubscriptionIndex
+
+
+class FakeBroker(object):
+    def __init__(self):
+        self.reactor = Clock()
+        self._subscription_index = SubscriptionIndex()
+        self.published = []
+
+    def _publish(self, msg, forward=True):
+        self.published.append((msg, forward))
+
+
+class FakeLink(ClusterLink):
+    def __init__(self, cluster):
+        ClusterLink.__init__(self, cluster)
+        self.sent = []
+
+    def sendString(self, frame):
+        self.sent.append(frame)
+
+
+class ClusterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = FakeBroker()
+        self.cluster = Cluster(self.broker, 0, 2, "/nonexistent")
+        self.link = FakeLink(self.cluster)
+        self.cluster.control_received(self.link, {'type': 'hello', 'worker': 1,
+                                                  'interest': [{'TO': 'cluster_item'}]})
+
+    def testForwardOnlyWhatPeersWant(self):
+        self.cluster.forward({'TOPICS': {'TO': 'cluster_item', 'MSG_ID': 1}, 'CONTENTS': {}})
+        self.cluster.forward({'TOPICS': {'TO': 'other_item', 'MSG_ID': 2}, 'CONTENTS': {}})
+        self.assertEqual(len(self.link.sent), 1)
+
+        self.cluster.control_received(self.link, {'type': 'interest', 'remove': [{'TO': 'cluster_item'}]})
+        self.cluster.forward({'TOPICS': {'TO': 'cluster_item', 'MSG_ID': 3}, 'CONTENTS': {}})
+        self.assertEqual(len(self.link.sent), 1)
+
+    def testPeerMessagesNotForwardedAgain(self):
+        self.cluster.publish_from_peer({'TOPICS': {'TO': 'cluster_item'}, 'CONTENTS': {}})
+        self.assertEqual(self.broker.published[0][1], False)
+
+    def testLocalInterestSentInHello(self):
+        self.broker._subscription_index.add(Subscription({'TO': 'local_item'}))
+        self.link.connectionMade()
+        hello = JSON.decode(self.link.sent[-1][len(CONTROL_FRAME):])
+        self.assertEqual(hello['interest'], [{'TO': 'local_item'}])
+
+    def testDiscoveryTimeout(self):
+        results = []
+        self.cluster.discover(False).addCallback(results.append)
+        self.assertEqual(results, [])
+        self.broker.reactor.advance(Cluster.DISCOVERY_TIMEOUT)
+        self.assertEqual(results, [[]])
+
+    def testWorkerGetsPrimarySettings(self):
+        broker = Broker.get_instance()
+        self.addCleanup(broker.configure, **broker.get_config())
+        config = broker.get_config()
+        config.update(outbound_queue_size=5, rate_limit_policy='delay', listener_max_failures=2,
+                      discovery_deadline=3)
+        args = parse_worker_args(self.cluster.worker_args(1, 7, config))
+        self.assertEqual((args.worker, args.websocket_fd), (1, 7))
+
+        configure_worker(broker, args)
+        self.assertEqual(broker.get_config(), config)
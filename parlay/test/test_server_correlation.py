@@ -0,0 +1,102 @@
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from parlay.server.adapter import Adapter
+from parlay.server.correlation import ResponseTable
+
+
+class FakeOwner(object):
+    def __init__(self):
+        self.reactor = Clock()
+
+
+def response(to, from_, msg_id, status='OK'):
+    return {'TOPICS': {'TO': to, 'FROM': from_, 'MSG_ID': msg_id, 'MSG_TYPE': 'RESPONSE', 'MSG_STATUS': status},
+            'CONTENTS': {}}
+
+
+class ResponseTableTests(unittest.TestCase):
+
+    def setUp(self):
+        self.owner = FakeOwner()
+        self.table = ResponseTable(self.owner)
+        self.received = []
+
+    def testMatchesOnlyItsResponse(self):
+        self.table.expect('script', 'item', 7, self.received.append)
+        self.assertEqual(self.table.match(response('script', 'item', 8)), [])
+        self.assertEqual(self.table.match(response('other_script', 'item', 7)), [])
+        self.assertEqual(self.table.match(response('script', 'item', 7)), [self.received.append])
+        # the final response removes it
+        self.assertEqual(len(self.table), 0)
+
+    def testProgressKeepsWaiting(self):
+        self.table.expect('script', 'item', 7, self.received.append)
+        self.assertEqual(len(self.table.match(response('script', 'item', 7, status='PROGRESS'))), 1)
+        self.assertEqual(len(self.table), 1)
+        self.assertEqual(len(self.table.match(response('script', 'item', 7))), 1)
+        self.assertEqual(len(self.table), 0)
+
+    def testTimeout(self):
+        timed_out = []
+        self.table.expect('script', 'item', 7, self.received.append, timeout=2,
+                          on_timeout=lambda: timed_out.append(True))
+        self.owner.reactor.advance(3)
+        self.assertEqual(timed_out, [True])
+        self.assertEqual(len(self.table), 0)
+        self.assertEqual(self.table.get_stats()['evicted'], 1)
+
+    def testCancel(self):
+        pending = self.table.expect('script', 'item', 7, self.received.append, timeout=2)
+        self.table.cancel(pending)
+        self.assertEqual(len(self.table), 0)
+        self.assertEqual(self.owner.reactor.getDelayedCalls(), [])
+        self.table.cancel(pending)  # cancelling twice is fine
+
+
+class SubscribeOnlyAdapter(Adapter):
+    """
+    An adapter that only implements publish and subscribe, like a third party one might
+    """
+
+    def __init__(self):
+        self.reactor = Clock()
+        self.subscriptions = []  # (listener, topics)
+        Adapter.__init__(self)
+
+    def subscribe(self, fn, **kwargs):
+        self.subscriptions.append((fn, kwargs))
+
+    def deliver(self, msg):
+        topics = msg['TOPICS']
+        for fn, wanted in self.subscriptions:
+            if all(topics.get(k, None) == v for k, v in wanted.iteritems()):
+                fn(msg)
+
+
+class AdapterFallbackTests(unittest.TestCase):
+
+    def setUp(self):
+        self.adapter = SubscribeOnlyAdapter()
+        self.received = []
+
+    def testResponsesRoutedThroughSubscription(self):
+        self.adapter.expect_response('script', 'item', 1, self.received.append)
+        self.adapter.expect_response('script', 'item', 2, self.received.append)
+        self.assertEqual(len(self.adapter.subscriptions), 1)  # one per requester
+
+        self.adapter.deliver(response('script', 'item', 2, 'PROGRESS'))
+        self.adapter.deliver(response('script', 'item', 2))
+        self.adapter.deliver(response('script', 'item', 2))  # already finished
+        self.assertEqual([x['TOPICS']['MSG_STATUS'] for x in self.received], ['PROGRESS', 'OK'])
+
+    def testCancelAndTimeout(self):
+        timeouts = []
+        pending = self.adapter.expect_response('script', 'item', 1, self.received.append)
+        self.adapter.expect_response('script', 'item', 2, self.received.append, timeout=5,
+                                     on_timeout=lambda: timeouts.append(True))
+        self.adapter.cancel_response(pending)
+        self.adapter.reactor.advance(5)
+        self.adapter.deliver(response('script', 'item', 1))
+        self.adapter.deliver(response('script', 'item', 2))
+        self.assertEqual((self.received, timeouts), ([], [True]))
@@ -0,0 +1,135 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from parlay.server.adapter import PyAdapter
+from parlay.server.discovery_cache import DiscoveryCache, json_diff, apply_patch, with_deadline
+
+
+class JsonPatchTests(unittest.TestCase):
+
+    def testRoundTrip(self):
+        old = [{'NAME': 'proto', 'CHILDREN': [{'ID': 1, 'NAME': 'a'}, {'ID': 2, 'NAME': 'b/c'}]}, {'NAME': 'gone'}]
+        new = [{'NAME': 'proto', 'CHILDREN': [{'ID': 1, 'NAME': 'a2', 'TYPE': 'x'}], 'NEW': True}]
+        patch = json_diff(old, new)
+        self.assertEqual(apply_patch(old, patch), new)
+        self.assertEqual(old[1], {'NAME': 'gone'})  # the original isn't touched
+
+    def testNoChanges(self):
+        self.assertEqual(json_diff([{'NAME': 'x'}], [{'NAME': 'x'}]), [])
+
+
+class DiscoveryCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.running = []  # (force, Deferred, progress) for every discovery that was started
+        self.changes = []
+        self.cache = DiscoveryCache(self.discover, on_change=lambda *args: self.changes.append(args))
+
+    def discover(self, force, progress):
+        d = defer.Deferred()
+        self.running.append((force, d, progress))
+        return d
+
+    def testSingleFlight(self):
+        results = []
+        for _ in range(10):
+            self.cache.get().addCallback(results.append)
+        self.assertEqual(len(self.running), 1)
+        self.running[0][1].callback([{'NAME': 'proto'}])
+        self.assertEqual(len(results), 10)
+        self.assertEqual(self.cache.version, 1)
+        self.assertEqual(len(self.changes), 1)
+
+    def testForcedWaitsForForcedDiscovery(self):
+        results = []
+        self.cache.get(force=False)
+        self.cache.get(force=True).addCallback(results.append)
+        self.running[0][1].callback([{'NAME': 'old'}])
+        self.assertEqual(results, [])
+        self.assertEqual(self.running[1][0], True)
+        self.running[1][1].callback([{'NAME': 'new'}])
+        self.assertEqual(results, [[{'NAME': 'new'}]])
+
+    def testProgress(self):
+        first, second = [], []
+        self.cache.get(progress=first.append)
+        self.running[0][2]([{'NAME': 'fast'}])
+        self.cache.get(progress=second.append)  # joins late, only sees what comes after
+        self.running[0][2]([{'NAME': 'slow'}])
+        self.running[0][1].callback([{'NAME': 'fast'}, {'NAME': 'slow'}])
+        self.running[0][2]([{'NAME': 'too late'}])
+        self.assertEqual(first, [[{'NAME': 'fast'}], [{'NAME': 'slow'}]])
+        self.assertEqual(second, [[{'NAME': 'slow'}]])
+
+    def testDeadline(self):
+        clock = task.Clock()
+        slow, results = defer.Deferred(), []
+        with_deadline(slow, 5, clock, lambda: 'stale').addCallback(results.append)
+        clock.advance(5)
+        self.assertEqual(results, ['stale'])
+        slow.callback('fresh')  # too late
+        self.assertEqual(results, ['stale'])
+        self.assertFalse(clock.getDelayedCalls())
+
+    def testVersionsAndChanges(self):
+        self.cache.update([{'NAME': 'a'}])
+        self.cache.update([{'NAME': 'a'}])  # no change, no new version
+        self.cache.update([{'NAME': 'a'}, {'NAME': 'b'}])
+        self.assertEqual(self.cache.version, 2)
+        self.assertEqual(apply_patch([], self.cache.changes_since(0)), [{'NAME': 'a'}, {'NAME': 'b'}])
+        self.assertEqual(self.cache.changes_since(2), [])
+        self.assertEqual(self.changes[-1][:2], (2, 1))
+
+    def testHistoryTooShort(self):
+        cache = DiscoveryCache(self.discover, history=1)
+        cache.update([1])
+        cache.update([2])
+        self.assertEqual(cache.changes_since(0), None)
+        self.assertEqual(apply_patch([1], cache.changes_since(1)), [2])
+
+
+class ItemDiscoveryTests(unittest.TestCase):
+
+    class FakeBroker(object):
+        def __init__(self):
+            self.reactor = task.Clock()
+
+    class FakeProtocol(object):
+        def __init__(self, items):
+            self.items = items
+            self.requests = []  # (item ID, Deferred) for every item discovery that was asked for
+
+        def get_item_discovery(self, item_id):
+            if item_id not in self.items:
+                return None
+            d = defer.Deferred()
+            self.requests.append((item_id, d))
+            return d
+
+    def testConcurrentRequestsShareFetch(self):
+        adapter = PyAdapter(self.FakeBroker())
+        other, protocol = self.FakeProtocol([]), self.FakeProtocol(['pump'])
+        adapter.open_protocols = [other, protocol]
+        results = []
+        for _ in range(2):
+            adapter.get_item_discovery('pump').addCallback(results.append)
+        self.assertEqual(len(protocol.requests), 1)
+
+        protocol.requests[0][1].callback({'ID': 'pump', 'CHILDREN': [], 'PROPERTIES': ['speed']})
+        self.assertEqual([x['PROPERTIES'] for x in results], [['speed'], ['speed']])
+        # and it's cached now
+        self.assertEqual(adapter.get_item_discovery('pump')['PROPERTIES'], ['speed'])
+        self.assertEqual(len(protocol.requests), 1)
+
+    def testFailedFetchTriedAgain(self):
+        adapter = PyAdapter(self.FakeBroker())
+        protocol = self.FakeProtocol(['pump'])
+        adapter.open_protocols = [protocol]
+        errors = []
+        for _ in range(2):
+            adapter.get_item_discovery('pump').addErrback(errors.append)
+        protocol.requests[0][1].errback(ValueError("no answer"))
+        self.assertEqual(len(errors), 2)
+
+        adapter.get_item_discovery('pump')
+        self.assertEqual(len(protocol.requests), 2)
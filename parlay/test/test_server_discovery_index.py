@@ -0,0 +1,58 @@
+from twisted.trial import unittest
+
+from parlay.server.discovery_index import DiscoveryIndex, discovery_tree
+
+DISCOVERY = [
+    {'TEMPLATE': 'Protocol', 'NAME': 'SerialProtocol', 'CHILDREN': [
+        {'ID': 1, 'NAME': 'motor', 'TYPE': 'sscom/STD_ITEM', 'INTERFACES': ['motion'], 'CHILDREN': [
+            {'ID': 11, 'NAME': 'encoder', 'TYPE': 'sscom/SUB_ITEM', 'INTERFACES': [], 'CHILDREN': []}]},
+        {'ID': 2, 'NAME': 'pump', 'TYPE': 'sscom/STD_ITEM', 'INTERFACES': ['motion', 'fluid'], 'CHILDREN': []},
+        {'ID': 3, 'NAME': 'camera', 'TYPE': 'ParlayStandardItem', 'INTERFACES': [], 'CHILDREN': []}]},
+    {'TEMPLATE': 'Broker', 'NAME': 'Broker', 'ID': '__Broker__', 'interfaces': ['broker'], 'CHILDREN': []}]
+
+
+class DiscoveryIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index = DiscoveryIndex()
+        self.index.rebuild(DISCOVERY)
+
+    def names(self, items):
+        return [x['NAME'] for x in items]
+
+    def testFindById(self):
+        items = self.index.find(item_id=1)
+        self.assertEqual(self.names(items), ['motor'])
+        self.assertEqual(items[0]['CHILDREN'][0]['NAME'], 'encoder')  # the whole subtree
+        self.assertEqual(self.names(self.index.find(item_id=11)), ['encoder'])
+
+    def testProtocolsNotIndexed(self):
+        self.assertEqual(self.index.find(name='SerialProtocol'), [])
+        self.index.rebuild([{'NAME': 'WedgedProtocol', 'STALE': True, 'CHILDREN': [{'ID': 5, 'NAME': 'valve'}]}])
+        self.assertEqual(self.index.find(name='WedgedProtocol'), [])
+        self.assertEqual(self.names(self.index.find()), ['valve'])
+
+    def testFindByTypePrefix(self):
+        self.assertEqual(self.names(self.index.find(type_prefix='sscom/')), ['motor', 'encoder', 'pump'])
+        self.assertEqual(self.names(self.index.find(type_prefix='sscom/STD')), ['motor', 'pump'])
+        self.assertEqual(self.index.find(type_prefix='nope'), [])
+
+    def testFindByInterface(self):
+        self.assertEqual(self.names(self.index.find(interface='motion')), ['motor', 'pump'])
+        self.assertEqual(self.names(self.index.find(interface='broker')), ['Broker'])
+
+    def testCombinedCriteria(self):
+        self.assertEqual(self.names(self.index.find(interface='motion', name='pump')), ['pump'])
+        self.assertEqual(self.index.find(item_id=1, name='pump'), [])
+        self.assertEqual(len(self.index.find(type_prefix='sscom', limit=1)), 1)
+
+    def testRebuild(self):
+        self.index.rebuild([{'ID': 4, 'NAME': 'new'}])
+        self.assertEqual(self.index.find(item_id=1), [])
+        self.assertEqual(len(self.index), 1)
+
+    def testDiscoveryTree(self):
+        tree = discovery_tree([{'NAME': 'proto', 'CHILDREN': [
+            {'ID': 1, 'NAME': 'motor', 'TYPE': 'sscom', 'PROPERTIES': [{'NAME': 'speed'}], 'CHILDREN': []}]}])
+        self.assertEqual(tree, [{'NAME': 'proto', 'CHILDREN': [
+            {'ID': 1, 'NAME': 'motor', 'TYPE': 'sscom', 'CHILDREN': []}]}])
@@ -0,0 +1,71 @@
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from parlay.server.dispatch import DispatchScheduler, DispatchPriority, message_priority
+
+
+class FakeBroker(object):
+    def __init__(self):
+        self.reactor = Clock()
+
+
+def msg(msg_type, status=None):
+    topics = {'MSG_TYPE': msg_type}
+    if status is not None:
+        topics['MSG_STATUS'] = status
+    return {'TOPICS': topics, 'CONTENTS': {}}
+
+
+class DispatchSchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = FakeBroker()
+        self.called = []
+
+    def testMessagePriority(self):
+        self.assertEqual(message_priority(msg('RESPONSE')), DispatchPriority.RESPONSE)
+        self.assertEqual(message_priority(msg('EVENT', 'ERROR')), DispatchPriority.RESPONSE)
+        self.assertEqual(message_priority(msg('COMMAND')), DispatchPriority.COMMAND)
+        self.assertEqual(message_priority(msg('STREAM')), DispatchPriority.TELEMETRY)
+        self.assertEqual(message_priority({'TOPICS': {}, 'CONTENTS': {}}), DispatchPriority.COMMAND)
+
+    def testDeliversImmediatelyWithinBudget(self):
+        scheduler = DispatchScheduler(self.broker)
+        scheduler.schedule(DispatchPriority.TELEMETRY, 1, [self.called.append, self.called.append])
+        self.assertEqual(self.called, [1, 1])
+        self.assertEqual(scheduler.pending(), 0)
+
+    def testNestedPublishIsDeliveredByPriority(self):
+        scheduler = DispatchScheduler(self.broker)
+
+        def publishes_more(arg):
+            self.called.append(arg)
+            scheduler.schedule(DispatchPriority.TELEMETRY, 'stream', [self.called.append])
+            scheduler.schedule(DispatchPriority.RESPONSE, 'response', [self.called.append])
+
+        scheduler.schedule(DispatchPriority.COMMAND, 'command', [publishes_more])
+        self.assertEqual(self.called, ['command', 'response', 'stream'])
+
+    def testYieldsWhenOverBudget(self):
+        scheduler = DispatchScheduler(self.broker, budget=-1)  # always over budget
+        scheduler.schedule(DispatchPriority.TELEMETRY, 1, [self.called.append] * 3)
+        self.assertEqual(self.called, [1])
+        self.assertEqual(scheduler.yields, 1)
+
+        # a response that comes in while telemetry is waiting goes first
+        scheduler.schedule(DispatchPriority.RESPONSE, 2, [self.called.append])
+        self.assertEqual(self.called, [1, 2])
+
+        self.broker.reactor.advance(0)
+        self.broker.reactor.advance(0)
+        self.assertEqual(self.called, [1, 2, 1, 1])
+        self.assertEqual(scheduler.pending(), 0)
+
+    def testListenerExceptionDoesNotStopDispatch(self):
+        scheduler = DispatchScheduler(self.broker)
+
+        def bad_listener(arg):
+            raise ValueError("bad listener")
+
+        scheduler.schedule(DispatchPriority.COMMAND, 1, [bad_listener, self.called.append])
+        self.assertEqual(self.called, [1])
@@ -0,0 +1,63 @@
+import copy
+import json
+
+from twisted.trial import unittest
+
+from parlay.server import message_codecs
+from parlay.server.envelope import ParlayMessage, wrap_message, encode_message
+
+
+class ParlayMessageTests(unittest.TestCase):
+
+    MSG = {"TOPICS": {u"TO": "ITEM", u"FROM": "SCRIPT", "MSG_ID": 7, "MSG_TYPE": "STREAM"},
+           "CONTENTS": {"VALUE": 1.5, "STREAM": "position"},
+           "ORIGIN": "broker-a"}
+
+    def testBehavesLikeTheDict(self):
+        msg = ParlayMessage.from_dict(self.MSG)
+        self.assertEqual(msg, self.MSG)
+        self.assertEqual(msg['TOPICS']['TO'], "ITEM")
+        self.assertIs(msg['CONTENTS'], self.MSG['CONTENTS'])
+        self.assertEqual(msg.get('ORIGIN'), "broker-a")
+        self.assertEqual(msg.get('NOPE', 3), 3)
+        self.assertTrue('ORIGIN' in msg)
+        self.assertEqual(sorted(msg), ['CONTENTS', 'ORIGIN', 'TOPICS'])
+        self.assertEqual(len(msg), 3)
+        self.assertEqual(msg.copy(), self.MSG)
+        self.assertEqual(dict(msg), self.MSG)
+        self.assertRaises(KeyError, msg.__getitem__, 'NOPE')
+
+    def testIsADict(self):
+        # listeners that type check or serialize messages themselves still work
+        msg = ParlayMessage.from_dict(self.MSG)
+        self.assertTrue(isinstance(msg, dict))
+        self.assertEqual(json.loads(json.dumps(msg))['ORIGIN'], "broker-a")
+        copied = copy.deepcopy(msg)
+        self.assertEqual(copied, self.MSG)
+        self.assertEqual(json.loads(encode_message(copied))['ORIGIN'], "broker-a")
+
+    def testTopicKeysInterned(self):
+        topics = {u"TO": "ITEM", u"MSG_TYPE": "COMMAND"}
+        msg = ParlayMessage.from_dict({"TOPICS": topics, "CONTENTS": {}})
+        self.assertIs(msg['TOPICS'], topics)  # interned in place, not copied
+        self.assertTrue(all(type(k) is str for k in msg['TOPICS']))
+
+    def testSetInvalidatesEncoding(self):
+        msg = ParlayMessage.from_dict(self.MSG)
+        encoded = encode_message(msg)
+        self.assertIs(encode_message(msg), encoded)
+        msg['RETAINED'] = 2
+        self.assertEqual(json.loads(encode_message(msg))['RETAINED'], 2)
+        self.assertEqual(msg.pop('RETAINED'), 2)
+        self.assertFalse('RETAINED' in msg)
+
+    def testWrapPassesThrough(self):
+        msg = ParlayMessage({'TO': 'ITEM'}, {})
+        self.assertIs(wrap_message(msg), msg)
+        self.assertIsNot(ParlayMessage.from_dict(msg), msg)
+
+    def testNestedInReply(self):
+        reply = {'TOPICS': {'type': 'broker'}, 'CONTENTS': {'messages': [ParlayMessage.from_dict(self.MSG)]}}
+        for name, codec in message_codecs.CODECS.items():
+            self.assertEqual(codec.decode(codec.encode(reply))['CONTENTS']['messages'][0]['ORIGIN'], "broker-a",
+                             name)
@@ -0,0 +1,140 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from parlay.server.broker import Broker
+from parlay.server import message_codecs
+from parlay.server.cluster import Cluster
+from parlay.server.federation import Federation, FederationClientProtocol, ORIGIN_KEY
+from parlay.server.subscriptions import SubscriptionIndex
+
+
+class FakeBroker(object):
+    def __init__(self):
+        self.reactor = Clock()
+        self.websocket_port = 8085
+        self._subscription_index = SubscriptionIndex()
+        self.adapters = []
+        self._cluster = None
+
+    def get_host_discovery(self, force):
+        return defer.succeed([{'NAME': 'local_protocol'}])
+
+
+class FakeLink(object):
+    """
+    Stands in for the websocket on one end of a federation link
+    """
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, msg):
+        self.sent.append(msg)
+
+
+class FakeClientFactory(object):
+    def __init__(self, broker):
+        self.broker = broker
+        self.url = 'ws://rack1:8085'
+        self.trying = True
+
+    def stopTrying(self):
+        self.trying = False
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.connected = True
+
+    def loseConnection(self):
+        self.connected = False
+
+
+def hello(broker_id, interest):
+    return {'TOPICS': {'type': 'federation', 'request': 'hello'},
+            'CONTENTS': {'broker_id': broker_id, 'interest': interest}}
+
+
+class FederationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = FakeBroker()
+        self.federation = Federation(self.broker, broker_id='local')
+        self.link = FakeLink()
+        self.federation.handle_message(hello('rack1', [{'TO': 'rack1_item'}]), self.link.send_message)
+
+    def testHelloAnswered(self):
+        self.assertEqual(self.link.sent[0]['TOPICS']['request'], 'hello_response')
+        self.assertEqual(self.federation.get_stats()['peers'][0]['broker_id'], 'rack1')
+
+    def testForwardOnlyWhatPeersWant(self):
+        self.federation.forward({'TOPICS': {'TO': 'rack1_item'}, 'CONTENTS': {}})
+        self.federation.forward({'TOPICS': {'TO': 'other_item'}, 'CONTENTS': {}})
+        self.assertEqual(len(self.link.sent), 2)  # the hello response and one message
+        self.assertEqual(self.link.sent[1][ORIGIN_KEY], 'local')
+
+    def testFederatedMessagesNotForwardedAgain(self):
+        self.federation.forward({'TOPICS': {'TO': 'rack1_item'}, 'CONTENTS': {}, ORIGIN_KEY: 'rack2'})
+        self.assertEqual(len(self.link.sent), 1)
+
+    def testRefuseDuplicateLink(self):
+        other = FakeLink()
+        self.federation.handle_message(hello('rack1', [{'TO': 'rack1_item'}]), other.send_message)
+        self.assertEqual(other.sent[0]['TOPICS']['request'], 'refused')
+        self.federation.handle_message(hello('local', []), other.send_message)
+        self.assertEqual(other.sent[1]['TOPICS']['request'], 'refused')
+        self.assertEqual(len(self.federation.get_stats()['peers']), 1)
+
+    def testDiscoveryTaggedWithOrigin(self):
+        results = []
+        self.federation.discover(False).addCallback(results.append)
+        request = self.link.sent[-1]
+        self.assertEqual(request['TOPICS']['request'], 'discovery')
+        self.federation.handle_message({'TOPICS': {'type': 'federation', 'request': 'discovery_response'},
+                                        'CONTENTS': {'id': request['CONTENTS']['id'],
+                                                     'discovery': [{'NAME': 'rack1_protocol'}]}},
+                                       self.link.send_message)
+        self.assertEqual(results[0], [{'NAME': 'rack1_protocol', ORIGIN_KEY: 'rack1'}])
+
+    def testAnswerDiscovery(self):
+        self.federation.handle_message({'TOPICS': {'type': 'federation', 'request': 'discovery'},
+                                        'CONTENTS': {'id': 7}}, self.link.send_message)
+        self.assertEqual(self.link.sent[-1]['CONTENTS'], {'id': 7, 'discovery': [{'NAME': 'local_protocol'}]})
+
+    def testDefaultIdBeforeBrokerStarted(self):
+        # Broker.start hasn't set anything on the broker yet
+        federation = Federation(Broker.get_instance())
+        self.assertTrue(federation.broker_id.endswith(":" + str(Broker.get_instance().websocket_port)))
+
+    def testRefusedLinkNotReopened(self):
+        federation = self.federation
+        self.broker.get_federation = lambda: federation
+        link = FederationClientProtocol()
+        link.factory = FakeClientFactory(self.broker)
+        link.transport = FakeTransport()
+        link.onMessage(message_codecs.JSON.encode({'TOPICS': {'type': 'federation', 'request': 'refused'},
+                                                   'CONTENTS': {'broker_id': 'rack1'}}), False)
+        self.assertFalse(link.factory.trying)
+        self.assertFalse(link.transport.connected)
+
+    def testClusterWorkerRefusesHello(self):
+        self.broker._cluster = Cluster(self.broker, 1, 2, "/nonexistent")
+        link = FakeLink()
+        self.federation.handle_message(hello('rack2', [{'TO': 'rack2_item'}]), link.send_message)
+        self.assertEqual(link.sent[0]['TOPICS']['request'], 'refused')
+        self.assertTrue(link.sent[0]['CONTENTS']['retry'])
+        self.assertEqual(len(self.federation.get_stats()['peers']), 1)
+
+        # the other broker's end of it tries again, hoping to land on the primary
+        self.broker.get_federation = lambda: self.federation
+        client = FederationClientProtocol()
+        client.factory = FakeClientFactory(self.broker)
+        client.transport = FakeTransport()
+        client.onMessage(message_codecs.JSON.encode(link.sent[0]), False)
+        self.assertTrue(client.factory.trying)
+        self.assertFalse(client.transport.connected)
+
+    def testRefusedPeerForgotten(self):
+        self.federation.handle_message({'TOPICS': {'type': 'federation', 'request': 'refused'},
+                                        'CONTENTS': {'broker_id': 'rack1'}}, self.link.send_message)
+        self.assertEqual(self.federation.get_stats()['peers'], [])
@@ -0,0 +1,43 @@
+from StringIO import StringIO
+from twisted.trial import unittest
+
+from parlay.server.flight_recorder import FlightRecorder
+
+
+def msg(i):
+    return {'TOPICS': {'MSG_ID': i}, 'CONTENTS': {}}
+
+
+class FlightRecorderTests(unittest.TestCase):
+
+    def testKeepsLastMessages(self):
+        recorder = FlightRecorder(size=3)
+        for i in range(5):
+            recorder.record(msg(i))
+        self.assertEqual([x['MSG']['TOPICS']['MSG_ID'] for x in recorder.dump()], [2, 3, 4])
+        self.assertEqual([x['MSG']['TOPICS']['MSG_ID'] for x in recorder.dump(2)], [3, 4])
+        self.assertEqual(recorder.get_stats()['seen'], 5)
+
+    def testSampling(self):
+        recorder = FlightRecorder(size=10, sample_every=2)
+        for i in range(6):
+            recorder.record(msg(i))
+        self.assertEqual(len(recorder), 3)
+
+        recorder.configure(sample_every=0)
+        recorder.record(msg(6))
+        self.assertEqual(len(recorder), 3)
+
+    def testResizeKeepsNewest(self):
+        recorder = FlightRecorder(size=5)
+        for i in range(5):
+            recorder.record(msg(i))
+        recorder.configure(size=2)
+        self.assertEqual([x['MSG']['TOPICS']['MSG_ID'] for x in recorder.dump()], [3, 4])
+
+    def testWriteDump(self):
+        recorder = FlightRecorder(size=2)
+        recorder.record(msg(1))
+        out = StringIO()
+        recorder.write_dump(out)
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
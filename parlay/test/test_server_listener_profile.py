@@ -0,0 +1,59 @@
+from twisted.trial import unittest
+
+from parlay.server.listener_profile import ListenerProfiler
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Pump(object):
+    item_id = 'pump'
+
+    def __init__(self, clock, seconds):
+        self.clock = clock
+        self.seconds = seconds
+
+    def on_message(self, msg):
+        self.clock.now += self.seconds
+
+    def broken(self, msg):
+        self.clock.now += self.seconds
+        raise RuntimeError("broken")
+
+
+class ListenerProfilerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.profiler = ListenerProfiler(budget=0.005, clock=self.clock)
+
+    def testSlowestFirst(self):
+        fast, slow = Pump(self.clock, 0.0001), Pump(self.clock, 0.002)
+        fast.item_id = 'fast_pump'
+        for _ in range(10):
+            self.profiler.call(fast.on_message, {})
+            self.profiler.call(slow.on_message, {})
+        rows = self.profiler.get_slowest()
+        self.assertEqual([(r['owner'], r['function'], r['calls']) for r in rows],
+                         [('pump', 'on_message', 10), ('fast_pump', 'on_message', 10)])
+        self.assertAlmostEqual(rows[0]['total'], 0.02)
+        self.assertAlmostEqual(rows[0]['max'], 0.002)
+        self.assertAlmostEqual(rows[0]['p99'], 0.002)
+        self.assertAlmostEqual(rows[1]['p50'], 0.0001)
+        self.assertEqual(rows[0]['over_budget'], 0)
+
+    def testOverBudget(self):
+        slow = Pump(self.clock, 0.01)
+        self.assertRaises(RuntimeError, self.profiler.call, slow.broken, {})
+        self.profiler.call(slow.on_message, {})
+        stats = self.profiler.get_stats(sort='over_budget')
+        self.assertEqual([x['function'] for x in stats['slow_calls']], ['broken', 'on_message'])
+        self.assertEqual(stats['slowest'][0]['over_budget'], 1)
+
+    def testBadSort(self):
+        self.assertRaises(ValueError, self.profiler.get_slowest, 10, 'median')
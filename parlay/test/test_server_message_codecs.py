@@ -0,0 +1,37 @@
+from twisted.trial import unittest
+
+from parlay.server import message_codecs
+from parlay.server.envelope import MessageEnvelope, encode_message
+
+
+class MessageCodecTests(unittest.TestCase):
+
+    MSG = {"TOPICS": {"TO": "ITEM", "FROM": "SCRIPT", "MSG_ID": 7, "MSG_TYPE": "STREAM"},
+           "CONTENTS": {"VALUE": [1.5, 2, -3], "STREAM": "position"}}
+
+    def testDefaultIsJSON(self):
+        codec, subprotocol = message_codecs.negotiate([])
+        self.assertIs(codec, message_codecs.JSON)
+        self.assertIsNone(subprotocol)
+
+    def testNegotiateUnknown(self):
+        codec, subprotocol = message_codecs.negotiate(["something.else"])
+        self.assertIs(codec, message_codecs.JSON)
+        self.assertIsNone(subprotocol)
+
+    def testNegotiateClientPreference(self):
+        codec, subprotocol = message_codecs.negotiate(["something.else", "parlay.json"])
+        self.assertIs(codec, message_codecs.JSON)
+        self.assertEqual(subprotocol, "parlay.json")
+
+    def testRoundTrip(self):
+        for name, codec in message_codecs.CODECS.items():
+            self.assertEqual(codec.decode(codec.encode(self.MSG)), self.MSG, name)
+
+    def testEnvelopeCachesPerCodec(self):
+        envelope = MessageEnvelope(self.MSG)
+        for name in message_codecs.CODECS:
+            self.assertIs(encode_message(envelope, name), encode_message(envelope, name))
+
+    def testUnknownCodec(self):
+        self.assertRaises(LookupError, message_codecs.get_codec, "not_a_codec")
@@ -0,0 +1,129 @@
+import json
+
+from twisted.trial import unittest
+
+from parlay.server import message_codecs
+from parlay.server.outbound_queue import OutboundQueue, SlowConsumerPolicy, QueuedWebSocketMixin
+
+
+def stream_msg(item, stream, value):
+    return {'TOPICS': {'FROM': item, 'MSG_TYPE': 'STREAM', 'STREAM': stream}, 'CONTENTS': {'VALUE': value}}
+
+
+def event_msg(value):
+    return {'TOPICS': {'FROM': 'item', 'MSG_TYPE': 'EVENT'}, 'CONTENTS': {'VALUE': value}}
+
+
+class OutboundQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.written = []
+        self.disconnects = []
+
+    def make_queue(self, policy, max_size=3):
+        return OutboundQueue(self.written.append, lambda: self.disconnects.append(True),
+                             max_size=max_size, policy=policy)
+
+    def testWritesThroughWhenNotPaused(self):
+        q = self.make_queue(SlowConsumerPolicy.DROP_OLDEST)
+        q.send(event_msg(1))
+        self.assertEqual(len(self.written), 1)
+        self.assertEqual(len(q), 0)
+
+    def testQueuesWhilePausedAndFlushesInOrder(self):
+        q = self.make_queue(SlowConsumerPolicy.DROP_OLDEST)
+        q.pauseProducing()
+        q.send(event_msg(1))
+        q.send(event_msg(2))
+        self.assertEqual(len(self.written), 0)
+        self.assertEqual(q.get_stats()['depth'], 2)
+        q.resumeProducing()
+        self.assertEqual([x['CONTENTS']['VALUE'] for x in self.written], [1, 2])
+        self.assertEqual(len(q), 0)
+
+    def testDropOldest(self):
+        q = self.make_queue(SlowConsumerPolicy.DROP_OLDEST)
+        q.pauseProducing()
+        for i in range(5):
+            q.send(event_msg(i))
+        self.assertEqual(q.get_stats()['dropped'], 2)
+        self.assertEqual(q.get_stats()['max_depth'], 3)
+        q.resumeProducing()
+        self.assertEqual([x['CONTENTS']['VALUE'] for x in self.written], [2, 3, 4])
+
+    def testLatestValue(self):
+        q = self.make_queue(SlowConsumerPolicy.LATEST_VALUE)
+        q.pauseProducing()
+        for i in range(10):
+            q.send(stream_msg('item', 'temp', i))
+        q.send(stream_msg('other_item', 'temp', 100))
+        q.send(event_msg(-1))
+        self.assertEqual(len(q), 3)
+        self.assertEqual(q.get_stats()['dropped'], 9)
+        q.resumeProducing()
+        self.assertEqual([x['CONTENTS']['VALUE'] for x in self.written], [9, 100, -1])
+
+    def testDisconnect(self):
+        q = self.make_queue(SlowConsumerPolicy.DISCONNECT)
+        q.pauseProducing()
+        for i in range(4):
+            q.send(event_msg(i))
+        self.assertEqual(len(self.disconnects), 1)
+        self.assertTrue(q.get_stats()['disconnected'])
+        # nothing more is written once we've given up on the connection
+        q.send(event_msg(5))
+        q.resumeProducing()
+        self.assertEqual(len(self.written), 0)
+
+    def testPausedDuringFlush(self):
+        q = self.make_queue(SlowConsumerPolicy.DROP_OLDEST)
+
+        def write(msg):
+            self.written.append(msg)
+            q.pauseProducing()  # the transport's buffer filled up again
+
+        q._write = write
+        q.pauseProducing()
+        q.send(event_msg(1))
+        q.send(event_msg(2))
+        q.resumeProducing()
+        self.assertEqual(len(self.written), 1)
+        self.assertEqual(len(q), 1)
+
+    def testUnknownPolicy(self):
+        self.assertRaises(ValueError, OutboundQueue, self.written.append, lambda: None, policy='bogus')
+
+
+class QueuedWebSocketTests(unittest.TestCase):
+
+    class FakeBroker(object):
+        outbound_queue_size = 2
+        outbound_queue_policy = SlowConsumerPolicy.DISCONNECT
+
+    class FakeWebSocket(QueuedWebSocketMixin):
+        _codec = message_codecs.DEFAULT_CODEC
+
+        def __init__(self):
+            self.sent = []
+            self.producer = None
+            self.dropped = False
+
+        def sendMessage(self, payload, isBinary=False):
+            self.sent.append(payload)
+
+        def registerProducer(self, producer, streaming):
+            self.producer = producer
+
+        def dropConnection(self, abort=False):
+            self.dropped = True
+
+    def testQueuedOnceOpen(self):
+        ws = self.FakeWebSocket()
+        ws.send_message(event_msg(1))  # not open yet, straight out
+        ws.open_outbound_queue(self.FakeBroker())
+        self.assertIs(ws.producer, ws.outbound_queue)
+        ws.outbound_queue.pauseProducing()
+        for i in range(2, 5):
+            ws.send_message(event_msg(i))
+        self.assertEqual([json.loads(x)['CONTENTS']['VALUE'] for x in ws.sent], [1])
+        self.assertTrue(ws.dropped)
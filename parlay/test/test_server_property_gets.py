@@ -0,0 +1,76 @@
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from parlay.server.property_gets import PropertyGetCoalescer
+
+
+class FakeBroker(object):
+    def __init__(self):
+        self.reactor = Clock()
+        self.published = []
+        self.property_gets = PropertyGetCoalescer(self)
+
+    def _publish(self, msg):
+        topics = msg['TOPICS']
+        if topics['MSG_TYPE'] == 'PROPERTY' and not self.property_gets.admit(msg):
+            return
+        self.published.append(msg)
+        if topics['MSG_TYPE'] == 'RESPONSE':
+            self.property_gets.response_published(msg)
+
+
+def get(from_, msg_id, to='pump', prop='speed'):
+    return {'TOPICS': {'TO': to, 'FROM': from_, 'MSG_ID': msg_id, 'MSG_TYPE': 'PROPERTY'},
+            'CONTENTS': {'PROPERTY': prop, 'ACTION': 'GET'}}
+
+
+def value(to, msg_id, val, from_='pump', prop='speed'):
+    return {'TOPICS': {'TO': to, 'FROM': from_, 'MSG_ID': msg_id, 'MSG_TYPE': 'RESPONSE', 'MSG_STATUS': 'OK'},
+            'CONTENTS': {'PROPERTY': prop, 'ACTION': 'RESPONSE', 'VALUE': val}}
+
+
+class PropertyGetCoalescerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = FakeBroker()
+
+    def testCoalescesIdenticalGets(self):
+        for i, requester in enumerate(['ui', 'script', 'panel']):
+            self.broker._publish(get(requester, i))
+        self.broker._publish(get('ui', 9, prop='rate'))  # a different property goes out
+        self.assertEqual(len(self.broker.published), 2)
+
+        self.broker._publish(value('ui', 0, 42))
+        answers = [(x['TOPICS']['TO'], x['TOPICS']['MSG_ID'], x['CONTENTS']['VALUE'])
+                   for x in self.broker.published[2:]]
+        self.assertEqual(answers, [('ui', 0, 42), ('script', 1, 42), ('panel', 2, 42)])
+        self.assertEqual(self.broker.property_gets.coalesced, 2)
+
+        # nothing in flight any more, so the next GET goes to the item
+        self.broker._publish(get('ui', 3))
+        self.assertEqual(self.broker.published[-1]['TOPICS']['MSG_TYPE'], 'PROPERTY')
+
+    def testExpiredGetReleasesFollowers(self):
+        self.broker._publish(get('ui', 0))
+        self.broker._publish(get('script', 1))
+        self.broker.reactor.advance(PropertyGetCoalescer.IN_FLIGHT_TIMEOUT)
+        self.assertEqual([x['TOPICS']['FROM'] for x in self.broker.published], ['ui', 'script'])
+
+    def testCache(self):
+        self.broker.property_gets.set_cache_ttl('pump', 'speed', 5)
+        self.broker._publish(get('ui', 0))
+        self.broker._publish(value('ui', 0, 42))
+        self.broker._publish(get('script', 1))
+        self.assertEqual(self.broker.published[-1]['TOPICS']['TO'], 'script')
+        self.assertEqual(self.broker.property_gets.cache_hits, 1)
+
+        # a SET drops the cached value
+        self.broker._publish({'TOPICS': {'TO': 'pump', 'FROM': 'ui', 'MSG_ID': 2, 'MSG_TYPE': 'PROPERTY'},
+                              'CONTENTS': {'PROPERTY': 'speed', 'ACTION': 'SET', 'VALUE': 1}})
+        self.broker._publish(get('script', 3))
+        self.assertEqual(self.broker.published[-1]['TOPICS']['TO'], 'pump')
+
+        self.broker._publish(value('script', 3, 1))
+        self.broker.reactor.advance(6)  # too old now
+        self.broker._publish(get('panel', 4))
+        self.assertEqual(self.broker.published[-1]['TOPICS']['TO'], 'pump')
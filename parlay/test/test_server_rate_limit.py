@@ -0,0 +1,86 @@
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from parlay.server.rate_limit import PublishLimits, RateLimitPolicy
+
+
+class FakeBroker(object):
+    def __init__(self):
+        self.reactor = Clock()
+        self.published = []
+
+    def publish(self, msg, write_method=None):
+        self.published.append(msg['CONTENTS']['VALUE'])
+
+
+def msg(value, from_='script', msg_id=None):
+    topics = {'FROM': from_, 'TO': 'pump', 'MSG_TYPE': 'COMMAND'}
+    if msg_id is not None:
+        topics['MSG_ID'] = msg_id
+    return {'TOPICS': topics, 'CONTENTS': {'VALUE': value}}
+
+
+class PublishLimitsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = FakeBroker()
+        self.limits = PublishLimits(self.broker)
+
+    def testOffByDefault(self):
+        connection = self.limits.connection('ws')
+        for i in range(100):
+            connection.publish(msg(i))
+        self.assertEqual(len(self.broker.published), 100)
+
+    def testDrop(self):
+        self.limits.configure(connection_rate=10, connection_burst=5)
+        connection = self.limits.connection('ws')
+        for i in range(20):
+            connection.publish(msg(i))
+        self.assertEqual(self.broker.published, range(5))
+        self.broker.reactor.advance(0.1)  # one more token
+        connection.publish(msg(20))
+        self.assertEqual(self.broker.published[-1], 20)
+        self.assertEqual((self.limits.limited, self.limits.dropped), (15, 15))
+        self.assertEqual(self.limits.get_stats()['limited_from'], [{'FROM': 'script', 'limited': 15}])
+
+    def testDelayKeepsOrder(self):
+        self.limits.configure(connection_rate=10, connection_burst=1, policy=RateLimitPolicy.DELAY)
+        connection = self.limits.connection('ws')
+        for i in range(5):
+            connection.publish(msg(i))
+        self.assertEqual(self.broker.published, [0])
+        for _ in range(4):
+            self.broker.reactor.advance(0.1)
+        self.assertEqual(self.broker.published, range(5))
+
+    def testReject(self):
+        self.limits.configure(from_rate=1, policy=RateLimitPolicy.REJECT)
+        replies = []
+        connection = self.limits.connection('ws')
+        connection.publish(msg(0, msg_id=1), replies.append)
+        connection.publish(msg(1, msg_id=2), replies.append)
+        # a different FROM has its own bucket
+        connection.publish(msg(2, from_='other', msg_id=3), replies.append)
+        self.assertEqual(self.broker.published, [0, 2])
+        self.assertEqual([(r['TOPICS']['TO'], r['TOPICS']['MSG_ID'], r['TOPICS']['MSG_STATUS']) for r in replies],
+                         [('script', 2, 'ERROR')])
+
+    def testFromLimitSharedAcrossConnections(self):
+        self.limits.configure(from_rate=2)
+        for name in ('ws1', 'ws2', 'ws3'):
+            self.limits.connection(name).publish(msg(name))
+        self.assertEqual(self.broker.published, ['ws1', 'ws2'])
+
+    def testBadPolicy(self):
+        self.assertRaises(ValueError, self.limits.configure, policy='ignore')
+
+    def testUnchangedLimitsDontRefill(self):
+        self.limits.configure(connection_rate=10, connection_burst=2, from_rate=10, from_burst=2)
+        connection = self.limits.connection('ws')
+        for i in range(3):
+            connection.publish(msg(i))
+        self.limits.configure()  # what a stats poll used to do
+        self.limits.configure(connection_rate=10, from_rate=10, policy=RateLimitPolicy.DROP)
+        connection.publish(msg(3))
+        self.assertEqual(self.broker.published, [0, 1])
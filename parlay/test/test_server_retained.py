@@ -0,0 +1,52 @@
+from twisted.trial import unittest
+
+from parlay.server.retained import RetainedValues, RETAINED_KEY, retain_key
+
+
+def _stream(item, stream, value):
+    return {'TOPICS': {'FROM': item, 'MSG_TYPE': 'STREAM', 'STREAM': stream}, 'CONTENTS': {'VALUE': value}}
+
+
+def _property(item, prop, value, status='OK'):
+    return {'TOPICS': {'FROM': item, 'TO': 'ui', 'MSG_TYPE': 'RESPONSE', 'MSG_STATUS': status},
+            'CONTENTS': {'PROPERTY': prop, 'ACTION': 'RESPONSE', 'VALUE': value}}
+
+
+class RetainedValuesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.retained = RetainedValues(max_size=3, ttl=10, clock=lambda: self.now)
+
+    def testRetainKey(self):
+        self.assertEqual(retain_key(_stream('pump', 'rate', 1)), ('pump', 'STREAM', 'rate'))
+        self.assertEqual(retain_key(_property('pump', 'speed', 5)), ('pump', 'PROPERTY', 'speed'))
+        self.assertEqual(retain_key(_property('pump', 'speed', 5, status='ERROR')), None)
+        # asking for a stream isn't a sample
+        self.assertEqual(retain_key({'TOPICS': {'FROM': 'ui', 'MSG_TYPE': 'STREAM'}, 'CONTENTS': {'STREAM': 'x'}}),
+                         None)
+
+    def testLastValueWins(self):
+        self.retained.observe(_stream('pump', 'rate', 1))
+        self.retained.observe(_stream('pump', 'rate', 2))
+        found = self.retained.match({'FROM': 'pump'})
+        self.assertEqual([x['CONTENTS']['VALUE'] for x in found], [2])
+        self.assertEqual(found[0][RETAINED_KEY], 0)
+
+    def testBoundedAndExpires(self):
+        for i in range(5):
+            self.retained.observe(_stream('pump', 'stream' + str(i), i))
+        self.assertEqual(len(self.retained), 3)
+        self.now += 5
+        self.retained.observe(_property('pump', 'speed', 5))
+        self.now += 6  # the streams are too old now, the property isn't
+        found = self.retained.match({'FROM': 'pump'})
+        self.assertEqual([x['CONTENTS'].get('PROPERTY') for x in found], ['speed'])
+        self.assertEqual(found[0][RETAINED_KEY], 6)
+
+    def testReplay(self):
+        self.retained.observe(_stream('pump', 'rate', 1))
+        self.retained.observe(_stream('valve', 'rate', 7))
+        received = []
+        self.assertEqual(self.retained.replay({'FROM': 'valve', 'MSG_TYPE': 'STREAM'}, received.append), 1)
+        self.assertEqual(received[0]['CONTENTS']['VALUE'], 7)
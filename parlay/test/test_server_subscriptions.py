@@ -0,0 +1,82 @@
+import json
+
+from twisted.trial import unittest
+
+from parlay.server.subscriptions import Subscription, SubscriptionIndex, InterestTable, Predicate, compile_topics, \
+    prefix, one_of, between
+
+
+def subscription(index, **topics):
+    sub = Subscription(compile_topics(topics))
+    index.add(sub)
+    return sub
+
+
+class PredicateTests(unittest.TestCase):
+
+    def testPredicates(self):
+        self.assertTrue(prefix("sub3/").test("sub3/pump"))
+        self.assertFalse(prefix("sub3/").test(3))
+        self.assertTrue(one_of("ERROR", "WARNING").test("WARNING"))
+        self.assertFalse(one_of("ERROR", "WARNING").test(["unhashable"]))
+        self.assertTrue(between(0, 10).test(10))
+        self.assertFalse(between(0, None).test(-1))
+        self.assertFalse(between(0, 10).test(True))
+
+    def testStillJSON(self):
+        predicate = Predicate({"$in": ["ERROR", "WARNING"]})
+        self.assertEqual(json.loads(json.dumps(predicate)), {"$in": ["ERROR", "WARNING"]})
+        # hashable, and the order of a $in doesn't matter
+        self.assertEqual(hash(predicate), hash(one_of("WARNING", "ERROR")))
+
+    def testBadPredicates(self):
+        self.assertRaises(ValueError, compile_topics, {"FROM": {"$regex": ".*"}})
+        self.assertRaises(ValueError, compile_topics, {"FROM": {"$prefix": 3}})
+        self.assertRaises(ValueError, compile_topics, {"VALUE": {"$range": [0]}})
+
+
+class PredicateIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index = SubscriptionIndex()
+
+    def testPrefix(self):
+        sub = subscription(self.index, FROM={"$prefix": "sub3/"})
+        self.assertEqual(self.index.match({"FROM": "sub3/pump"}), [sub])
+        self.assertEqual(self.index.match({"FROM": "sub4/pump"}), [])
+        self.assertEqual(self.index.match({"FROM": "sub3"}), [])
+
+    def testValueShorterThanLongerPrefix(self):
+        short = subscription(self.index, FROM={"$prefix": "ab"})
+        long_ = subscription(self.index, FROM={"$prefix": "abc"})
+        self.assertEqual(self.index.match({"FROM": "ab"}), [short])
+        self.assertEqual(sorted(self.index.match({"FROM": "abcd"}), key=id), sorted([short, long_], key=id))
+
+    def testInIsFiledUnderEachValue(self):
+        sub = subscription(self.index, MSG_STATUS={"$in": ["ERROR", "WARNING"]}, FROM={"$prefix": "sub3/"})
+        self.assertEqual(self.index.match({"MSG_STATUS": "WARNING", "FROM": "sub3/pump"}), [sub])
+        self.assertEqual(self.index.match({"MSG_STATUS": "OK", "FROM": "sub3/pump"}), [])
+        self.assertEqual(list(self.index.subscriptions()), [sub])
+        self.assertEqual(len(self.index), 1)
+
+    def testRangeWithExactAnchor(self):
+        sub = subscription(self.index, TO="ui", VALUE={"$range": [0, 10]})
+        self.assertEqual(self.index.match({"TO": "ui", "VALUE": 5}), [sub])
+        self.assertEqual(self.index.match({"TO": "ui", "VALUE": 11}), [])
+
+    def testRemove(self):
+        subs = [subscription(self.index, FROM={"$prefix": "sub3/"}),
+                subscription(self.index, MSG_STATUS={"$in": ["ERROR", "WARNING"]}),
+                subscription(self.index, VALUE={"$range": [None, 0]})]
+        for sub in subs:
+            self.index.remove(sub)
+        self.assertEqual(len(self.index), 0)
+        self.assertEqual(self.index.match({"FROM": "sub3/pump", "MSG_STATUS": "ERROR", "VALUE": -1}), [])
+
+    def testInterestTable(self):
+        table = InterestTable()
+        # a peer sends its topics as plain JSON
+        table.add(json.loads(json.dumps({"FROM": prefix("sub3/")})))
+        self.assertTrue(table.wants({"FROM": "sub3/pump"}))
+        table.remove({"FROM": {"$prefix": "sub3/"}})
+        self.assertFalse(table.wants({"FROM": "sub3/pump"}))
@@ -0,0 +1,71 @@
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from parlay.server.throttle import RateThrottle
+
+
+class FakeDispatcher(object):
+    def schedule(self, priority, msg, funcs):
+        for func in funcs:
+            func(msg)
+
+
+class FakeBroker(object):
+    def __init__(self):
+        self.reactor = Clock()
+        self._dispatcher = FakeDispatcher()
+
+
+def sample(value, stream='rate', from_='pump'):
+    return {'TOPICS': {'FROM': from_, 'MSG_TYPE': 'STREAM', 'STREAM': stream}, 'CONTENTS': {'VALUE': value}}
+
+
+class RateThrottleTests(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = FakeBroker()
+        self.throttle = RateThrottle(self.broker)
+        self.received = []
+
+    def testLatest(self):
+        listener = self.throttle.listener(self.received.append, 10)
+        for i in range(100):
+            listener(sample(i))
+        listener(sample(7, stream='other'))
+        self.assertEqual(self.received, [])
+        self.broker.reactor.advance(0.1)
+        self.assertEqual([(x['TOPICS']['STREAM'], x['CONTENTS']['VALUE']) for x in self.received],
+                         [('rate', 99), ('other', 7)])
+
+    def testMeanAndMinMax(self):
+        mean = self.throttle.listener(self.received.append, 10, 'mean')
+        minmax = self.throttle.listener(self.received.append, 10, 'minmax')
+        for value in (1, 5, 3):
+            mean(sample(value))
+            minmax(sample(value))
+        self.broker.reactor.advance(0.1)
+        self.assertEqual(self.received[0]['CONTENTS']['VALUE'], 3.0)
+        self.assertEqual((self.received[1]['CONTENTS']['MIN'], self.received[1]['CONTENTS']['MAX']), (1, 5))
+        self.assertEqual(self.received[1]['CONTENTS']['COUNT'], 3)
+
+    def testOneTimerPerRate(self):
+        listeners = [self.throttle.listener(self.received.append, 10) for _ in range(5)]
+        for listener in listeners:
+            listener(sample(1))
+        self.assertEqual(len(self.broker.reactor.getDelayedCalls()), 1)
+
+    def testOtherMessagesNotHeld(self):
+        listener = self.throttle.listener(self.received.append, 1)
+        listener({'TOPICS': {'FROM': 'pump', 'MSG_TYPE': 'EVENT'}, 'CONTENTS': {'EVENT': 'alarm'}})
+        self.assertEqual(len(self.received), 1)
+
+    def testCancel(self):
+        listener = self.throttle.listener(self.received.append, 10)
+        listener(sample(1))
+        listener.cancel()
+        self.broker.reactor.advance(0.1)
+        self.assertEqual(self.received, [])
+
+    def testBadRate(self):
+        self.assertRaises(ValueError, self.throttle.listener, self.received.append, 0)
+        self.assertRaises(ValueError, self.throttle.listener, self.received.append, 10, 'median')
@@ -0,0 +1,103 @@
+import os
+import tempfile
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from parlay.server.traffic_log import TrafficRecorder, TrafficLogReader, TrafficLogError, INDEX_SUFFIX
+from parlay.server.replay import TrafficReplayer
+from parlay.server.broker import Broker
+
+
+def msg(i, topic_type=None):
+    topics = {'TO': 'traffic_item', 'MSG_ID': i}
+    if topic_type is not None:
+        topics['type'] = topic_type
+    return {'TOPICS': topics, 'CONTENTS': {'VALUE': i}}
+
+
+class FakeBroker(object):
+    def __init__(self):
+        self.reactor = Clock()
+        self.published = []
+
+    def publish_many(self, msgs, write_method=None):
+        self.published.extend(msgs)
+
+
+class TrafficLogTests(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".log")
+        os.close(fd)
+        os.remove(self.path)  # the recorder writes its own header
+
+    def tearDown(self):
+        for path in (self.path, self.path + INDEX_SUFFIX):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def record(self, msgs):
+        recorder = TrafficRecorder(self.path)
+        for m in msgs:
+            recorder.record(m)
+        recorder.close()
+        return recorder
+
+    def testRecordAndRead(self):
+        recorder = self.record([msg(i) for i in range(10)])
+        self.assertEqual(recorder.recorded, 10)
+        reader = TrafficLogReader(self.path)
+        self.assertEqual(len(reader), 10)
+        self.assertEqual([m['CONTENTS']['VALUE'] for _, m in reader], range(10))
+        reader.close()
+
+    def testSeekByTime(self):
+        self.record([msg(i) for i in range(10)])
+        reader = TrafficLogReader(self.path)
+        timestamps = [t for t, _ in reader]
+        records = list(reader.records(start_time=timestamps[5]))
+        self.assertEqual(records[0][1]['CONTENTS']['VALUE'], 5)
+        self.assertEqual(list(reader.records(start_time=timestamps[-1] + 1)), [])
+        reader.close()
+
+    def testTruncatedLog(self):
+        self.record([msg(i) for i in range(3)])
+        with open(self.path, 'rb+') as f:
+            f.truncate(os.path.getsize(self.path) - 2)  # crash in the middle of the last record
+        reader = TrafficLogReader(self.path)
+        self.assertEqual(len(list(reader)), 2)
+        reader.close()
+
+    def testNotATrafficLog(self):
+        with open(self.path, 'wb') as f:
+            f.write("this is not a traffic log")
+        self.assertRaises(TrafficLogError, TrafficLogReader, self.path)
+
+    def testReplayMaxSpeed(self):
+        self.record([msg(0), msg(1, topic_type='subscribe'), msg(2)])
+        broker = FakeBroker()
+        results = []
+        TrafficReplayer(broker, self.path, speed=None).start().addCallback(results.append)
+        self.assertEqual([m['CONTENTS']['VALUE'] for m in broker.published], [0, 2])
+        self.assertEqual(results[0]['published'], 2)
+        self.assertEqual(results[0]['skipped'], 1)
+
+    def testRecordedBeforeRouting(self):
+        # the broker answers a subscribe with a copy that shares its TOPICS, and changes them
+        broker = Broker.get_instance()
+        broker.start_traffic_recorder(self.path)
+        broker.publish({'TOPICS': {'type': 'subscribe'}, 'CONTENTS': {'TOPICS': {'TO': 'traffic_item'}}},
+                       lambda _: None)
+        broker.stop_traffic_recorder()
+        reader = TrafficLogReader(self.path)
+        self.assertEqual([m['TOPICS'] for _, m in reader], [{'type': 'subscribe'}])
+        reader.close()
+
+    def testReplayMeasureLatency(self):
+        self.record([msg(i) for i in range(3)])
+        results = []
+        TrafficReplayer(Broker.get_instance(), self.path, speed=None,
+                        measure_latency=True).start().addCallback(results.append)
+        self.assertEqual(results[0]['published'], 3)
+        self.assertEqual(results[0]['undelivered'], 0)
+        self.assertIn('latency_ms', results[0])
@@ -0,0 +1,66 @@
+import json
+
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from parlay.server.envelope import ParlayMessage, encode_message
+from parlay.server.traffic_stats import TrafficStats, TABLE_COLUMNS
+
+
+def msg(from_, msg_type='STREAM', to=None):
+    return {'TOPICS': {'FROM': from_, 'MSG_TYPE': msg_type, 'TO': to}, 'CONTENTS': {'VALUE': 1}}
+
+
+class TrafficStatsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.stats = TrafficStats(clock=self.clock.seconds)
+
+    def testCountsPerPublisher(self):
+        for _ in range(20):
+            self.stats.record(msg('pump'), 2)
+        self.stats.record(msg('pump', 'EVENT'), 0)
+        rows = self.stats.get_publishers()
+        self.assertEqual([(r['FROM'], r['MSG_TYPE'], r['messages']) for r in rows],
+                         [('pump', 'STREAM', 20), ('pump', 'EVENT', 1)])
+        # two samples of the same message, so the estimate is exact
+        self.assertEqual(rows[0]['bytes'], 20 * len(json.dumps(msg('pump'))))
+        self.assertEqual(self.stats.deliveries, 40)
+
+    def testSampleNotCached(self):
+        sampled = ParlayMessage.from_dict(msg('pump'))
+        self.stats.record(sampled, 1)
+        # a listener changes it after the stats saw it, and subscribers send out the change
+        sampled['CONTENTS']['VALUE'] = 2
+        self.assertEqual(json.loads(encode_message(sampled))['CONTENTS']['VALUE'], 2)
+        self.assertEqual(self.stats.get_publishers()[0]['bytes'], len(json.dumps(msg('pump'))))
+
+    def testRollingRates(self):
+        for second in range(10):
+            for _ in range(second + 1):
+                self.stats.record(msg('pump'), 0)
+            self.clock.advance(1)
+        row = self.stats.get_publishers()[0]
+        self.assertEqual(row['rate_1s'], 10.0)
+        self.assertEqual(row['rate_10s'], 5.5)
+        self.assertEqual(row['rate_60s'], 55 / 60.0)
+
+        self.clock.advance(100)
+        self.assertEqual(self.stats.get_publishers()[0]['rate_60s'], 0.0)
+
+    def testNoisiestFirst(self):
+        self.stats.record(msg('quiet'), 0)
+        for _ in range(5):
+            self.stats.record(msg('noisy'), 0)
+        self.clock.advance(1)
+        stats = self.stats.get_stats(top=1)
+        self.assertEqual(stats['table']['columns'], TABLE_COLUMNS)
+        self.assertEqual([row[0] for row in stats['table']['rows']], ['noisy'])
+
+    def testFanOutPerDestination(self):
+        self.stats.record(msg('ui', 'COMMAND', to='pump'), 1)
+        self.stats.record(msg('ui', 'COMMAND', to='pump'), 3)
+        self.assertEqual(self.stats.get_destinations(), [{'TO': 'pump', 'messages': 2, 'deliveries': 4}])
+        self.stats.reset()
+        self.assertEqual(self.stats.get_destinations(), [])
@@ -105,7 +105,7 @@ class ParlayScript(ThreadedItem):
 
 
 def start_script(script_class, engine_ip='localhost', engine_port=DEFAULT_ENGINE_WEBSOCKET_PORT,
-                 stop_reactor_on_close=None, skip_checks=False, reactor=None):
+                 stop_reactor_on_close=None, skip_checks=False, reactor=None, codecs=None):
     """
     Construct a new script from the script class and start it
 
@@ -115,6 +115,8 @@ def start_script(script_class, engine_ip='localhost', engine_port=DEFAULT_ENGINE
     :param stop_reactor_on_close: Boolean regarding whether ot not to stop the reactor when the script closes
     (Defaults to False if the reactor is running, True if the reactor is not currently running)
     :param skip_checks : if True will not do sanity checks on script (CAREFUL: BETTER KNOW WHAT YOU ARE DOING!)
+    :param codecs : names of the wire codecs to offer the broker, most preferred first. e.g. ['msgpack', 'json']
+    (Defaults to JSON only)
     """
     if not skip_checks:
         if not issubclass(script_class, ParlayScript):
@@ -127,7 +129,8 @@ def start_script(script_class, engine_ip='localhost', engine_port=DEFAULT_ENGINE
     script_class.stop_reactor_on_close = stop_reactor_on_close if stop_reactor_on_close is not None else not reactor.running
 
     # connect it up
-    factory = WebsocketClientAdapterFactory("ws://" + engine_ip + ":" + str(engine_port), reactor=reactor)
+    factory = WebsocketClientAdapterFactory("ws://" + engine_ip + ":" + str(engine_port), reactor=reactor,
+                                            codecs=codecs)
     adapter = factory.adapter
     script_item = script_class(_reactor=reactor, adapter=adapter)
     reactor.connectTCP(engine_ip, engine_port, factory)
@@ -73,7 +73,10 @@ setup(
                    "cffi>=1.5.0",
                    "service-identity >=14.0.0",
                    "requests",
-                   "ipaddress>=1.0.16"]
+                   "ipaddress>=1.0.16"],
+        "binary": ["msgpack>=0.5.2",
+                   "cbor2>=4.0.0"],
+        "profiling": ["monotonic>=1.5"]
     },
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -88,7 +91,8 @@ setup(
     entry_points={
         'console_scripts': [
               'parlay = parlay.__main__:main',
-              'findparlay = parlay.server.advertiser:main'
+              'findparlay = parlay.server.advertiser:main',
+              'parlayreplay = parlay.server.replay:main'
           ]
     }
 )